@@ -2,4 +2,21 @@ from .cloudbatch import CloudBatch
 from .gsbatch import GSBatch
 from .localbatch import LocalBatch
 from .cdsbatch import CDSBatch
-from .apply_batch_func import apply_batch_func
\ No newline at end of file
+from .apply_batch_func import apply_batch_func, iter_apply
+from .backends import TransferBackend, GSUtilBackend, GCSBackend, LocalBackend
+from .cache import DiskCache
+from .checkpoint import Checkpoint
+from .retry import RetryPolicy, TransferError
+from .metrics import BatchStats, Callback, ProgressReporter
+from .filemaker import ComponentFileList, file_list_from_components
+from .listing import Lister
+from .sharding import BatchLeases, shard_from_env
+from .staging import StagingArea
+from .manifest import Manifest
+from .checksum import Hasher, file_hashes, check_file
+from .autotune import BatchAutotuner
+from .shards import ShardArchive, ShardMember, write_shard
+from .remotefile import RemoteFile
+from .align import AlignmentError, check_alignment, join_on_key
+from .sinks import Sink, MemorySink, JSONLinesSink, NpySink, NpyResults, ParquetSink, ZarrSink, read_results
+from .asyncbatch import AsyncGSBatch, async_apply_batch_func
\ No newline at end of file
@@ -0,0 +1,204 @@
+import os.path as path
+import re
+import numpy as np
+
+# Number of mismatches spelled out in an AlignmentError message
+_N_REPORTED = 5
+
+class AlignmentError(Exception):
+    '''
+    Raised when CloudBatch objects that are processed together don't line up.
+
+    ATTRIBUTES
+        mismatches (list)  :: One dictionary per problem found, with key 'kind'
+                              ('n_batches', 'batch_size', 'key', 'missing',
+                              'duplicate' or 'no_match') and keys describing
+                              where it is.
+    '''
+
+    def __init__(self, message, mismatches):
+        super().__init__(message)
+        self.mismatches = mismatches
+
+def key_function(key, sep = '_'):
+    ''' Turn a key specification into a function of a file name.
+
+    key may be:
+        a function     :: called with each file name.
+        a regex (str)  :: searched for in each name. The key is the group
+                          named 'key' if there is one, else every group
+                          joined with sep, else the whole match.
+        indices (tuple):: Positions of the components to keep when the base
+                          name, without its extension, is split on sep. E.g.
+                          (0, 2) gives 'a_c' for 'dir/a_b_c.nc'.
+    '''
+
+    if callable(key):
+        return key
+
+    if isinstance(key, (str, re.Pattern)):
+        regex = re.compile(key)
+
+        def regex_key(name):
+            match = regex.search(name)
+            if match is None:
+                raise AlignmentError(f"{name} does not match the key pattern {regex.pattern!r}.",
+                                     [{'kind' : 'no_match', 'file' : name}])
+            if 'key' in regex.groupindex:
+                return match.group('key')
+            if regex.groups > 0:
+                return sep.join([gg or '' for gg in match.groups()])
+            return match.group(0)
+
+        return regex_key
+
+    indices = [int(ii) for ii in key]
+
+    def component_key(name):
+        parts = path.splitext(path.basename(name))[0].split(sep)
+        return sep.join([parts[ii] for ii in indices])
+
+    return component_key
+
+def file_keys(files, key, sep = '_'):
+    ''' Numpy array of the key of every file '''
+    func = key_function(key, sep)
+    return np.array([func(ff) for ff in files], dtype=str)
+
+def check_alignment(batch, same_sizes = True, key = None, sep = '_'):
+    ''' Check that a list of CloudBatch objects can be processed together,
+    without transferring anything.
+
+    Every object must have the same number of batches. If same_sizes, each
+    batch must also hold the same number of files in every object, which is
+    needed when files are paired one by one (pass_args='one'). If key is
+    given (see key_function()), files in the same position must also have
+    the same key. A key may also be a list with one specification per object.
+
+    Raises AlignmentError describing the first few mismatches.
+    '''
+
+    if len(batch) < 2:
+        return
+
+    n_batches = [bt.n_batches for bt in batch]
+    mismatches = [{'kind' : 'n_batches', 'object' : ii, 'n_batches' : nn, 'expected' : n_batches[0]}
+                  for ii, nn in enumerate(n_batches) if nn != n_batches[0]]
+    if len(mismatches) > 0:
+        raise AlignmentError(f"Objects have different numbers of batches: {n_batches}.", mismatches)
+
+    if same_sizes or key is not None:
+        ref_sizes = np.diff(batch[0].batch_bounds)
+        for ii, bt in enumerate(batch[1:], 1):
+            bad = np.flatnonzero(np.diff(bt.batch_bounds) != ref_sizes)
+            mismatches += [{'kind' : 'batch_size', 'object' : ii, 'batch' : int(bb),
+                            'size' : int(bt.batch_bounds[bb + 1] - bt.batch_bounds[bb]),
+                            'expected' : int(ref_sizes[bb])} for bb in bad]
+        if len(mismatches) > 0:
+            lines = [f"batch {mm['batch']} of object {mm['object']} has {mm['size']} files, "
+                     f"object 0 has {mm['expected']}" for mm in mismatches[:_N_REPORTED]]
+            raise AlignmentError(_message("Batch sizes differ between objects", lines, mismatches), mismatches)
+
+    if key is None:
+        return
+
+    keys = [file_keys(bt.files, kk, sep) for bt, kk in zip(batch, _per_object(key, len(batch)))]
+    for ii in range(1, len(batch)):
+        bad = np.flatnonzero(keys[ii] != keys[0])
+        mismatches += [{'kind' : 'key', 'object' : ii, 'file' : int(ff),
+                        'key' : str(keys[ii][ff]), 'expected' : str(keys[0][ff])} for ff in bad]
+    if len(mismatches) > 0:
+        lines = [f"file {mm['file']} of object {mm['object']} has key {mm['key']!r}, "
+                 f"object 0 has {mm['expected']!r}" for mm in mismatches[:_N_REPORTED]]
+        raise AlignmentError(_message("Files are not paired by key", lines, mismatches), mismatches)
+
+def join_on_key(batch, key, how = 'exact', sep = '_'):
+    ''' Reorder the files of every object so that files with the same key
+    are in the same position as in the first object, then give every object
+    the batches of the first object.
+
+    INPUTS
+        batch (list)  :: CloudBatch objects. The first sets the order.
+        key           :: Key specification, or a list of one per object. See
+                         key_function().
+        how (str)     :: 'exact' raises AlignmentError unless every object has
+                         the same set of keys. 'inner' drops files whose key
+                         is not in every object. [ Default = 'exact' ]
+        sep (str)     :: Separator used by key_function(). [ Default = '_' ]
+
+    Keys must be unique within each object. Matching is done by sorting the
+    keys, so it stays fast for millions of files.
+    '''
+
+    if how not in ['exact', 'inner']:
+        raise Exception("Unrecognised how. Choose: how = ['exact','inner']")
+
+    keys = [file_keys(bt.files, kk, sep) for bt, kk in zip(batch, _per_object(key, len(batch)))]
+
+    mismatches = []
+    for ii, kk in enumerate(keys):
+        mismatches += [{'kind' : 'duplicate', 'object' : ii, 'key' : str(dd)} for dd in _duplicates(kk)]
+    if len(mismatches) > 0:
+        lines = [f"object {mm['object']} has key {mm['key']!r} more than once" for mm in mismatches[:_N_REPORTED]]
+        raise AlignmentError(_message("Keys are not unique", lines, mismatches), mismatches)
+
+    # For every file of the first object, where its key is in each object
+    where = [_match(keys[0], kk) for kk in keys]
+    keep = np.all([ww >= 0 for ww in where], axis=0)
+
+    if how == 'exact':
+        for ii in range(1, len(batch)):
+            missing = np.flatnonzero(where[ii] < 0)
+            mismatches += [{'kind' : 'missing', 'object' : ii, 'key' : str(keys[0][ff])} for ff in missing]
+            extra = np.flatnonzero(_match(keys[ii], keys[0]) < 0)
+            mismatches += [{'kind' : 'missing', 'object' : 0, 'key' : str(keys[ii][ff])} for ff in extra]
+        if len(mismatches) > 0:
+            lines = [f"key {mm['key']!r} is missing from object {mm['object']}" for mm in mismatches[:_N_REPORTED]]
+            raise AlignmentError(_message("Objects don't have the same keys", lines, mismatches), mismatches)
+
+    for bt, ww in zip(batch, where):
+        order = ww[keep]
+        if len(order) == len(bt.files) and np.all(order == np.arange(len(order))):
+            continue
+        bt.files = [bt.files[ff] for ff in order]
+        if bt.file_sizes is not None:
+            bt.file_sizes = bt.file_sizes[order]
+        bt.n_files = len(bt.files)
+
+    ref = batch[0]
+    ref.current_batch = 0
+    ref._rebatch()
+    for bt in batch[1:]:
+        bt.current_batch = 0
+        bt._set_bounds(ref.batch_bounds)
+
+    return batch
+
+def _per_object(key, n_objects):
+    ''' Expand key into one specification per object '''
+    if isinstance(key, list) and len(key) == n_objects and not all([isinstance(kk, int) for kk in key]):
+        return key
+    return [key] * n_objects
+
+def _match(ref_keys, keys):
+    ''' For each entry of ref_keys, the index of the same key in keys, or -1 '''
+
+    if len(keys) == 0:
+        return np.full(len(ref_keys), -1, dtype=np.int64)
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    pos = np.minimum(np.searchsorted(sorted_keys, ref_keys), len(keys) - 1)
+    found = sorted_keys[pos] == ref_keys
+
+    return np.where(found, order[pos], -1)
+
+def _duplicates(keys):
+    sorted_keys = np.sort(keys)
+    return np.unique(sorted_keys[1:][sorted_keys[1:] == sorted_keys[:-1]])
+
+def _message(title, lines, mismatches):
+    more = len(mismatches) - len(lines)
+    if more > 0:
+        lines = lines + [f"... and {more} more"]
+    return title + ":\n  " + "\n  ".join(lines)
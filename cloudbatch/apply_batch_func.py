@@ -1,4 +1,16 @@
 import numpy as np
+import os.path as path
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .checkpoint import Checkpoint
+from .retry import TransferError
+from .metrics import BatchStats, ProgressReporter
+from .sharding import BatchLeases, shard_batches
+from .sinks import Sink, MemorySink
+from .align import AlignmentError, check_alignment, join_on_key
+from .shards import member_size
+from .remotefile import RemoteFile
 
 class apply_batch_func():
     '''
@@ -20,16 +32,241 @@ class apply_batch_func():
     def __init__(self, func, batch, 
                  verbosity = 0,
                  pass_args = "one",
-                 delete_put_files = False):
+                 delete_put_files = False,
+                 prefetch = 0,
+                 executor = None,
+                 max_workers = None,
+                 split_output = None,
+                 checkpoint = None,
+                 resume = False,
+                 lazy = False,
+                 on_transfer_error = 'raise',
+                 progress = True,
+                 callbacks = None,
+                 shard = None,
+                 lease_dir = None,
+                 lease_ttl = 600,
+                 sink = None,
+                 align = 'check',
+                 align_key = None):
         '''
         func is a bespoke analysis function that should take a filename
         (or multiple file names) as input
+        
+        INPUTS
+            func (function)          :: Function to apply to the batch files.
+            batch (list)             :: CloudBatch object or list of aligned
+                                        CloudBatch objects.
+            verbosity (int)          :: 0, 1 or 2. Amount of printed output.
+            pass_args (str)          :: 'one' or 'all'. How files are passed to func.
+                                        'one' calls func once per file. 'all' calls
+                                        func once per batch, passing each object's
+                                        list of batch files as one argument.
+            delete_put_files (bool)  :: Delete local files once they are uploaded.
+            prefetch (int)           :: Number of batches to download ahead of the
+                                        current batch in the background. Uploads
+                                        also run in the background when > 0.
+                                        0 runs every step serially. [ Default = 0 ]
+            executor (str)           :: None, 'thread' or 'process'. Run the per-file
+                                        func calls of a batch in parallel using a pool
+                                        of this type. Exceptions raised by func are
+                                        collected in self.errors instead of stopping
+                                        the run. Failures of the pool itself, such as
+                                        func or its arguments not pickling, are
+                                        raised. [ Default = None ]
+            max_workers (int)        :: Size of the executor pool. [ Default = None ]
+            split_output (function)  :: Only used with pass_args='all'. Takes the
+                                        output of func for a batch and returns a 
+                                        sequence with one element per file, so that
+                                        self.output[batch][file] still works. If None,
+                                        the func output is stored as is. [ Default = None ]
+            checkpoint (str)         :: Path of a checkpoint journal, or a Checkpoint
+                                        object. The output of every finished batch is
+                                        appended to it. Batches in which func raised
+                                        for any file (see executor) are left out, so
+                                        a resumed run does them again. [ Default = None ]
+            resume (bool)            :: Continue from the batches recorded in checkpoint,
+                                        skipping them without downloading. If False,
+                                        any existing checkpoint is overwritten.
+                                        [ Default = False ]
+            on_transfer_error (str)  :: 'raise' or 'skip'. What to do when files still
+                                        fail to transfer after retrying (see 
+                                        RetryPolicy). 'skip' records the batch in
+                                        self.failed_batches, gives it an output of
+                                        None and carries on. Skipped batches are not
+                                        checkpointed, so a resumed run retries them.
+                                        [ Default = 'raise' ]
+            lazy (bool)              :: Don't run straight away. Iterating over the
+                                        object then runs the batches one at a time,
+                                        yielding (batch_index, output) without keeping
+                                        outputs in self.output. See iter_apply().
+                                        [ Default = False ]
+            progress (bool)          :: Print a progress line with throughput and an
+                                        estimated time left. [ Default = True ]
+            callbacks (list)         :: Callback objects (see metrics.Callback) or
+                                        functions called with the stats record of
+                                        each batch as it finishes. [ Default = None ]
+            shard                    :: Process only part of the batches, for running
+                                        the same job on several machines. Either
+                                        (shard_index, num_shards), or 'env' to read
+                                        them from a job array's environment variables
+                                        (see sharding.shard_from_env()). Batches are
+                                        dealt out round robin by batch index, so
+                                        aligned objects stay paired. [ Default = None ]
+            lease_dir (str)          :: Shared directory or bucket path. If set, each
+                                        batch is claimed with a lease file before it
+                                        is processed, and once its own shard is done
+                                        a worker takes over batches that other
+                                        workers have not claimed or have abandoned.
+                                        See sharding.BatchLeases. [ Default = None ]
+            lease_ttl (float)        :: Seconds before an unfinished lease held by
+                                        another worker is taken over. [ Default = 600 ]
+            sink (Sink)              :: Where each batch output goes as soon as the
+                                        batch finishes, e.g. NpySink, ZarrSink,
+                                        ParquetSink or JSONLinesSink (see sinks.py).
+                                        self.output is then sink.result() instead of
+                                        a list, so outputs are never all held in
+                                        memory. If None, outputs are kept in memory,
+                                        or not kept at all when lazy. [ Default = None ]
+            align (str)              :: How the objects in batch are lined up, checked
+                                        before anything is transferred.
+                                        'check' requires the same batches in every
+                                        object, with the same number of files in each
+                                        when pass_args='one', and if align_key is
+                                        given, the same key for files in the same
+                                        position. 'exact' first reorders every
+                                        object's files to match the first object's
+                                        on align_key, and 'inner' does the same but
+                                        drops files whose key is missing from any
+                                        object. None only checks the number of
+                                        batches. Problems raise an AlignmentError.
+                                        See align.py. [ Default = 'check' ]
+            align_key                :: Key derived from each file name: a regex, a
+                                        tuple of component indices or a function,
+                                        or a list of one per object. See
+                                        align.key_function(). [ Default = None ]
          
         OUTPUTS
+            self.output (list)       :: Function outputs, one list per batch, or
+                                        sink.result() when a sink is given.
+            self.batch_ids (list)    :: Batch index of each element of self.output.
+                                        Only differs from range(n_batches) when
+                                        sharding.
+            self.errors (list)       :: One dict per failed func call when using an
+                                        executor, with keys 'batch', 'file', 'args'
+                                        and 'error'. The output for that file is None.
+            self.failed_batches (list) :: One dict per batch skipped because of a
+                                        transfer error, with keys 'batch', 'op' and
+                                        'failures' (see TransferError).
+            self.stats (BatchStats)  :: Time spent getting, applying, putting and
+                                        deleting, bytes moved and func latency for
+                                        each batch. See metrics.BatchStats.
         '''
 
         if type(batch) is not list:
             batch = [batch]
+            
+        if prefetch < 0:
+            raise Exception("prefetch must be >= 0.")
+
+        self.func = func
+        self.batch = batch
+        self.verbosity = verbosity
+        self.pass_args = pass_args
+        self.delete_put_files = delete_put_files
+        self.prefetch = int(prefetch)
+        self.executor = executor
+        self.max_workers = max_workers
+        self.split_output = split_output
+        self.resume = resume
+        
+        if checkpoint is not None and not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        self.checkpoint = checkpoint
+        
+        if resume and checkpoint is None:
+            raise Exception("resume = True requires a checkpoint.")
+        self.errors = []
+        self.failed_batches = []
+        self.on_transfer_error = on_transfer_error
+        
+        if on_transfer_error not in ['raise', 'skip']:
+            raise Exception("Unrecognised on_transfer_error. Choose: on_transfer_error = ['raise','skip']")
+        
+        if executor not in [None, 'thread', 'process']:
+            raise Exception("Unrecognised executor. Choose: executor = [None, 'thread', 'process']")
+        
+        self.callbacks = [] if callbacks is None else list(callbacks)
+        if progress:
+            self.callbacks.append(ProgressReporter())
+            
+        # Objects made with batch_size='auto' are resized between batches
+        self._tuner = next((bt.autotune for bt in batch if getattr(bt, 'autotune', None) is not None), None)
+        if self._tuner is not None:
+            if shard is not None or lease_dir is not None or checkpoint is not None:
+                raise Exception("batch_size = 'auto' can't be used with shard, lease_dir or checkpoint, "
+                                "as batch indices change during the run.")
+            self._tuner.prefetch = self.prefetch
+            self.callbacks.append(self._autotune_step)
+        self.stats = BatchStats(self.callbacks)
+        
+        if shard == 'env':
+            shard = (None, None)
+        self.shard = shard
+        self.leases = None
+        if lease_dir is not None:
+            self.leases = BatchLeases(lease_dir, ttl = lease_ttl)
+
+        if sink is not None and not isinstance(sink, Sink):
+            raise Exception("sink must be a Sink object (see cloudbatch.sinks).")
+        self.sink = sink
+        
+        if align not in [None, 'check', 'exact', 'inner']:
+            raise Exception("Unrecognised align. Choose: align = [None, 'check', 'exact', 'inner']")
+        if align in ['exact', 'inner']:
+            if align_key is None:
+                raise Exception(f"align = '{align}' requires an align_key.")
+            join_on_key(batch, align_key, how = align)
+        self.align = align
+        self.align_key = align_key
+
+        if lazy:
+            return
+
+        if self.sink is None:
+            self.sink = MemorySink()
+
+        batch_ids = []
+        for bb, batch_out in self._write_to_sink(self._run()):
+            batch_ids.append(bb)
+        
+        self.batch_ids = sorted(batch_ids)
+        self.output = self.sink.result()
+        if verbosity ==1: print('Done! Phew.')
+        
+    def __iter__(self):
+        if self.sink is None:
+            return self._run()
+        return self._write_to_sink(self._run())
+        
+    def _write_to_sink(self, batches):
+        ''' Pass each (batch_index, output) to self.sink on its way through.
+        The sink is closed however the run ends, keeping what was written. '''
+        self.sink.open()
+        try:
+            for bb, batch_out in batches:
+                self.sink.write(bb, batch_out)
+                yield bb, batch_out
+        finally:
+            self.sink.close()
+        
+    def _run(self):
+        ''' Generator that cycles through all batches, yielding the
+        batch index and output of func for each batch in turn. '''
+        
+        func = self.func
+        batch = self.batch
+        verbosity = self.verbosity
 
         n_args = len(batch)
 
@@ -41,11 +278,9 @@ class apply_batch_func():
         if verbosity > 0: print("   --> Resetting all batches")
         [bb.reset_batch() for bb in batch]
 
-        # Check number of batches are aligned
-        if not np.all( [bb.n_batches for bb in batch] ):
-            raise Exception("n_batches does not match between input cloudbatch objects.")
+        # Check the objects line up before transferring anything
+        self._check_alignment()
                       
-        batch_size = batch[0].batch_size
         n_batches = batch[0].n_batches
         if verbosity > 0: print(f"   --> Number of batches: {n_batches}")
                     
@@ -58,77 +293,502 @@ class apply_batch_func():
         
         if n_gets == 0 and n_puts == 0:
             raise Exception(" You are not getting or putting any data so why use cloudbatch? ")
-
+            
+        done, batch_ids, n_own = self._plan(n_batches)
+        for bb in sorted(done):
+            yield bb, done[bb]
+            
+        self.stats = BatchStats(self.callbacks)
+        self.stats.run_start(n_own)
+        
+        self._pool = self._make_pool()
+        try:
+            if self.prefetch > 0:
+                yield from self._run_pipelined(batch_ids, n_batches, n_gets, n_puts)
+            else:
+                yield from self._run_serial(batch_ids, n_batches, n_gets, n_puts)
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait = True)
+                self._pool = None
+            
+            # Don't leave downloaded files behind if we stopped part way
+            [bt.delete_tmp_files() for bt in batch if bt.source == 'remote']
+            self.stats.run_end()
+                
+    def _plan(self, n_batches):
+        ''' Work out which batches to run. Returns the outputs of batches
+        restored from the checkpoint, by batch index, an iterable of the
+        batch indices left to run and how many of those are this worker's
+        own shard. '''
+        
+        batch_ids = self._shard_ids(n_batches)
+        n_own = len(batch_ids)
+        if self.leases is not None:
+            # Then offer to take over everyone else's batches, from the end
+            own = set(batch_ids)
+            batch_ids = batch_ids + [bb for bb in reversed(range(n_batches)) if bb not in own]
+            
+        # Pick up finished batches from a previous run
+        done = {}
+        if self.checkpoint is not None:
+            done = self.checkpoint.start(self._checkpoint_header(), resume = self.resume)
+            if self.verbosity > 0 and len(done) > 0: 
+                print(f"   --> Resuming. Skipping {len(done)} finished batches.")
+            n_own = len([bb for bb in batch_ids[:n_own] if bb not in done])
+            batch_ids = [bb for bb in batch_ids if bb not in done]
+            
+        if self.leases is not None:
+            batch_ids = self.leases.claims(batch_ids)
+        if self._tuner is not None:
+            batch_ids = self._tuned_ids()
+            
+        return done, batch_ids, n_own
+            
+    def _run_serial(self, batch_ids, n_batches, n_gets, n_puts):
+        
+        batch = self.batch
+        verbosity = self.verbosity
+        stats = self.stats
+        
         # Now start the cycle of going through batches and passing to the function
-        all_out = []
-        for bb in range(n_batches):
-            percent_done = bb / n_batches * 100
-            print(f"Progress: {percent_done}% ", end='\r')
-
-            if verbosity >= 1:
-                print(f"   --> Processing batch: {batch[0].current_batch + 1} / {batch[0].n_batches}")
+        for bb in batch_ids:
+            self._print_progress(bb, n_batches)
+            self._start_batch(bb)
+            [bt.goto_batch(bb) for bt in batch]
                 
             # Download the data if source is remote
             if n_gets > 0:
                 if verbosity >= 2: 
                     print(f"      --> Getting data from {n_gets} cloudbatch objects.")
-                [bt.get_batch() for bt in batch if bt.source == 'remote']
-
-            if pass_args == 'one':
-                if verbosity >=2: print(f"      --> Applying function one file at a time.")
-                batch_out = self._apply_one_at_a_time(func, batch)
-            elif pass_args == 'all':
-                if verbosity >=2: print(f"      --> Applying function to all files in batch.")
-                batch_out = self._apply_all_at_once(func, batch)
-            else:
-                raise Exception("Unrecognised pass option. Choose: pass_args = ['one','all']")
-                
-            # Stick the outputs onto the end of the current outputs
-            all_out.append(batch_out)
+                t0 = time.perf_counter()
+                try:
+                    [bt.get_batch() for bt in batch if bt.source == 'remote']
+                except TransferError as err:
+                    [bt.delete_tmp_files() for bt in batch if bt.source == 'remote']
+                    self._transfer_failed(bb, 'get', err)
+                    stats.batch_end(bb, failed = True)
+                    yield bb, None
+                    continue
+                t_get = time.perf_counter() - t0
+                stats.add(bb, 'get_s', t_get)
+                stats.add(bb, 'get_wait_s', t_get)
+                stats.add(bb, 'bytes_in', _nbytes([ff for bt in batch if bt.source == 'remote'
+                                                   for ff in bt.tmp_files]))
+
+            batch_out = self._apply(self.func, batch, bb)
             
             # Upload the data if source is local
+            uploaded = True
             if n_puts > 0:
                 if verbosity == 2: print(f"      --> Uploading data to {n_puts} cloudbatch objects.")
-                [bt.put_batch() for bt in batch if bt.source == 'local']
+                stats.add(bb, 'bytes_out', _nbytes([ff for bt in batch if bt.source == 'local'
+                                                    for ff in bt.files_batch]))
+                try:
+                    with stats.timer(bb, 'put_s'):
+                        [bt.put_batch() for bt in batch if bt.source == 'local']
+                except TransferError as err:
+                    self._transfer_failed(bb, 'put', err)
+                    uploaded = False
                 
             # Delete any downloaded files
-            [bt.delete_tmp_files() for bt in batch]
+            with stats.timer(bb, 'delete_s'):
+                [bt.delete_tmp_files() for bt in batch]
+                
+                for bt in batch:
+                    if self.delete_put_files and bt.source == 'local' and uploaded:
+                        bt.delete_tmp_files( bt.files_batch )
+                    
+            if uploaded:
+                self._finish_batch(bb, batch_out)
+            stats.batch_end(bb, failed = not uploaded)
             
-            for bt in batch:
-                if delete_put_files and bt.source == 'local':
-                    bt.delete_tmp_files( bt.files_batch )
+            yield bb, batch_out
+            
+    def _run_pipelined(self, batch_ids, n_batches, n_gets, n_puts):
+        ''' Pipelined version of the batch cycle. Downloads for the next
+        self.prefetch batches and uploads of previous batches run in a
+        thread pool while func is applied to the current batch. At most
+        prefetch + 1 downloaded batches are staged in get_dir at once. '''
+        
+        batch = self.batch
+        verbosity = self.verbosity
+        prefetch = self.prefetch
+        
+        remote = [bt for bt in batch if bt.source == 'remote']
+        local = [bt for bt in batch if bt.source == 'local']
+        
+        n_workers = prefetch * max(1, n_gets) + max(1, n_puts)
+        pool = ThreadPoolExecutor(max_workers = n_workers)
+        
+        get_futures = {}
+        get_tickets = {}
+        put_futures = deque()
+        
+        # batch_ids may be a generator (when leasing), so only take ids from
+        # it as they are staged
+        ids = iter(batch_ids)
+        staged = deque()
+        
+        try:
+            while True:
+                # Keep up to prefetch batches staged ahead of the current one
+                while len(staged) <= prefetch:
+                    get_id = next(ids, None)
+                    if get_id is None:
+                        break
+                    if verbosity >= 2 and n_gets > 0:
+                        print(f"      --> Staging batch {get_id + 1} from {n_gets} cloudbatch objects.")
+                    get_tickets[get_id] = [bt._staging_ticket() for bt in remote]
+                    get_futures[get_id] = [pool.submit(self._timed_get, bt, get_id, bt.batch_files(get_id), ticket) 
+                                           for bt, ticket in zip(remote, get_tickets[get_id])]
+                    staged.append(get_id)
+                    
+                if len(staged) == 0:
+                    break
+                bb = staged.popleft()
+                self._print_progress(bb, n_batches)
+                self._start_batch(bb)
+                
+                [bt.goto_batch(bb) for bt in batch]
+                
+                # Wait for this batch to finish downloading
+                try:
+                    with self.stats.timer(bb, 'get_wait_s'):
+                        for bt, fut in zip(remote, get_futures[bb]):
+                            bt.tmp_files = bt.tmp_files + fut.result()
+                except TransferError as err:
+                    # Get rid of anything else that arrived for this batch
+                    for bt, fut in zip(remote, get_futures.pop(bb)):
+                        if fut.exception() is None:
+                            bt.delete_tmp_files(fut.result())
+                        bt.tmp_files = []
+                    self._transfer_failed(bb, 'get', err)
+                    self.stats.batch_end(bb, failed = True)
+                    yield bb, None
+                    continue
+                get_futures.pop(bb)
+                    
+                batch_out = self._apply(self.func, batch, bb)
+                
+                # Delete downloaded files now that func is done with them
+                with self.stats.timer(bb, 'delete_s'):
+                    [bt.delete_tmp_files() for bt in remote]
+                
+                # Upload in the background, bounding the number of pending uploads
+                if n_puts > 0:
+                    if verbosity == 2: print(f"      --> Uploading data to {n_puts} cloudbatch objects.")
+                    futs = [pool.submit(self._put_and_clean, bt, bt.files_batch, bb) for bt in local]
+                    put_futures.append((bb, batch_out, futs))
+                    while len(put_futures) > prefetch:
+                        self._wait_for_put(*put_futures.popleft())
+                else:
+                    self._finish_batch(bb, batch_out)
+                    self.stats.batch_end(bb)
+                
+                yield bb, batch_out
                 
+            # Make sure everything has been uploaded before finishing
+            while len(put_futures) > 0:
+                self._wait_for_put(*put_futures.popleft())
+                
+        finally:
+            for get_id, futs in get_futures.items():
+                for bt, fut, ticket in zip(remote, futs, get_tickets[get_id]):
+                    if fut.cancel() and ticket is not None:
+                        bt.staging.cancel(ticket)
+                    
+            # Free the current batch's staging space before waiting on
+            # downloads that might be queued behind it
+            [bt.delete_tmp_files() for bt in remote]
+                    
+            # Let uploads already in flight finish so they are recorded
+            while len(put_futures) > 0:
+                bb, batch_out, futs = put_futures.popleft()
+                uploaded = all([fut.exception() is None for fut in futs])
+                if uploaded:
+                    self._finish_batch(bb, batch_out)
+                self.stats.batch_end(bb, failed = not uploaded)
+                    
+            # Clean up any batches that were staged but never used, oldest
+            # first so that each frees space for the next
+            for futs in get_futures.values():
+                for bt, fut in zip(remote, futs):
+                    if not fut.cancelled() and fut.exception() is None:
+                        bt.delete_tmp_files(fut.result())
+                        
+            pool.shutdown(wait = True)
+                        
+    def _wait_for_put(self, bb, batch_out, futs):
+        try:
+            [fut.result() for fut in futs]
+        except TransferError as err:
+            self._transfer_failed(bb, 'put', err)
+            self.stats.batch_end(bb, failed = True)
+            return
+        self._finish_batch(bb, batch_out)
+        self.stats.batch_end(bb)
+        
+    def _transfer_failed(self, bb, op, err):
+        ''' Deal with a batch whose files could not be transferred '''
+        if self.on_transfer_error == 'raise':
+            raise err
+        if self.verbosity > 0:
+            print(f"      --> Skipping batch {bb + 1}: {err}")
+        self.failed_batches.append({'batch' : bb, 'op' : op, 'failures' : err.failures})
+        [bt.mark_batch(bb, 'failed') for bt in self.batch]
+        
+    def _finish_batch(self, bb, batch_out):
+        ''' Called once a batch has been applied and uploaded. Files for which
+        func raised are marked as failed in the manifest, and their batch is
+        not checkpointed so that a resumed run does it again. '''
+        failed = self._failed_files(bb)
+        if self.checkpoint is not None and len(failed) == 0:
+            self.checkpoint.record(bb, batch_out)
+        if self.leases is not None:
+            self.leases.done(bb)
+        [bt.mark_batch(bb, failed = failed) for bt in self.batch]
+        
+    def _failed_files(self, bb):
+        ''' Positions in batch bb of the files for which func raised '''
+        return sorted(set([err['file'] for err in self.errors if err['batch'] == bb]))
+            
+    def _tuned_ids(self):
+        ''' Batch indices for batch_size='auto'. The number of batches changes
+        as the run goes, so indices are handed out one at a time. Batches
+        from self._next_batch on have not been started and can be resized. '''
+        bb = 0
+        while bb < self.batch[0].n_batches:
+            self._next_batch = bb + 1
+            yield bb
+            bb += 1
+            
+    def _autotune_step(self, record):
+        ''' Callback that lets the autotuner resize the batches not yet started '''
+        old_size = self._tuner.size
+        new_size = self._tuner.observe(record)
+        if new_size is None:
+            return
+        [bt.resize_remaining(self._next_batch, new_size) for bt in self.batch]
+        self.stats.rebatch(self.batch[0].n_batches)
+        if self.verbosity > 0:
+            print(f"   --> Batch size {old_size} -> {new_size} from batch {self._next_batch + 1}"
+                  f" ({self.batch[0].n_batches} batches)")
+            
+    def _shard_ids(self, n_batches):
+        ''' Batch indices for this worker '''
+        if self.shard is None:
+            return list(range(n_batches))
+        shard_index, num_shards = self.shard
+        return shard_batches(n_batches, shard_index, num_shards)
+            
+    def _check_alignment(self):
+        ''' Raise an AlignmentError if the objects in self.batch don't line up '''
+        pair_files = self.pass_args == 'one'
+        # Downloaded shards only give their members once unpacked, so files
+        # are paired batch by batch then instead (see _check_members())
+        if any([_unpacks_shards(bt) for bt in self.batch]):
+            pair_files = False
+        if self.align == 'check':
+            key = self.align_key if pair_files else None
+            check_alignment(self.batch, same_sizes = pair_files, key = key)
+        elif self.align is not None:
+            # Already joined on the key, so only the batches need checking
+            check_alignment(self.batch, same_sizes = pair_files)
+        else:
+            check_alignment(self.batch, same_sizes = False)
+            
+    def _check_members(self, batch_files):
+        ''' Raise an AlignmentError if shards of the current batch unpacked
+        into a different number of files than the files they are paired with '''
+        if self.align is None or not any([_unpacks_shards(bt) for bt in self.batch]):
+            return
+        sizes = [len(files) for files in batch_files]
+        mismatches = [{'kind' : 'batch_size', 'object' : ii, 'batch' : int(self._batch_index),
+                       'size' : nn, 'expected' : sizes[0]} for ii, nn in enumerate(sizes) if nn != sizes[0]]
+        if len(mismatches) > 0:
+            raise AlignmentError(f"Batch {self._batch_index} has {sizes} files per object once "
+                                 "shards are unpacked.", mismatches)
+            
+    def _checkpoint_header(self):
+        ''' Description of the run, used to make sure a checkpoint belongs
+        to the same set of batches when resuming '''
+        return {'n_batches' : int(self.batch[0].n_batches),
+                'n_files' : [int(bt.n_files) for bt in self.batch],
+                'batch_bounds' : [bt.batch_bounds.tolist() for bt in self.batch],
+                'pass_args' : self.pass_args}
+            
+    def _put_and_clean(self, bt, files, batch_index):
+        self.stats.add(batch_index, 'bytes_out', _nbytes(files))
+        with self.stats.timer(batch_index, 'put_s'):
+            bt._put_files(files)
+        if self.delete_put_files:
+            with self.stats.timer(batch_index, 'delete_s'):
+                bt.delete_tmp_files(files)
+                
+    def _timed_get(self, bt, batch_index, files, ticket = None):
+        ''' bt._get_files(), recording the time taken and bytes downloaded '''
+        with self.stats.timer(batch_index, 'get_s'):
+            got_files = bt._get_files(files, ticket)
+        self.stats.add(batch_index, 'bytes_in', _nbytes(got_files))
+        return got_files
+    
+    def _start_batch(self, batch_index):
+        self.stats.batch_start(batch_index)
+        self.stats.set(batch_index, 'n_files', len(self.batch[0].batch_files(batch_index)))
             
-            # Cycle up batches
-            [bt.next_batch() for bt in batch]
+    def _apply(self, func, batch, batch_index):
         
-        self.output = all_out
-        if verbosity ==1: print('Done! Phew.')
+        self._batch_index = batch_index
+        
+        with self.stats.timer(batch_index, 'apply_s'):
+            if self.pass_args == 'one':
+                if self.verbosity >=2: print(f"      --> Applying function one file at a time.")
+                output = self._apply_one_at_a_time(func, batch)
+            elif self.pass_args == 'all':
+                if self.verbosity >=2: print(f"      --> Applying function to all files in batch.")
+                output = self._apply_all_at_once(func, batch)
+            else:
+                raise Exception("Unrecognised pass option. Choose: pass_args = ['one','all']")
+            
+        # RemoteFile handles fetch their bytes while func reads them
+        handles = [ff for bt in batch if bt.source == 'remote' 
+                   for ff in bt.tmp_files if isinstance(ff, RemoteFile)]
+        if len(handles) > 0:
+            self.stats.add(batch_index, 'bytes_in', _nbytes(handles))
+            
+        return output
+            
+    def _make_pool(self):
+        if self.executor == 'thread':
+            return ThreadPoolExecutor(max_workers = self.max_workers)
+        elif self.executor == 'process':
+            return ProcessPoolExecutor(max_workers = self.max_workers)
+        return None
+            
+    def _print_progress(self, bb, n_batches):
+        if self.verbosity >= 1:
+            print(f"   --> Processing batch: {bb + 1} / {n_batches}")
                  
 
     def _apply_one_at_a_time(self, func, batch):
         ''' Apply a function to files in a list of batches, one file
         at a time '''
         
-        # Get files differently depending on source
         output = []
-            
-        batch_files = []
-        for bb in batch:
-            if bb.source == 'remote':
-                batch_files.append(bb.tmp_files)
-            else:
-                batch_files.append(bb.files_batch)
+        batch_files = self._batch_file_lists(batch)
+        self._check_members(batch_files)
 
         n_files = len(batch_files[0])
         n_args = len(batch)
 
-        for ff in range(n_files):
-            # Make list of input files
-            args = [batch_files[ii][ff] for ii in range(n_args)]
-            output.append( func(*args) )
+        all_args = [[batch_files[ii][ff] for ii in range(n_args)] for ff in range(n_files)]
+        
+        latencies = []
+        if self._pool is None:
+            for args in all_args:
+                out, seconds = _timed_call(func, *args)
+                output.append( out )
+                latencies.append( seconds )
+            self.stats.add_latencies(self._batch_index, latencies)
+            return output
+        
+        # Fan out over the pool. Collecting futures in order keeps the
+        # output in the same order as the files. Only errors raised by func
+        # come back as results. Anything else, such as func not pickling or
+        # a broken process pool, is raised here and stops the run.
+        futures = [self._pool.submit(_guarded_call, func, *args) for args in all_args]
+        try:
+            for ff, fut in enumerate(futures):
+                out, seconds, err = fut.result()
+                if err is not None:
+                    self.errors.append({'batch' : self._batch_index, 
+                                        'file' : ff, 
+                                        'args' : all_args[ff],
+                                        'error' : err})
+                    output.append(None)
+                    continue
+                output.append( out )
+                latencies.append( seconds )
+        except BaseException:
+            [fut.cancel() for fut in futures]
+            raise
+        self.stats.add_latencies(self._batch_index, latencies)
 
         return output
 
     def _apply_all_at_once(self, func, batch):
-        raise NotImplemented(" For future development . . . ")
\ No newline at end of file
+        ''' Apply a function to all files in a batch at once. func is passed
+        one list of files per cloudbatch object. '''
+        
+        batch_files = self._batch_file_lists(batch)
+        output, seconds = _timed_call(func, *batch_files)
+        
+        # Only the whole batch can be timed, so share it between the files
+        n_files = len(batch_files[0])
+        self.stats.add_latencies(self._batch_index, [seconds / max(1, n_files)] * n_files)
+        
+        if self.split_output is None:
+            return output
+        
+        output = list(self.split_output(output))
+        if len(output) != n_files:
+            raise Exception(f"split_output returned {len(output)} elements for a batch of {n_files} files.")
+        
+        return output
+    
+    def _batch_file_lists(self, batch):
+        ''' Get the list of current batch files for each object. Downloaded
+        files are used for remote objects. '''
+        
+        batch_files = []
+        for bb in batch:
+            if bb.source == 'remote':
+                batch_files.append(list(bb.tmp_files))
+            else:
+                batch_files.append(list(bb.files_batch))
+                
+        return batch_files
+
+def _timed_call(func, *args):
+    ''' Call func, returning its output and the seconds it took. Module level
+    so it can be sent to a process pool. '''
+    t0 = time.perf_counter()
+    out = func(*args)
+    return out, time.perf_counter() - t0
+
+def _guarded_call(func, *args):
+    ''' _timed_call() for pool workers. Returns (output, seconds, error),
+    where error is the exception raised by func, if any, so that it can be
+    told apart from failures of the pool itself. '''
+    try:
+        out, seconds = _timed_call(func, *args)
+    except Exception as err:
+        return None, None, err
+    return out, seconds, None
+
+def _unpacks_shards(bt):
+    ''' Whether bt downloads shards and gives their members as tmp_files '''
+    return bt.source == 'remote' and getattr(bt, '_unpacked', None) is not None
+
+def _nbytes(files):
+    ''' Bytes moved for files. RemoteFile handles count what they have
+    fetched so far. '''
+    return sum([ff.bytes_fetched if isinstance(ff, RemoteFile) else member_size(ff) 
+                for ff in files])
+
+def iter_apply(func, batch, **kwargs):
+    ''' Generator form of apply_batch_func. 
+    
+    Takes the same arguments as apply_batch_func, but yields 
+    (batch_index, output) for each batch as soon as it has been processed
+    instead of collecting every output in memory. Downloaded files are 
+    deleted before each batch is yielded. Batches restored from a checkpoint
+    come first when resuming.
+    
+    Example
+    
+        for bb, out in iter_apply(func, [gsb_get, gsb_put], prefetch=2):
+            save(out)
+    '''
+    return iter(apply_batch_func(func, batch, lazy = True, **kwargs))
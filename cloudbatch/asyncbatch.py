@@ -0,0 +1,388 @@
+import asyncio
+import functools
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .gsbatch import GSBatch
+from .backends import GSUtilBackend
+from .retry import RetryPolicy, TransferError
+from .apply_batch_func import apply_batch_func, _nbytes
+from .sinks import MemorySink
+
+# Limit on transfers in flight across every AsyncGSBatch object. One
+# semaphore is made per event loop as asyncio primitives are tied to a loop.
+_max_concurrency = 64
+_semaphores = weakref.WeakKeyDictionary()
+_transfer_pool = None
+
+# Per-object transfers make one try per call and are retried by
+# AsyncGSBatch._aretry()
+_one_attempt = RetryPolicy(max_attempts = 1)
+
+def set_max_concurrency(max_concurrency):
+    ''' Set the global number of object transfers allowed in flight at once.
+    Takes effect for event loops that have not made any transfers yet. '''
+    global _max_concurrency, _transfer_pool
+    _max_concurrency = max_concurrency
+    if _transfer_pool is not None:
+        _transfer_pool.shutdown(wait = False)
+        _transfer_pool = None
+
+def _semaphore():
+    loop = asyncio.get_event_loop()
+    if loop not in _semaphores:
+        _semaphores[loop] = asyncio.Semaphore(_max_concurrency)
+    return _semaphores[loop]
+
+def _pool():
+    global _transfer_pool
+    if _transfer_pool is None:
+        _transfer_pool = ThreadPoolExecutor(max_workers = _max_concurrency)
+    return _transfer_pool
+
+class AsyncGSBatch(GSBatch):
+
+    '''
+    Version of GSBatch where get_batch() and put_batch() are coroutines.
+
+    Each object is transferred by its own coroutine, and every transfer made
+    by any AsyncGSBatch waits on one global semaphore (see
+    set_max_concurrency()), so thousands of small objects can be in flight
+    across batches and objects with a bounded amount of work running. With
+    in-process backends ('gcs', 'local') the transfers share one thread pool
+    of the same size. gsutil already parallelises inside one process, so
+    with GSUtilBackend a whole batch is one transfer.
+
+    Failed objects are retried by their coroutine, which sleeps through the
+    backoff without holding a slot of the semaphore, so other transfers go
+    ahead while it waits.
+
+    Takes the same arguments as GSBatch.
+
+    Example
+
+        gsb = AsyncGSBatch(files = file_list, get_dir = '/tmp/data', backend = 'gcs')
+        await gsb.get_batch()
+    '''
+
+    async def get_batch(self):
+        got_files = await self._aget_files(self.files_batch)
+        self.tmp_files = self.tmp_files + got_files
+
+    async def put_batch(self, sync = None):
+        await self._aput_files(self.files_batch, sync)
+
+    async def _aget_files(self, files, ticket = None):
+        ''' Coroutine version of _get_files() '''
+
+        if getattr(self, 'materialize', 'copy') == 'lazy':
+            # Only opens handles, nothing is downloaded
+            return self._get_files(files, ticket)
+        if getattr(self, 'cache', None) is not None or self._batched_backend():
+            return await _transfer(self._get_files, files, ticket)
+
+        # Reserve staging space for the whole batch up front, outside the
+        # transfer semaphore as it may wait for a while
+        staging = getattr(self, 'staging', None)
+        if staging is not None:
+            try:
+                sizes = self._staging_sizes(files)
+            except BaseException:
+                if ticket is not None:
+                    staging.cancel(ticket)
+                raise
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(None, staging.reserve, sizes, ticket)
+
+        # Each object is retried on its own
+        targets = self.backend._local_targets(files, self.get_dir)
+        got = await asyncio.gather(*[self._aretry(self._fetch_attempt, [ff], 'get') for ff in files],
+                                   return_exceptions = True)
+        if staging is not None and any([isinstance(gg, BaseException) for gg in got]):
+            staging.release(list(sizes))
+        _raise_any(got, lambda ok: self.delete_tmp_files([tt for tt, gg in zip(targets, got)
+                                                          if not isinstance(gg, BaseException)]))
+
+        return self._unpack(targets)
+
+    async def _aput_files(self, files, sync = None):
+        ''' Coroutine version of _put_files() '''
+
+        # A bundle is one shard for the whole batch
+        if self._batched_backend() or getattr(self, 'bundle', False):
+            await _transfer(self._put_files, files, sync)
+            return
+
+        if sync is None:
+            sync = getattr(self, 'sync', False)
+        if sync:
+            files = await _transfer(self._unsynced, files)
+
+        done = await asyncio.gather(*[self._aretry(self._push, [ff], 'put') for ff in files],
+                                    return_exceptions = True)
+        _raise_any(done)
+
+    async def _aretry(self, attempt, files, op):
+        ''' Transfer files by calling attempt(files, retry) through
+        _transfer(), one try per call, retrying only the files that failed.
+        attempt returns the failures as a list of (file, attempts, error).
+        The backoff is slept here rather than in a transfer thread so that
+        it doesn't hold a slot of the semaphore. '''
+
+        policy = self._retry_policy()
+        remaining = list(files)
+        for n in range(policy.max_attempts):
+            if n > 0:
+                await asyncio.sleep(policy.delay(n - 1))
+            failed = await _transfer(attempt, remaining, _one_attempt)
+            remaining = [ff for ff, attempts, error in failed]
+            if len(remaining) == 0:
+                return
+
+        self._raise_failures([(ff, policy.max_attempts, error) for ff, attempts, error in failed], op)
+
+    def _fetch_attempt(self, files, retry):
+        return self._fetch(files, self.get_dir, retry)[1]
+
+    def _batched_backend(self):
+        return isinstance(self.backend, GSUtilBackend)
+
+def _raise_any(results, cleanup = None):
+    ''' Raise if any of the results from asyncio.gather() is an exception,
+    merging TransferErrors into one. cleanup is called with the successful
+    results first. '''
+
+    errors = [rr for rr in results if isinstance(rr, BaseException)]
+    if len(errors) == 0:
+        return
+
+    if cleanup is not None:
+        cleanup([rr for rr in results if not isinstance(rr, BaseException)])
+
+    if all([isinstance(ee, TransferError) for ee in errors]):
+        failures = [ff for ee in errors for ff in ee.failures]
+        raise TransferError(f"Failed to transfer {len(failures)} files after retrying.", failures)
+    raise errors[0]
+
+async def _transfer(func, *args):
+    async with _semaphore():
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(_pool(), func, *args)
+
+async def async_apply_batch_func(func, batch,
+                                 verbosity = 0,
+                                 pass_args = "one",
+                                 delete_put_files = False,
+                                 prefetch = 1,
+                                 executor = None,
+                                 max_workers = None,
+                                 split_output = None,
+                                 progress = True,
+                                 callbacks = None,
+                                 sink = None,
+                                 align = 'check',
+                                 align_key = None,
+                                 checkpoint = None,
+                                 resume = False,
+                                 on_transfer_error = 'raise',
+                                 shard = None,
+                                 lease_dir = None,
+                                 lease_ttl = 600):
+    '''
+    Coroutine version of apply_batch_func.
+
+    Downloads for the next prefetch batches and uploads of finished batches
+    run as coroutines while func is applied to the current batch in an
+    executor, so I/O overlaps with compute without blocking the event loop.
+    AsyncGSBatch objects transfer through their async methods; any other
+    CloudBatch is transferred in a thread.
+
+    Takes the same arguments as apply_batch_func, including checkpoint,
+    resume, on_transfer_error, shard and lease_dir. Returns a list of
+    outputs, one per batch, or sink.result() if a sink is given. Per-batch
+    stats are passed to callbacks as each batch's uploads finish.
+
+    Example
+
+        out = await async_apply_batch_func(func, [gsb_get, gsb_put], prefetch=2)
+    '''
+
+    if type(batch) is not list:
+        batch = [batch]
+
+    # Reuse apply_batch_func for argument handling and applying func
+    app = apply_batch_func(func, batch,
+                           verbosity = verbosity,
+                           pass_args = pass_args,
+                           executor = executor,
+                           max_workers = max_workers,
+                           split_output = split_output,
+                           lazy = True,
+                           progress = progress,
+                           callbacks = callbacks,
+                           sink = sink,
+                           align = align,
+                           align_key = align_key,
+                           checkpoint = checkpoint,
+                           resume = resume,
+                           on_transfer_error = on_transfer_error,
+                           shard = shard,
+                           lease_dir = lease_dir,
+                           lease_ttl = lease_ttl)
+    sink = app.sink if app.sink is not None else MemorySink()
+    if app._tuner is not None:
+        app._tuner.prefetch = prefetch
+
+    [bb.reset_batch() for bb in batch]
+
+    app._check_alignment()
+
+    n_batches = batch[0].n_batches
+    remote = [bt for bt in batch if bt.source == 'remote']
+    local = [bt for bt in batch if bt.source == 'local']
+
+    if len(remote) == 0 and len(local) == 0:
+        raise Exception(" You are not getting or putting any data so why use cloudbatch? ")
+
+    loop = asyncio.get_event_loop()
+    stats = app.stats
+    app._pool = app._make_pool()
+    compute_pool = ThreadPoolExecutor(max_workers = 1)
+
+    get_tasks = {}
+    put_tasks = []
+
+    sink.open()
+    try:
+        # Batches restored from a checkpoint go straight to the sink
+        done, batch_ids, n_own = app._plan(n_batches)
+        for bb in sorted(done):
+            sink.write(bb, done[bb])
+
+        stats.run_start(n_own)
+
+        # Batch indices come one at a time, as claiming a lease or waiting
+        # for one to expire blocks, and batch_size='auto' changes the number
+        # of batches as the run goes
+        ids = iter(batch_ids)
+        staged = deque()
+        while True:
+            # Keep up to prefetch batches staged ahead of the current one
+            while len(staged) <= prefetch:
+                get_id = await loop.run_in_executor(None, next, ids, None)
+                if get_id is None:
+                    break
+                get_tasks[get_id] = [asyncio.ensure_future(_aget(stats, get_id, bt, bt.batch_files(get_id),
+                                                                 bt._staging_ticket()))
+                                     for bt in remote]
+                staged.append(get_id)
+
+            if len(staged) == 0:
+                break
+            bb = staged.popleft()
+            app._print_progress(bb, batch[0].n_batches)
+            app._start_batch(bb)
+
+            [bt.goto_batch(bb) for bt in batch]
+            with stats.timer(bb, 'get_wait_s'):
+                got_all = await asyncio.gather(*get_tasks[bb], return_exceptions = True)
+            get_tasks.pop(bb)
+            try:
+                _raise_any(got_all, lambda ok: [bt.delete_tmp_files(got) for bt, got in zip(remote, got_all)
+                                                if type(got) is list])
+            except TransferError as err:
+                app._transfer_failed(bb, 'get', err)
+                stats.batch_end(bb, failed = True)
+                sink.write(bb, None)
+                continue
+            for bt, got in zip(remote, got_all):
+                bt.tmp_files = bt.tmp_files + got
+
+            batch_out = await loop.run_in_executor(compute_pool, app._apply, func, batch, bb)
+
+            with stats.timer(bb, 'delete_s'):
+                [bt.delete_tmp_files() for bt in remote]
+
+            put_tasks.append(asyncio.ensure_future(_aput_batch(stats, bb, [(bt, bt.files_batch) for bt in local],
+                                                              delete_put_files,
+                                                              functools.partial(_finish, app, sink, bb, batch_out),
+                                                              functools.partial(_put_failed, app, sink, bb))))
+            while len(put_tasks) > prefetch:
+                await put_tasks.pop(0)
+
+        while len(put_tasks) > 0:
+            await put_tasks.pop(0)
+
+    finally:
+        # Let uploads already in flight finish so they are recorded
+        await asyncio.gather(*put_tasks, return_exceptions = True)
+
+        # Transfers already running can't be stopped, so wait for any
+        # staged batches and remove their files. The current batch goes
+        # first as staged batches may be waiting for its space.
+        [bt.delete_tmp_files() for bt in remote]
+        for tasks in get_tasks.values():
+            results = await asyncio.gather(*tasks, return_exceptions = True)
+            for bt, got in zip(remote, results):
+                if type(got) is list:
+                    bt.delete_tmp_files(got)
+        compute_pool.shutdown(wait = True)
+        if app._pool is not None:
+            app._pool.shutdown(wait = True)
+        [bt.delete_tmp_files() for bt in remote]
+        stats.run_end()
+        sink.close()
+
+    app.output = sink.result()
+    if verbosity ==1: print('Done! Phew.')
+
+    return app.output
+
+def _finish(app, sink, batch_index, batch_out):
+    ''' A batch is only written to the sink once its uploads are done '''
+    app._finish_batch(batch_index, batch_out)
+    sink.write(batch_index, batch_out)
+
+def _put_failed(app, sink, batch_index, err):
+    app._transfer_failed(batch_index, 'put', err)
+    sink.write(batch_index, None)
+
+async def _aget(stats, batch_index, bt, files, ticket = None):
+    with stats.timer(batch_index, 'get_s'):
+        if isinstance(bt, AsyncGSBatch):
+            got = await bt._aget_files(files, ticket)
+        else:
+            got = await _transfer(bt._get_files, files, ticket)
+    stats.add(batch_index, 'bytes_in', _nbytes(got))
+    return got
+
+async def _aput_batch(stats, batch_index, uploads, delete_put_files, finish = None, failed = None):
+    ''' Upload one batch, given as (object, files) pairs, then call finish()
+    and close its stats record. If the upload fails with a TransferError and
+    failed is given, failed(err) is called instead of raising. '''
+    try:
+        with stats.timer(batch_index, 'put_s'):
+            await asyncio.gather(*[_aput(stats, batch_index, bt, files, delete_put_files)
+                                   for bt, files in uploads])
+    except TransferError as err:
+        stats.batch_end(batch_index, failed = True)
+        if failed is None:
+            raise
+        failed(err)
+        return
+    except BaseException:
+        stats.batch_end(batch_index, failed = True)
+        raise
+    if finish is not None:
+        finish()
+    stats.batch_end(batch_index)
+
+async def _aput(stats, batch_index, bt, files, delete_put_files):
+    stats.add(batch_index, 'bytes_out', _nbytes(files))
+    if isinstance(bt, AsyncGSBatch):
+        await bt._aput_files(files)
+    else:
+        await _transfer(bt._put_files, files)
+    if delete_put_files:
+        with stats.timer(batch_index, 'delete_s'):
+            bt.delete_tmp_files(files)
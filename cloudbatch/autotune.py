@@ -0,0 +1,168 @@
+import numpy as np
+
+class BatchAutotuner():
+    '''
+    Picks the batch size while a job runs. Used by CloudBatch objects made
+    with batch_size='auto'.
+
+    After every batch apply_batch_func passes the batch's stats record (see
+    metrics.BatchStats) to observe(). Transfer time per batch (get_s + put_s)
+    is fitted as a fixed overhead, such as starting gsutil, plus a cost per
+    file. The func cost per file comes from apply_s. Larger batches spread the
+    overhead over more files, so the expected files per second always grows
+    with batch size, but by less and less while scratch space and the work
+    lost on failure keep growing. The tuner picks the smallest batch size
+    that gets within overhead_fraction of the best possible rate, allowing for
+    downloads overlapping func when prefetch > 0. It then keeps that size
+    inside [min_size, max_size] and under max_bytes of staged data.
+
+    Until two different batch sizes have been seen, the size is doubled to
+    measure the overhead. After a change nothing more is changed until a
+    batch of the new size has finished, and the size only changes when the
+    new size differs by more than the tolerance, so batches staged ahead and
+    measurement noise do not make it jitter.
+
+    INPUTS
+        min_size (int)            :: Smallest batch size. [ Default = 1 ]
+        max_size (int)            :: Largest batch size. [ Default = 1000 ]
+        initial_size (int)        :: Size of the first batches. If None, 10
+                                     clipped to the bounds. [ Default = None ]
+        overhead_fraction (float) :: Acceptable shortfall from the best rate.
+                                     [ Default = 0.1 ]
+        max_bytes (int)           :: Cap on the bytes of all batches staged at
+                                     once (prefetch + 1 of them). [ Default = None ]
+        warmup (int)              :: Number of first batches to ignore, as they
+                                     include start up costs. [ Default = 1 ]
+        window (int)              :: Number of recent batches to fit. [ Default = 20 ]
+        tolerance (float)         :: Relative change needed to resize. [ Default = 0.2 ]
+
+    ATTRIBUTES
+        history (list)  :: One dictionary per change, with keys 'batch',
+                           'old_size', 'new_size', 'overhead_s', 'transfer_s',
+                           'apply_s' and 'files_per_s' (the expected rate).
+    '''
+
+    def __init__(self, min_size = 1, max_size = 1000, initial_size = None,
+                 overhead_fraction = 0.1, max_bytes = None, warmup = 1,
+                 window = 20, tolerance = 0.2):
+
+        if min_size < 1 or max_size < min_size:
+            raise Exception("Need 1 <= min_size <= max_size.")
+
+        self.min_size = int(min_size)
+        self.max_size = int(max_size)
+        if initial_size is None:
+            initial_size = 10
+        self.initial_size = self._clip(initial_size)
+        self.overhead_fraction = overhead_fraction
+        self.max_bytes = max_bytes
+        self.warmup = warmup
+        self.window = window
+        self.tolerance = tolerance
+        self.prefetch = 0
+        self.size = self.initial_size
+        self.history = []
+        self._seen = 0
+        self._obs = []
+
+    def observe(self, record):
+        ''' Take the stats record of a finished batch. Returns the new batch
+        size if it should change, otherwise None. '''
+
+        self._seen += 1
+        if record['failed'] or record['n_files'] == 0 or self._seen <= self.warmup:
+            return None
+
+        self._obs.append((record['n_files'], record['get_s'] + record['put_s'],
+                          record['apply_s'], record['bytes_in']))
+        self._obs = self._obs[-self.window:]
+
+        n_files = np.array([oo[0] for oo in self._obs], dtype=float)
+        if len(self.history) > 0 and self.size not in n_files:
+            # Batches staged before the last change are still arriving
+            return None
+        if len(np.unique(n_files)) < 2:
+            # Need a second size to separate overhead from per-file cost
+            new_size = self._clip(self.size * 2)
+            if new_size == self.size:
+                new_size = self._clip(self.size // 2)
+            return self._change(record['batch'], new_size, {})
+
+        overhead, transfer, apply = self._fit()
+        new_size = self._best_size(overhead, transfer, apply)
+
+        if abs(new_size - self.size) <= self.tolerance * self.size:
+            return None
+        return self._change(record['batch'], new_size,
+                            {'overhead_s' : overhead,
+                             'transfer_s' : transfer,
+                             'apply_s' : apply,
+                             'files_per_s' : self._rate(new_size, overhead, transfer, apply)})
+
+    def _fit(self):
+        ''' Overhead per batch and seconds per file for transfers, and seconds
+        per file for func '''
+
+        obs = np.array([oo[:3] for oo in self._obs], dtype=float)
+        n_files, transfer_s, apply_s = obs.T
+
+        transfer, overhead = np.polyfit(n_files, transfer_s, 1)
+        if transfer < 0:
+            # Noise swamped the per-file cost. Treat it all as per-file.
+            transfer, overhead = np.sum(transfer_s) / np.sum(n_files), 0
+        overhead = max(0.0, overhead)
+        apply = np.sum(apply_s) / np.sum(n_files)
+
+        return float(overhead), float(transfer), float(apply)
+
+    def _rate(self, size, overhead, transfer, apply):
+        ''' Expected files per second for a batch size '''
+        if self.prefetch > 0:
+            # Transfers overlap func for the neighbouring batches
+            seconds = max(overhead + transfer * size, apply * size)
+        else:
+            seconds = overhead + (transfer + apply) * size
+        return size / seconds if seconds > 0 else np.inf
+
+    def _best_size(self, overhead, transfer, apply):
+        ''' Smallest size within overhead_fraction of the best rate '''
+
+        upper = self._size_cap()
+        best = self._rate(upper, overhead, transfer, apply)
+        if overhead == 0 or not np.isfinite(best):
+            return self.min_size
+        target = (1 - self.overhead_fraction) * best
+
+        # The rate only grows with size, so bisect
+        lo, hi = self.min_size, upper
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._rate(mid, overhead, transfer, apply) >= target:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+
+    def _size_cap(self):
+        upper = self.max_size
+        if self.max_bytes is not None:
+            n_files = sum([oo[0] for oo in self._obs])
+            n_bytes = sum([oo[3] for oo in self._obs])
+            if n_bytes > 0:
+                per_file = n_bytes / n_files
+                upper = min(upper, int(self.max_bytes / ((self.prefetch + 1) * per_file)))
+        return max(self.min_size, upper)
+
+    def _change(self, batch_index, new_size, estimates):
+        new_size = min(new_size, self._size_cap())
+        if new_size == self.size:
+            return None
+        entry = {'batch' : batch_index, 'old_size' : self.size, 'new_size' : new_size,
+                 'overhead_s' : None, 'transfer_s' : None, 'apply_s' : None, 'files_per_s' : None}
+        entry.update(estimates)
+        self.history.append(entry)
+        self.size = new_size
+        return new_size
+
+    def _clip(self, size):
+        return int(min(self.max_size, max(self.min_size, size)))
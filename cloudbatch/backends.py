@@ -0,0 +1,678 @@
+import subprocess
+import os
+import os.path as path
+import glob
+import re
+import shutil
+import csv
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+class TransferBackend():
+    '''
+    Interface for moving files between local disk and a remote store.
+
+    CloudBatch objects do all of their transfers through a backend, so the
+    same batching logic can run against google buckets (GSUtilBackend,
+    GCSBackend) or a plain local directory (LocalBackend).
+
+    METHODS
+        get(remote_paths, local_dir)  :: Copy remote objects into local_dir.
+                                         Returns the expected local paths.
+        put(local_paths, remote_dir)  :: Copy local files into remote_dir.
+                                         Returns the local paths that failed.
+        list(pattern)                 :: List remote paths matching a pattern,
+                                         which may contain wildcards.
+        list_info(pattern)            :: Like list(), but returns a metadata
+                                         dictionary (as from stat()) per object.
+        iter_prefix(prefix)           :: Generator of metadata dictionaries for
+                                         every object whose path starts with
+                                         prefix, streamed page by page.
+        list_level(prefix)            :: (infos, subdirs) for the objects and
+                                         subdirectories directly in the
+                                         directory of prefix whose paths start
+                                         with prefix, from a listing with a /
+                                         delimiter. Subdirectories end in /.
+        stat(path)                    :: Dictionary of object metadata, or None
+                                         if the object does not exist.
+        delete(paths)                 :: Delete remote objects.
+        create_exclusive(path, data)  :: Create an object holding data only if
+                                         it does not already exist. Returns True
+                                         if this call created it.
+        read_range(path, start, length) :: Bytes start to start + length - 1 of
+                                         an object, without fetching the rest.
+    '''
+
+    def get(self, remote_paths, local_dir):
+        error_msg = 'This child of TransferBackend has not implemented this method'
+        raise NotImplementedError(error_msg)
+
+    def put(self, local_paths, remote_dir):
+        error_msg = 'This child of TransferBackend has not implemented this method'
+        raise NotImplementedError(error_msg)
+
+    def list(self, pattern):
+        error_msg = 'This child of TransferBackend has not implemented this method'
+        raise NotImplementedError(error_msg)
+
+    def stat(self, path):
+        error_msg = 'This child of TransferBackend has not implemented this method'
+        raise NotImplementedError(error_msg)
+
+    def delete(self, paths):
+        error_msg = 'This child of TransferBackend has not implemented this method'
+        raise NotImplementedError(error_msg)
+
+    def create_exclusive(self, path, data = b''):
+        error_msg = 'This child of TransferBackend has not implemented this method'
+        raise NotImplementedError(error_msg)
+
+    def read_range(self, path, start, length):
+        error_msg = 'This child of TransferBackend has not implemented this method'
+        raise NotImplementedError(error_msg)
+
+    def list_info(self, pattern):
+        infos = [self.stat(pp) for pp in self.list(pattern)]
+        return [info for info in infos if info is not None]
+
+    def iter_prefix(self, prefix):
+        yield from self.list_info(prefix + '**')
+
+    def list_level(self, prefix):
+        return _split_level(prefix, self.iter_prefix(prefix))
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def _local_targets(self, remote_paths, local_dir):
+        return [path.join(local_dir, path.basename(ff)) for ff in remote_paths]
+
+class GSUtilBackend(TransferBackend):
+    '''
+    Transfers using the gsutil command line tool. File lists are passed to
+    a single `gsutil -m cp -I` call on stdin, so there is one process per
+    transfer rather than one per file and no limit on command length. Which
+    files failed is read from the per-file results gsutil writes with -L.
+
+    INPUTS
+        parallel (bool)  :: Use gsutil -m for parallel copies. [ Default = True ]
+    '''
+
+    def __init__(self, parallel = True):
+        self.parallel = parallel
+
+    def get(self, remote_paths, local_dir):
+        local_paths = self._local_targets(remote_paths, local_dir)
+        failed = set(self._cp(remote_paths, local_dir))
+
+        # Remove anything left at the target of a failed download, e.g. from
+        # an earlier run, so it is not taken for the object
+        for src, dst in zip(remote_paths, local_paths):
+            if src in failed and path.exists(dst):
+                os.remove(dst)
+        return local_paths
+
+    def put(self, local_paths, remote_dir):
+        return self._cp(local_paths, remote_dir)
+
+    def list(self, pattern):
+        result = subprocess.run(['gsutil', 'ls', pattern],
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.DEVNULL)
+        if result.returncode != 0:
+            return []
+        return result.stdout.decode('utf-8').splitlines()
+
+    def list_info(self, pattern):
+        # gsutil expands a trailing * into the contents of every matching
+        # subdirectory too, so list the directory itself, which only lists
+        # that level
+        target = pattern
+        if pattern.endswith('/*') and _wildcard_prefix(pattern) == pattern[:-1]:
+            target = pattern[:-1]
+        regex = _wildcard_regex(pattern)
+
+        result = subprocess.run(['gsutil', 'ls', '-L', target],
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.DEVNULL)
+        if result.returncode != 0:
+            return []
+
+        # Output is one block per object, starting with an unindented
+        # "gs://bucket/name:" line followed by indented fields
+        infos = []
+        name = None
+        block = []
+        for line in result.stdout.decode('utf-8').splitlines() + ['']:
+            if line[:1].strip() != '' or line == '':
+                if name is not None and regex.match(name):
+                    infos.append(self._parse_stat(name, '\n'.join(block)))
+                name = line.rstrip()[:-1] if line.rstrip().endswith(':') else None
+                block = []
+            else:
+                block.append(line)
+        return infos
+
+    def iter_prefix(self, prefix):
+        # gsutil pages through the listing itself. Read its output as it
+        # arrives rather than holding the whole listing in memory.
+        proc = subprocess.Popen(['gsutil', 'ls', '-la', prefix + '**'],
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.DEVNULL,
+                                encoding = 'utf-8')
+        try:
+            for line in proc.stdout:
+                info = self._parse_ls_line(line)
+                if info is not None:
+                    yield info
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                proc.kill()
+            proc.wait()
+
+    def list_level(self, prefix):
+        # Listing a directory without wildcards only lists that level, with
+        # subdirectories on lines of their own
+        base = prefix[:prefix.rfind('/') + 1]
+        result = subprocess.run(['gsutil', 'ls', '-la', base],
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.DEVNULL,
+                                encoding = 'utf-8')
+        if result.returncode != 0:
+            return [], []
+
+        infos = []
+        subdirs = []
+        for line in result.stdout.splitlines():
+            name = line.strip()
+            if name.startswith('gs://') and name.endswith('/'):
+                if name.startswith(prefix) and name != base:
+                    subdirs.append(name)
+                continue
+            info = self._parse_ls_line(line)
+            if info is not None and info['path'].startswith(prefix):
+                infos.append(info)
+        return infos, subdirs
+
+    def stat(self, path):
+        result = subprocess.run(['gsutil', 'stat', path],
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.DEVNULL)
+        if result.returncode != 0:
+            return None
+        return self._parse_stat(path, result.stdout.decode('utf-8'))
+
+    def create_exclusive(self, path, data = b''):
+        # Generation 0 means the upload only succeeds if there is no live object
+        result = subprocess.run(['gsutil', '-h', 'x-goog-if-generation-match:0', 'cp', '-', path],
+                                input = data,
+                                stdout = subprocess.DEVNULL,
+                                stderr = subprocess.DEVNULL)
+        return result.returncode == 0
+
+    def read_range(self, path, start, length):
+        if length <= 0:
+            return b''
+        result = subprocess.run(['gsutil', 'cat', '-r', f'{start}-{start + length - 1}', path],
+                                stdout = subprocess.PIPE,
+                                stderr = subprocess.PIPE)
+        if result.returncode != 0:
+            raise OSError(result.stderr.decode('utf-8', 'replace').strip())
+        return result.stdout
+
+    def delete(self, paths):
+        if len(paths) == 0:
+            return
+        subprocess.run(self._gsutil() + ['rm', '-I'],
+                       input = '\n'.join(paths).encode('utf-8'),
+                       stdout = subprocess.DEVNULL,
+                       stderr = subprocess.STDOUT)
+
+    def _gsutil(self):
+        if self.parallel:
+            return ['gsutil', '-m']
+        return ['gsutil']
+
+    def _cp(self, sources, destination):
+        ''' Copy sources into destination with one gsutil call. Returns the
+        sources that failed. '''
+
+        if len(sources) == 0:
+            return []
+
+        # gsutil reads an existing -L manifest to skip files it already
+        # copied, so give every call a new one
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest = path.join(tmp_dir, 'manifest.csv')
+            result = subprocess.run(self._gsutil() + ['cp', '-L', manifest, '-I', destination],
+                                    input = '\n'.join(sources).encode('utf-8'),
+                                    stdout = subprocess.DEVNULL,
+                                    stderr = subprocess.DEVNULL)
+            if result.returncode == 0:
+                return []
+
+            # One row per source, with Result 'OK' for those that copied
+            copied = set()
+            if path.exists(manifest):
+                with open(manifest, newline = '') as fh:
+                    for row in csv.DictReader(fh):
+                        if row.get('Result') == 'OK':
+                            copied.add(_source_key(row.get('Source', '')))
+
+        return [ss for ss in sources if _source_key(ss) not in copied]
+
+    def _parse_ls_line(self, line):
+        ''' Metadata from a line of `gsutil ls -la` output, or None if the
+        line is not an object '''
+
+        # Lines are "<size>  <time>  gs://bucket/name#<generation>  metageneration=<n>",
+        # then a TOTAL line
+        parts = line.strip().split(None, 2)
+        if len(parts) != 3 or not parts[0].isdigit():
+            return None
+        url = parts[2].rsplit(None, 1)[0] if 'metageneration=' in parts[2] else parts[2]
+        name, _, generation = url.rpartition('#')
+        if name == '':
+            name, generation = url, None
+        return {'path' : name,
+                'size' : int(parts[0]),
+                'mtime' : parts[1],
+                'generation' : generation,
+                'md5' : None,
+                'crc32c' : None}
+
+    def _parse_stat(self, path, text):
+        ''' Pull the useful fields out of `gsutil stat` output '''
+
+        fields = {}
+        for line in text.splitlines():
+            if ':' not in line:
+                continue
+            key, value = line.split(':', 1)
+            fields[key.strip()] = value.strip()
+
+        return {'path' : path,
+                'size' : int(fields.get('Content-Length', 0)),
+                'mtime' : fields.get('Update time'),
+                'generation' : fields.get('Generation'),
+                'md5' : fields.get('Hash (md5)'),
+                'crc32c' : fields.get('Hash (crc32c)')}
+
+class GCSBackend(TransferBackend):
+    '''
+    In-process transfers using the google-cloud-storage client library. A
+    single client is shared by all transfers and its HTTP session is given
+    a connection pool as large as the thread pool, so connections are reused
+    across objects and batches rather than opened per file.
+
+    INPUTS
+        max_workers (int)  :: Number of concurrent transfers. [ Default = 16 ]
+        client             :: An existing google.cloud.storage.Client. If None,
+                              one is created with default credentials.
+    '''
+
+    def __init__(self, max_workers = 16, client = None):
+
+        try:
+            from google.cloud import storage
+        except ImportError:
+            raise ImportError("GCSBackend requires google-cloud-storage. Install it with: pip install google-cloud-storage")
+
+        if client is None:
+            client = storage.Client()
+
+        self.client = client
+        self.max_workers = max_workers
+        self._mount_pool()
+
+    def get(self, remote_paths, local_dir):
+        local_paths = self._local_targets(remote_paths, local_dir)
+        self._map(self._get_one, remote_paths, local_paths)
+        return local_paths
+
+    def put(self, local_paths, remote_dir):
+        remote_paths = [_join_remote(remote_dir, path.basename(ff)) for ff in local_paths]
+        ok = self._map(self._put_one, local_paths, remote_paths)
+        return [ff for ff, success in zip(local_paths, ok) if not success]
+
+    def list(self, pattern):
+        return [info['path'] for info in self.list_info(pattern)]
+
+    def list_info(self, pattern):
+        return list(_walk_pattern(pattern, self.list_level, self.iter_prefix))
+
+    def iter_prefix(self, prefix):
+        bucket, name = _split_gs(prefix)
+        # list_blobs fetches one page at a time as it is iterated
+        for bl in self.client.list_blobs(bucket, prefix = name):
+            yield self._blob_stat(f'gs://{bucket}/{bl.name}', bl)
+
+    def list_level(self, prefix):
+        bucket, name = _split_gs(prefix)
+        blobs = self.client.list_blobs(bucket, prefix = name, delimiter = '/')
+        infos = [self._blob_stat(f'gs://{bucket}/{bl.name}', bl) for bl in blobs]
+        # prefixes is only filled in once the blobs have been iterated
+        subdirs = [f'gs://{bucket}/{pp}' for pp in sorted(blobs.prefixes)]
+        return infos, subdirs
+
+    def stat(self, path):
+        bucket, name = _split_gs(path)
+        blob = self.client.bucket(bucket).get_blob(name)
+        if blob is None:
+            return None
+        return self._blob_stat(path, blob)
+
+    def delete(self, paths):
+        self._map(self._delete_one, paths)
+
+    def create_exclusive(self, path, data = b''):
+        from google.api_core.exceptions import PreconditionFailed
+        bucket, name = _split_gs(path)
+        try:
+            self.client.bucket(bucket).blob(name).upload_from_string(data, if_generation_match = 0)
+        except PreconditionFailed:
+            return False
+        return True
+
+    def read_range(self, path, start, length):
+        if length <= 0:
+            return b''
+        bucket, name = _split_gs(path)
+        # end is inclusive
+        return self.client.bucket(bucket).blob(name).download_as_bytes(start = start, end = start + length - 1)
+
+    def _blob_stat(self, path, blob):
+        return {'path' : path,
+                'size' : blob.size,
+                'mtime' : blob.updated,
+                'generation' : blob.generation,
+                'md5' : blob.md5_hash,
+                'crc32c' : blob.crc32c}
+
+    def _get_one(self, remote_path, local_path):
+        bucket, name = _split_gs(remote_path)
+        try:
+            self.client.bucket(bucket).blob(name).download_to_filename(local_path)
+        except Exception:
+            # Leave the file missing so the caller sees the failure
+            if path.exists(local_path):
+                os.remove(local_path)
+
+    def _put_one(self, local_path, remote_path):
+        bucket, name = _split_gs(remote_path)
+        try:
+            self.client.bucket(bucket).blob(name).upload_from_filename(local_path)
+        except Exception:
+            return False
+        return True
+
+    def _delete_one(self, remote_path):
+        bucket, name = _split_gs(remote_path)
+        self.client.bucket(bucket).blob(name).delete()
+
+    def _map(self, func, *args):
+        with ThreadPoolExecutor(max_workers = self.max_workers) as pool:
+            return list(pool.map(func, *args))
+
+    def _mount_pool(self):
+        try:
+            from requests.adapters import HTTPAdapter
+            adapter = HTTPAdapter(pool_connections = self.max_workers,
+                                  pool_maxsize = self.max_workers)
+            self.client._http.mount('https://', adapter)
+        except Exception:
+            # Fall back on the default pool of the client session
+            pass
+
+class LocalBackend(TransferBackend):
+    '''
+    Treats a local (or mounted) directory as the remote store. Paths may be
+    plain paths or file:// URLs. Useful for running and benchmarking the
+    whole pipeline without network access.
+    '''
+
+    def get(self, remote_paths, local_dir):
+        local_paths = self._local_targets(remote_paths, local_dir)
+        for src, dst in zip(remote_paths, local_paths):
+            try:
+                shutil.copyfile(_strip_file(src), dst)
+            except OSError:
+                pass
+        return local_paths
+
+    def put(self, local_paths, remote_dir):
+        remote_dir = _strip_file(remote_dir)
+        os.makedirs(remote_dir, exist_ok = True)
+        failed = []
+        for ff in local_paths:
+            try:
+                shutil.copyfile(ff, path.join(remote_dir, path.basename(ff)))
+            except OSError:
+                failed.append(ff)
+        return failed
+
+    def list(self, pattern):
+        is_url = pattern.startswith('file://')
+        matches = sorted(glob.glob(_strip_file(pattern)))
+        if is_url:
+            matches = ['file://' + mm for mm in matches]
+        return matches
+
+    def iter_prefix(self, prefix):
+        is_url = prefix.startswith('file://')
+        prefix = _strip_file(prefix)
+        top = prefix if prefix.endswith('/') else path.dirname(prefix)
+
+        for root, dirs, files in os.walk(top or '.'):
+            dirs.sort()
+            for fn in sorted(files):
+                fp = path.join(root, fn) if top else fn
+                if not fp.startswith(prefix):
+                    continue
+                info = self.stat(fp)
+                if info is None:
+                    continue
+                if is_url:
+                    info['path'] = 'file://' + fp
+                yield info
+
+    def list_level(self, prefix):
+        is_url = prefix.startswith('file://')
+        fp = _strip_file(prefix)
+        base = fp[:fp.rfind('/') + 1]
+        try:
+            entries = sorted(os.scandir(base or '.'), key = lambda ee: ee.name)
+        except OSError:
+            return [], []
+
+        infos = []
+        subdirs = []
+        for entry in entries:
+            full = base + entry.name
+            if not full.startswith(fp):
+                continue
+            name = 'file://' + full if is_url else full
+            if entry.is_dir():
+                subdirs.append(name + '/')
+                continue
+            info = self.stat(full)
+            if info is not None:
+                info['path'] = name
+                infos.append(info)
+        return infos, subdirs
+
+    def stat(self, path):
+        try:
+            st = os.stat(_strip_file(path))
+        except OSError:
+            return None
+        return {'path' : path,
+                'size' : st.st_size,
+                'mtime' : st.st_mtime,
+                'generation' : st.st_mtime_ns,
+                'md5' : None,
+                'crc32c' : None}
+
+    def read_range(self, path, start, length):
+        with open(_strip_file(path), 'rb') as fh:
+            fh.seek(start)
+            return fh.read(max(0, length))
+
+    def delete(self, paths):
+        for ff in paths:
+            try:
+                os.remove(_strip_file(ff))
+            except OSError:
+                pass
+
+    def create_exclusive(self, path, data = b''):
+        fp = _strip_file(path)
+        os.makedirs(os.path.dirname(fp) or '.', exist_ok = True)
+        try:
+            fd = os.open(fp, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        return True
+
+def get_backend(backend = None, example_path = None):
+    ''' Return a TransferBackend.
+
+    backend can be a TransferBackend instance, which is returned as is, or
+    one of the names 'gsutil', 'gcs' or 'local'. If backend is None, it is
+    chosen from the scheme of example_path: gs:// paths use gsutil and
+    anything else uses LocalBackend.
+    '''
+
+    if isinstance(backend, TransferBackend):
+        return backend
+
+    if backend is None:
+        if example_path is not None and str(example_path).startswith('gs://'):
+            backend = 'gsutil'
+        else:
+            backend = 'local'
+
+    if backend == 'gsutil':
+        return GSUtilBackend()
+    elif backend == 'gcs':
+        return GCSBackend()
+    elif backend in ['local', 'file']:
+        return LocalBackend()
+    else:
+        raise Exception("Unrecognised backend. Choose: backend = ['gsutil','gcs','local']")
+
+def _strip_file(path):
+    if path.startswith('file://'):
+        return path[len('file://'):]
+    return path
+
+def _split_gs(path):
+    ''' Split gs://bucket/name into (bucket, name) '''
+    if not path.startswith('gs://'):
+        raise Exception(f"Not a google storage path: {path}")
+    bucket, _, name = path[len('gs://'):].partition('/')
+    return bucket, name
+
+def _join_remote(remote_dir, name):
+    return remote_dir.rstrip('/') + '/' + name
+
+def _wildcard_prefix(pattern):
+    ''' Literal part of a pattern before the first wildcard '''
+    match = re.search(r'[*?\[]', pattern)
+    if match is None:
+        return pattern
+    return pattern[:match.start()]
+
+def _walk_pattern(pattern, list_level, iter_prefix):
+    ''' Generator of metadata for the objects matching a wildcard pattern.
+
+    Like `gsutil ls`, each level of the pattern up to any ** is listed with
+    list_level(), following only the subdirectories that match, so that
+    gs://bucket/dir/*.nc lists dir/ alone rather than everything under it.
+    From a ** on, the rest is listed recursively with iter_prefix(). '''
+
+    regex = _wildcard_regex(pattern)
+    prefix = _wildcard_prefix(pattern)
+    if prefix == pattern:
+        # No wildcards
+        for info in iter_prefix(pattern):
+            if regex.match(info['path']):
+                yield info
+        return
+
+    dirs = [prefix[:prefix.rfind('/') + 1]]
+    segments = pattern[len(dirs[0]):].split('/')
+    for depth, segment in enumerate(segments):
+        literal = _wildcard_prefix(segment)
+        if '**' in segment:
+            for dd in dirs:
+                for info in iter_prefix(dd + literal):
+                    if regex.match(info['path']):
+                        yield info
+            return
+
+        last = depth == len(segments) - 1
+        if literal == segment and not last:
+            dirs = [dd + segment + '/' for dd in dirs]
+            continue
+
+        seg_regex = _wildcard_regex(segment)
+        next_dirs = []
+        for dd in dirs:
+            infos, subdirs = list_level(dd + literal)
+            if last:
+                for info in infos:
+                    if regex.match(info['path']):
+                        yield info
+            else:
+                next_dirs = next_dirs + [ss for ss in subdirs if seg_regex.match(ss[len(dd):-1])]
+        dirs = next_dirs
+
+def _source_key(source):
+    ''' Form of a gsutil source that matches how its -L manifest lists it '''
+    if source.startswith('gs://'):
+        return source
+    return path.abspath(_strip_file(source))
+
+def _split_level(prefix, infos):
+    ''' (infos, subdirs) for one directory level, from a recursive listing
+    of everything under prefix '''
+
+    base = prefix[:prefix.rfind('/') + 1]
+    objects = []
+    subdirs = {}
+    for info in infos:
+        name = info['path']
+        if not name.startswith(prefix):
+            continue
+        rest = name[len(base):]
+        if '/' in rest:
+            subdirs[base + rest.split('/', 1)[0] + '/'] = True
+        else:
+            objects.append(info)
+    return objects, list(subdirs)
+
+def _wildcard_regex(pattern):
+    ''' Compile a gsutil style wildcard. * and ? do not match across /
+    but ** does. '''
+
+    out = ''
+    ii = 0
+    while ii < len(pattern):
+        cc = pattern[ii]
+        if pattern[ii:ii+2] == '**':
+            out += '.*'
+            ii += 2
+            continue
+        if cc == '*':
+            out += '[^/]*'
+        elif cc == '?':
+            out += '[^/]'
+        else:
+            out += re.escape(cc)
+        ii += 1
+
+    return re.compile(out + '$')
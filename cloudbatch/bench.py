@@ -0,0 +1,316 @@
+'''
+Benchmarks for the batching and transfer pipeline.
+
+Everything runs offline against a fake bucket, which is a local directory
+read through LocalBackend, optionally with simulated network latency and
+bandwidth. Each case downloads every file in batches, applies a function
+that reads the file and writes a small output, and uploads the outputs.
+
+Run from the command line, e.g.
+
+    python -m cloudbatch.bench --n-files 500 --mean-bytes 1e6 \
+        --batch-sizes 10 50 --prefetch 0 2 --workers 1 4 --output bench.json
+
+and compare the JSON written by different versions.
+'''
+
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import os.path as path
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from .gsbatch import GSBatch
+from .backends import LocalBackend
+from .apply_batch_func import apply_batch_func
+from .filemaker import file_list_from_components, ComponentFileList
+
+class SimulatedBackend(LocalBackend):
+    '''
+    LocalBackend with a fixed cost per call and per object, and a bandwidth
+    limit, to stand in for a remote store.
+
+    INPUTS
+        call_latency (float)    :: Seconds added to every get/put call.
+        object_latency (float)  :: Seconds added per object transferred.
+        bandwidth (float)       :: Bytes per second. None for no limit.
+    '''
+
+    def __init__(self, call_latency = 0, object_latency = 0, bandwidth = None):
+        self.call_latency = call_latency
+        self.object_latency = object_latency
+        self.bandwidth = bandwidth
+
+    def get(self, remote_paths, local_dir):
+        local_paths = super().get(remote_paths, local_dir)
+        self._wait(local_paths)
+        return local_paths
+
+    def put(self, local_paths, remote_dir):
+        failed = super().put(local_paths, remote_dir)
+        self._wait(local_paths)
+        return failed
+
+    def _wait(self, files):
+        delay = self.call_latency + self.object_latency * len(files)
+        if self.bandwidth is not None:
+            nbytes = sum([path.getsize(ff) for ff in files if path.isfile(ff)])
+            delay += nbytes / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+def make_dataset(bucket_dir, n_files, mean_bytes = 1e6, size_dist = 'fixed', seed = 0):
+    ''' Write n_files files of random bytes into bucket_dir.
+
+    size_dist is 'fixed' (every file is mean_bytes), 'uniform' (between 0
+    and 2 * mean_bytes) or 'lognormal' (mean of mean_bytes with a long tail).
+    Returns the list of file names. '''
+
+    rng = np.random.default_rng(seed)
+    if size_dist == 'fixed':
+        sizes = np.full(n_files, mean_bytes)
+    elif size_dist == 'uniform':
+        sizes = rng.uniform(0, 2 * mean_bytes, n_files)
+    elif size_dist == 'lognormal':
+        sigma = 1.0
+        sizes = rng.lognormal(np.log(mean_bytes) - sigma**2 / 2, sigma, n_files)
+    else:
+        raise Exception("Unrecognised size_dist. Choose: size_dist = ['fixed','uniform','lognormal']")
+    sizes = np.maximum(sizes.astype(np.int64), 1)
+
+    os.makedirs(bucket_dir, exist_ok = True)
+    names = [f'file{ii:07d}.dat' for ii in range(n_files)]
+    for name, size in zip(names, sizes):
+        with open(path.join(bucket_dir, name), 'wb') as fh:
+            fh.write(rng.bytes(int(size)))
+
+    return names
+
+def _checksum_func(compute_s):
+    ''' Function applied in the benchmark. Reads the whole input, writes
+    its crc32 to the output file and optionally burns compute_s seconds. '''
+
+    def func(fp_in, fp_out):
+        crc = 0
+        with open(fp_in, 'rb') as fh:
+            while True:
+                chunk = fh.read(1 << 20)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+        if compute_s > 0:
+            end = time.perf_counter() + compute_s
+            while time.perf_counter() < end:
+                pass
+        with open(fp_out, 'w') as fh:
+            fh.write(str(crc))
+        return crc
+
+    return func
+
+def run_case(bucket_dir, names, work_dir, batch_size, prefetch = 0, workers = None,
+             compute_s = 0, call_latency = 0, object_latency = 0, bandwidth = None):
+    ''' Run one get -> apply -> put benchmark and return a dictionary of
+    results. Call through run_case_isolated() to measure peak RSS. '''
+
+    get_dir = path.join(work_dir, 'get')
+    out_dir = path.join(work_dir, 'out')
+    put_dir = path.join(work_dir, 'put')
+    for dn in [get_dir, out_dir, put_dir]:
+        shutil.rmtree(dn, ignore_errors = True)
+        os.makedirs(dn)
+
+    backend = SimulatedBackend(call_latency, object_latency, bandwidth)
+    gsb_get = GSBatch(files = names, file_dir = bucket_dir, get_dir = get_dir,
+                      batch_size = batch_size, backend = backend)
+    gsb_put = GSBatch(files = [path.join(out_dir, nn + '.crc') for nn in names],
+                      put_dir = put_dir, source = 'local',
+                      batch_size = batch_size, backend = backend)
+
+    n_bytes = sum([path.getsize(path.join(bucket_dir, nn)) for nn in names])
+    executor = 'thread' if workers is not None and workers > 1 else None
+
+    latencies = []
+    t_start = time.perf_counter()
+    t_last = t_start
+    app = apply_batch_func(_checksum_func(compute_s), [gsb_get, gsb_put],
+                           prefetch = prefetch, executor = executor,
+                           max_workers = workers, delete_put_files = True,
+                           lazy = True, progress = False)
+    for bb, out in app:
+        t_now = time.perf_counter()
+        latencies.append(t_now - t_last)
+        t_last = t_now
+    elapsed = time.perf_counter() - t_start
+    totals = app.stats.totals()
+
+    return {'batch_size' : batch_size,
+            'prefetch' : prefetch,
+            'workers' : workers,
+            'n_files' : len(names),
+            'n_bytes' : int(n_bytes),
+            'seconds' : elapsed,
+            'files_per_s' : len(names) / elapsed,
+            'mb_per_s' : n_bytes / elapsed / 1e6,
+            'batch_latency_p50' : float(np.percentile(latencies, 50)),
+            'batch_latency_p99' : float(np.percentile(latencies, 99)),
+            'get_s' : totals['get_s'],
+            'get_wait_s' : totals['get_wait_s'],
+            'apply_s' : totals['apply_s'],
+            'put_s' : totals['put_s'],
+            'delete_s' : totals['delete_s'],
+            'peak_rss_mb' : _peak_rss_mb()}
+
+def run_case_isolated(*args, **kwargs):
+    ''' Run run_case() in a fresh process so peak RSS belongs to this case
+    only. The process is spawned rather than forked, which would start it
+    with a copy of this one's memory. '''
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers = 1, mp_context = context) as pool:
+        return pool.submit(run_case, *args, **kwargs).result()
+
+def bench_filemaker(n_subcomponents, repeats = 3):
+    ''' Time file_list_from_components for a grid with the given number of
+    values per component, and the time to build a ComponentFileList and
+    take one batch of 100 names from the middle of it. '''
+
+    components = [[f'c{ii}v{jj}' for jj in range(nn)] for ii, nn in enumerate(n_subcomponents)]
+    times = []
+    lazy_times = []
+    for rr in range(repeats):
+        t0 = time.perf_counter()
+        files = file_list_from_components(components, file_ext = 'nc')
+        len(files)
+        times.append(time.perf_counter() - t0)
+        
+        t0 = time.perf_counter()
+        files = ComponentFileList(components, file_ext = 'nc')
+        files[len(files) // 2 : len(files) // 2 + 100]
+        lazy_times.append(time.perf_counter() - t0)
+
+    return {'n_subcomponents' : list(n_subcomponents),
+            'n_files' : int(np.prod(n_subcomponents)),
+            'seconds' : min(times),
+            'lazy_batch_seconds' : min(lazy_times)}
+
+def compare(old, new):
+    ''' Print the change in files/s between two benchmark reports for the
+    cases they have in common '''
+
+    def key(res):
+        return (res['batch_size'], res['prefetch'], res['workers'])
+
+    old_results = {key(res) : res for res in old['results']}
+    print(f"Compared with version {old.get('version')}:")
+    for res in new['results']:
+        if key(res) not in old_results:
+            continue
+        ratio = res['files_per_s'] / old_results[key(res)]['files_per_s']
+        print(f"batch_size={res['batch_size']:<5d} prefetch={res['prefetch']:<2d} "
+              f"workers={res['workers']:<3d} files/s x{ratio:.2f}")
+
+def _peak_rss_mb():
+    ''' Peak RSS of this process. On Linux this is VmHWM, as ru_maxrss
+    carries over the peak of the parent across fork and exec. '''
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1e3
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return rss / 1e6
+    return rss / 1e3
+
+def _version():
+    try:
+        from importlib.metadata import version
+        return version('cloudbatch')
+    except Exception:
+        return 'unknown'
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark the cloudbatch get/apply/put pipeline on a local fake bucket.')
+    parser.add_argument('--n-files', type = int, default = 200)
+    parser.add_argument('--mean-bytes', type = float, default = 1e5)
+    parser.add_argument('--size-dist', default = 'fixed', choices = ['fixed', 'uniform', 'lognormal'])
+    parser.add_argument('--batch-sizes', type = int, nargs = '+', default = [10, 50])
+    parser.add_argument('--prefetch', type = int, nargs = '+', default = [0, 2])
+    parser.add_argument('--workers', type = int, nargs = '+', default = [1])
+    parser.add_argument('--compute-ms', type = float, default = 0, help = 'CPU time burnt per file')
+    parser.add_argument('--call-latency', type = float, default = 0, help = 'Seconds per transfer call')
+    parser.add_argument('--object-latency', type = float, default = 0, help = 'Seconds per object transferred')
+    parser.add_argument('--bandwidth', type = float, default = None, help = 'Simulated bytes per second')
+    parser.add_argument('--filemaker', type = int, nargs = '*', default = None,
+                        help = 'Also time file_list_from_components for a grid of this shape')
+    parser.add_argument('--work-dir', default = None, help = 'Scratch directory. Defaults to a temporary directory')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', default = None, help = 'Write results to this JSON file')
+    parser.add_argument('--compare', default = None, help = 'Earlier results JSON to compare against')
+    args = parser.parse_args(argv)
+
+    work_dir = args.work_dir
+    cleanup = work_dir is None
+    if cleanup:
+        work_dir = tempfile.mkdtemp(prefix = 'cloudbatch_bench_')
+
+    try:
+        bucket_dir = path.join(work_dir, 'bucket')
+        names = make_dataset(bucket_dir, args.n_files, args.mean_bytes, args.size_dist, args.seed)
+
+        results = []
+        for batch_size, prefetch, workers in itertools.product(args.batch_sizes, args.prefetch, args.workers):
+            res = run_case_isolated(bucket_dir, names, path.join(work_dir, 'run'),
+                                    batch_size, prefetch, workers,
+                                    compute_s = args.compute_ms / 1e3,
+                                    call_latency = args.call_latency,
+                                    object_latency = args.object_latency,
+                                    bandwidth = args.bandwidth)
+            results.append(res)
+            print(f"batch_size={batch_size:<5d} prefetch={prefetch:<2d} workers={workers:<3d} "
+                  f"{res['files_per_s']:9.1f} files/s {res['mb_per_s']:8.2f} MB/s "
+                  f"p50={res['batch_latency_p50']:.3f}s p99={res['batch_latency_p99']:.3f}s "
+                  f"rss={res['peak_rss_mb']:.0f}MB "
+                  f"[get {res['get_s']:.2f}s wait {res['get_wait_s']:.2f}s "
+                  f"apply {res['apply_s']:.2f}s put {res['put_s']:.2f}s]")
+
+        report = {'version' : _version(),
+                  'python' : platform.python_version(),
+                  'platform' : platform.platform(),
+                  'args' : vars(args),
+                  'results' : results}
+
+        if args.filemaker:
+            report['filemaker'] = bench_filemaker(args.filemaker)
+            print(f"file_list_from_components {report['filemaker']['n_files']} files: "
+                  f"{report['filemaker']['seconds']:.3f}s, lazy batch "
+                  f"{report['filemaker']['lazy_batch_seconds'] * 1e3:.3f}ms")
+
+        if args.output is not None:
+            with open(args.output, 'w') as fh:
+                json.dump(report, fh, indent = 2)
+                
+        if args.compare is not None:
+            with open(args.compare) as fh:
+                compare(json.load(fh), report)
+
+    finally:
+        if cleanup:
+            shutil.rmtree(work_dir, ignore_errors = True)
+
+    return report
+
+if __name__ == '__main__':
+    main()
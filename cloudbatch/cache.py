@@ -0,0 +1,177 @@
+import os
+import os.path as path
+import shutil
+import sqlite3
+import hashlib
+import threading
+import time
+import uuid
+
+class DiskCache():
+    '''
+    Local content cache for downloaded objects, shared between runs and
+    between batch objects.
+
+    Objects are keyed on their remote path plus generation (or ETag) and
+    size, so a changed object is never served from the cache. The index is
+    a small SQLite database in cache_dir, which makes the cache safe to share
+    between threads and processes. When the total size goes over max_bytes,
+    the least recently used objects are evicted.
+
+    Files are handed out by hard linking them into the destination directory,
+    falling back on a copy if the directories are on different file systems.
+    Either way a handed out file stays valid if its entry is evicted later,
+    e.g. while a staged batch is waiting to be processed.
+
+    INPUTS
+        cache_dir (str)   :: Directory to keep cached objects and the index.
+        max_bytes (int)   :: Size cap of the cache in bytes. None means no
+                             cap. [ Default = None ]
+
+    ATTRIBUTES
+        hits, misses (int)          :: Lookups made through this object.
+        hit_bytes, miss_bytes (int) :: Bytes served from cache / downloaded.
+    '''
+
+    def __init__(self, cache_dir, max_bytes = None):
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.object_dir = path.join(cache_dir, 'objects')
+        self.incoming_dir = path.join(cache_dir, 'incoming')
+        self.index_path = path.join(cache_dir, 'index.sqlite')
+
+        os.makedirs(self.object_dir, exist_ok = True)
+        os.makedirs(self.incoming_dir, exist_ok = True)
+
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        self._lock = threading.Lock()
+
+        with self._connect() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS entries (
+                               key TEXT PRIMARY KEY,
+                               remote TEXT,
+                               size INTEGER,
+                               last_used REAL)''')
+
+    def key(self, remote_path, version = None, size = None):
+        ''' Cache key for a remote object. version should be the generation
+        or ETag of the object. '''
+        ident = f'{remote_path}\n{version}\n{size}'
+        return hashlib.sha1(ident.encode('utf-8')).hexdigest()
+
+    def lookup(self, key):
+        ''' Return the cached path for key, or None. Marks the entry as used. '''
+
+        fn = self._object_path(key)
+        with self._connect() as con:
+            row = con.execute('SELECT size FROM entries WHERE key=?', (key,)).fetchone()
+            if row is None or not path.isfile(fn):
+                return None
+            con.execute('UPDATE entries SET last_used=? WHERE key=?', (time.time(), key))
+        return fn
+
+    def add(self, key, remote_path, local_path):
+        ''' Move a downloaded file into the cache and return its cached path. '''
+
+        fn = self._object_path(key)
+        os.makedirs(path.dirname(fn), exist_ok = True)
+        size = path.getsize(local_path)
+        os.replace(local_path, fn)
+
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO entries VALUES (?,?,?,?)',
+                        (key, remote_path, size, time.time()))
+        return fn
+
+    def incoming(self):
+        ''' Make a fresh directory to download cache misses into '''
+        dn = path.join(self.incoming_dir, uuid.uuid4().hex)
+        os.makedirs(dn)
+        return dn
+
+    def record(self, hit, nbytes):
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self.hit_bytes += nbytes
+            else:
+                self.misses += 1
+                self.miss_bytes += nbytes
+
+    def stats(self):
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'hit_bytes' : self.hit_bytes,
+                'miss_bytes' : self.miss_bytes,
+                'total_bytes' : self.total_bytes()}
+
+    def total_bytes(self):
+        with self._connect() as con:
+            total = con.execute('SELECT SUM(size) FROM entries').fetchone()[0]
+        return 0 if total is None else total
+
+    def evict(self, keep = ()):
+        ''' Remove least recently used entries until the cache is under
+        max_bytes. Keys in keep are never removed. '''
+
+        if self.max_bytes is None:
+            return
+
+        keep = set(keep)
+        with self._connect() as con:
+            total = con.execute('SELECT SUM(size) FROM entries').fetchone()[0] or 0
+            rows = con.execute('SELECT key, size FROM entries ORDER BY last_used ASC').fetchall()
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                if key in keep:
+                    continue
+                try:
+                    os.remove(self._object_path(key))
+                except OSError:
+                    pass
+                con.execute('DELETE FROM entries WHERE key=?', (key,))
+                total -= size
+
+    def link(self, cached_path, target):
+        ''' Make target a hard link to a cached file, or a copy of it if the
+        two are on different file systems. Not a symlink, which evict()
+        would leave dangling. '''
+
+        if path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(cached_path, target)
+        except OSError:
+            shutil.copyfile(cached_path, target)
+
+    def clear(self):
+        with self._connect() as con:
+            con.execute('DELETE FROM entries')
+        shutil.rmtree(self.object_dir, ignore_errors = True)
+        os.makedirs(self.object_dir, exist_ok = True)
+
+    def _object_path(self, key):
+        return path.join(self.object_dir, key[:2], key)
+
+    def _connect(self):
+        return _Connection(self.index_path)
+
+class _Connection():
+    ''' sqlite connection that commits and closes on exit. A new connection
+    is made each time so the cache can be used from any thread. '''
+
+    def __init__(self, fn):
+        self.con = sqlite3.connect(fn, timeout = 60)
+
+    def __enter__(self):
+        return self.con
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.con.commit()
+        self.con.close()
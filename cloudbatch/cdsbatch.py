@@ -1,227 +1,301 @@
-import subprocess
 import numpy as np
 import os
 import os.path as path
-import glob
+import itertools
+import json
+import time
+import base64
+import threading
+import urllib.request
 from .cloudbatch import CloudBatch
+from .retry import TransferError
 
 class CDSBatch(CloudBatch):
-    
-    def __init__(self, 
+
+    '''
+    For batching requests to the Copernicus Climate Data Store (CDS).
+
+    One request is made for every combination of the values in cds_loop,
+    for example one per year or one per year and month, on top of the fixed
+    keys in cds_dict. Each request is one file, and files are batched like
+    any other CloudBatch. get_batch() keeps up to max_queued requests queued
+    on the server at once, polls them and downloads each result as soon as
+    it is ready, then moves on to the next request. Requests that fail on
+    the server or whose result can't be downloaded raise a TransferError,
+    with one entry per request, also kept in self.failures.
+
+    With queue_ahead, queue slots freed at the end of a batch are used to
+    submit requests for the next batch (by batch index), so the server queue
+    doesn't drain between batches. Those requests are picked up when that
+    batch is fetched. If the next batch is skipped, e.g. when it belongs to
+    another shard, its requests are dropped and their results go unused.
+
+    INPUTS
+        cds_dict (dict)       :: Keys common to every request, e.g. variable,
+                                 product_type, format.
+        cds_loop (dict)       :: Keys to loop over, mapping to lists of values.
+                                 e.g. {'year' : ['2000','2001'], 'month' : ['01']}
+        dataset (str)         :: Name of the CDS dataset,
+                                 e.g. 'reanalysis-era5-single-levels'.
+        get_dir (str)         :: Directory to download results to.
+        batch_size (int)      :: Number of requests in a batch.
+        max_queued (int)      :: Requests to keep queued at once. [ Default = 4 ]
+        poll_interval (float) :: Seconds between status checks. [ Default = 5 ]
+        client                :: Object with submit(), poll() and download()
+                                 methods (see CDSAPIClient). If None, an
+                                 HTTPCDSClient is used when url is given and
+                                 a CDSAPIClient otherwise. [ Default = None ]
+        url (str)             :: URL of the CDS API. [ Default = None ]
+        key (str)             :: CDS API key. [ Default = None ]
+        queue_ahead (bool)    :: Submit requests for the next batch while the
+                                 current one finishes. [ Default = True ]
+
+    Example
+
+        cds = CDSBatch(cds_dict = {'variable' : '2m_temperature', 'format' : 'netcdf'},
+                       cds_loop = {'year' : ['2000', '2001', '2002']},
+                       dataset = 'reanalysis-era5-single-levels',
+                       get_dir = '/tmp/era5',
+                       batch_size = 2)
+        cds.get_batch()
+    '''
+
+    def __init__(self,
                  cds_dict,
                  cds_loop,
+                 dataset = None,
                  get_dir = None,
-                 batch_size=10
+                 batch_size=10,
+                 max_queued = 4,
+                 poll_interval = 5,
+                 client = None,
+                 url = None,
+                 key = None,
+                 queue_ahead = True
                 ):
-        
-        # Initialise batches
-        self.current_file = 0
-        self.current_batch = 0
-        self.source='remote'
-        
-        self.n_batches = len(loop_vector)
-        self.files = files
-        self.last_batch_size = last_batch_size
-        self.batch_size = batch_size
-        self.is_last_batch = False
-        self.source = source
-        self.tmp_files = []
+
+        self.source = 'remote'
         self.get_dir = get_dir
-        
-        self._update_batch() 
-        
-        return
-            
-    def next_batch(self):
-        if self.current_batch < self.n_batches - 1:
-            self.current_batch = self.current_batch + 1
-            self.current_file = self.current_file + self.batch_size
-            self._update_batch()
-        else:
-            print('Final batch has been reached. Cannot increase index.')
-        
-    def prev_batch(self):
-        if self.current_batch > 0:
-            self.current_batch = self.current_batch - 1
-            self.current_file = self.current_file - self.batch_size
-            self._update_batch()
-        else:
-            print('This is the first batch. Cannot decrease index')
-        
-    def reset_batch(self):
-        self.current_batch = 0
-        self.current_file = 0
-        self._update_batch()
+        self.put_dir = None
+        self.cds_dict = cds_dict
+        self.cds_loop = cds_loop
+        self.dataset = dataset
+        self.max_queued = max_queued
+        self.poll_interval = poll_interval
+        self.queue_ahead = queue_ahead
+        self.failures = []
+
+        # Requests submitted ahead of their batch, {file : handle}, shared by
+        # batches being fetched at once in other threads
+        self._ahead = {}
+        self._fetching = set()
+        self._ahead_lock = threading.Lock()
+
+        if client is None:
+            if url is not None:
+                client = HTTPCDSClient(url, key)
+            else:
+                client = CDSAPIClient(url, key)
+        self.client = client
+
+        # One request per combination of loop values
+        loop_keys = list(cds_loop.keys())
+        loop_vector = list(itertools.product(*[cds_loop[kk] for kk in loop_keys]))
+
+        self.requests = []
+        files = []
+        for values in loop_vector:
+            request = dict(cds_dict)
+            request.update(dict(zip(loop_keys, values)))
+            self.requests.append(request)
+            files.append(self._file_name(values))
+        self._request_of = dict(zip(files, self.requests))
+        self._position_of = {ff : ii for ii, ff in enumerate(files)}
+
+        self._init_batches(files, batch_size)
+
         return
-    
-    def get_batch(self):  
-        
-        # Create get command using gsutil and run from command line
-        get_cmd = 'gsutil -m cp '
-        for ff in self.files_batch:
-            get_cmd = get_cmd + f' {ff}'
-        get_cmd += f' {self.get_dir}'
-        subprocess.run(get_cmd, shell=True, )
-                       #stdout=subprocess.DEVNULL, 
-                       #stderr=subprocess.STDOUT)
-        
-        # Save list of current temporary files
+
+    def put_batch(self):
+        raise Exception("CDSBatch can only get data.")
+
+    def _get_files(self, files, ticket = None):
+        ''' Submit the requests for files, keeping max_queued of them on the
+        server at once, and download each result as it finishes. Once every
+        request for files is submitted, free slots go to the next batch
+        (see queue_ahead). '''
+
+        pending = list(files)
+        in_flight = {}
         got_files = []
-        for ff in self.files_batch:
-            got_files.append(path.join(self.get_dir, path.basename(ff)))
-            
-        self.tmp_files = self.tmp_files + got_files
-        
-    def put_batch(self):  
-        # Create get command using gsutil and run from command line
-        put_cmd = 'gsutil -m cp '
-        for ff in self.files_batch:
-            put_cmd = put_cmd + f' {ff}'
-        put_cmd += f' {self.put_dir}'
-        subprocess.run(put_cmd, shell=True, stdout=subprocess.DEVNULL, 
-                                stderr=subprocess.STDOUT)
-    
-    def set_batch_size(self, batch_size):
-        
-        self.batch_size = batch_size
-        n_batches = np.ceil( self.n_files / batch_size ).astype(int)
-        last_batch_size = self.n_files % batch_size
-        
-        self.n_batches = n_batches
-        self.last_batch_size = last_batch_size
-        self._update_batch()
-                        
-    def is_final_batch(self):
-        if self.current_batch == self.n_batches - 1:
-            return True
-        else:
-            return False
-        
-    def delete_tmp_files(self):
-        tmp_files = self.tmp_files
-        for ff in tmp_files:
-            try:
-                os.remove(ff)
-            except:
-                pass
-        self.tmp_files = []
-            
-    def delete_batch_files(self):
-        for ff in self.files_batch:
-            os.remove(ff)
-        self.files_batch = []
-        
-    def summary(self):
-        out_str = ''
-        print(f'   Number of batches:     {self.n_batches}')
-        print(f'   Number of files:       {self.n_files}')
-        print('')
-        print(f'   Current batch number:  {self.current_batch+1}')
-        
-    def check_files(self):
-        
-        checked = np.zeros(self.n_files)
-        for ii in range(self.n_files):
-            if self.source == 'remote':
-                checked[ii] = self._gsstat(self.files[ii])
-            elif self.source == 'local':
-                checked[ii] = self._localstat(self.files[ii])
-            print(ii, self.n_files, checked[ii])
-                
-        self.file_exists = checked
-        
-        
-    def _update_batch(self):
-        
-        start_idx = self.current_file
-        
-        if self.current_batch < self.n_batches - 1:
-            end_idx = self.current_file + self.batch_size
-        else:
-            end_idx = self.current_file + self.last_batch_size
-        
-        self.files_batch = self.files[start_idx:end_idx]
-    
-    def _make_files_from_components(self, components):
-        
-        n_components = len(components)
-        n_subcomponents = [len(cc) for cc in components]
-        n_files = np.prod(n_subcomponents)
-        
-        tmp_list = components[0]
-        
-        for ii in np.arange(1,n_components):
-            tmp_list = self._iterate_list(tmp_list, n_subcomponents[ii])
-            c_ii = components[ii]
-            n_ii = n_subcomponents[ii]
-            for jj in range(len(tmp_list)):
-                tmp_list[jj] = tmp_list[jj] + c_ii[jj%n_ii]
-        
-        return tmp_list
-    
-    def _iterate_list(self, inlist, it=2):
-        
-        n_elements = len(inlist)
-        new_list = ['' for ii in range(it*n_elements)]
-        
-        for ii in range(it):
-            new_list[ii::it] = inlist
-            
-        return new_list
-    
-    def _gsls(self, path):
-        
-        cmd = f"gsutil ls {path}"
-        output = subprocess.check_output(cmd, shell=True)
-        output = str(output)[2:-1]
-        
-        output_split = output.split('\\n')[:-1]
-        
-        return output_split
-    
-    def _gsstat(self, path):
-        cmd = f"gsutil stat {path}"
+        failed = {}
+
+        next_files = self._next_batch_files(files)
+        with self._ahead_lock:
+            self._fetching.update(files)
+            # Requests made ahead for batches that were skipped would hold
+            # queue slots for good
+            keep = set(files) | set(next_files)
+            self._ahead = {ff : handle for ff, handle in self._ahead.items() if ff in keep}
         try:
-            output = subprocess.check_output(cmd, shell=True)
-            if output[:2] == 'No':
-                return False
-            else:
-                return True
-        except:
-            return False
-        
-    def _localstat(self, path):
-        return os.path.exists(path)
-        
-    
-    def _ls(self, path):
-        
-        cmd = f"ls {path}"
-        output = subprocess.check_output(cmd, shell=True)
-        output = str(output)[2:-1]
-        
-        output_split = output.split('\\n')[:-1]
-        
-        return output_split
-    
-    def _expand_wildcards(self, list_of_paths, source):
-        
-        output_list = []
-        n_str = len(list_of_paths)
-        
-        for ii in range(n_str):
-            path = list_of_paths[ii]
-            if '*' in path:
-                if source == 'remote':
-                    wc_files = self._gsls(path)
-                elif source == 'local':
-                    wc_files = glob.glob(path)
-                if type(wc_files) is not list:
-                    wc_files = [wc_files]
-                output_list = output_list + wc_files
-            else:
-                output_list.append(path)
-                
-        return output_list
-            
-        
\ No newline at end of file
+            while len(pending) > 0 or len(in_flight) > 0:
+
+                # Take over requests already submitted ahead, then top up
+                # the queue
+                with self._ahead_lock:
+                    for ff in [ff for ff in pending if ff in self._ahead]:
+                        in_flight[ff] = self._ahead.pop(ff)
+                        pending.remove(ff)
+                while len(pending) > 0 and len(in_flight) < self.max_queued:
+                    ff = pending.pop(0)
+                    in_flight[ff] = self.client.submit(self.dataset, self._request_of[ff])
+                if len(pending) == 0 and self.queue_ahead:
+                    self._submit_ahead(next_files, len(in_flight))
+
+                self._poll(in_flight, got_files, failed)
+                if len(in_flight) > 0:
+                    time.sleep(self.poll_interval)
+        finally:
+            with self._ahead_lock:
+                self._fetching.difference_update(files)
+
+        if len(failed) > 0:
+            report = [{'path' : ff, 'op' : 'get', 'attempts' : 1, 'error' : error,
+                       'request' : self._request_of[ff]} for ff, error in failed.items()]
+            self.failures = self.failures + report
+            self.delete_tmp_files(got_files)
+            raise TransferError(f"{len(report)} CDS requests failed: {list(failed)}", report)
+
+        # Keep the files in batch order
+        return [path.join(self.get_dir, ff) for ff in files]
+
+    def _poll(self, in_flight, got_files, failed):
+        ''' Check on every request in in_flight, downloading finished ones
+        and removing them from in_flight '''
+
+        for ff in list(in_flight.keys()):
+            state = self.client.poll(in_flight[ff])
+            if state == 'completed':
+                target = path.join(self.get_dir, ff)
+                try:
+                    self.client.download(in_flight[ff], target)
+                    got_files.append(target)
+                except Exception as err:
+                    failed[ff] = f'download failed: {err}'
+                del in_flight[ff]
+            elif state == 'failed':
+                failed[ff] = 'request failed on the server'
+                del in_flight[ff]
+
+    def _next_batch_files(self, files):
+        ''' Files of the batch after the one holding files '''
+        if len(files) == 0:
+            return []
+        next_batch = int(np.searchsorted(self.batch_bounds, self._position_of[files[-1]], side = 'right'))
+        if next_batch >= self.n_batches:
+            return []
+        return self.batch_files(next_batch)
+
+    def _submit_ahead(self, next_files, n_in_flight):
+        ''' Fill free queue slots with requests for next_files. Requests of
+        batches being fetched are left alone. '''
+
+        with self._ahead_lock:
+            n_queued = n_in_flight + len([ff for ff in next_files if ff in self._ahead])
+            for ff in next_files:
+                if n_queued >= self.max_queued:
+                    break
+                if ff in self._ahead or ff in self._fetching:
+                    continue
+                self._ahead[ff] = self.client.submit(self.dataset, self._request_of[ff])
+                n_queued += 1
+
+    def _file_name(self, values):
+        fmt = self.cds_dict.get('data_format', self.cds_dict.get('format', 'grib'))
+        ext = {'netcdf' : 'nc', 'netcdf4' : 'nc', 'grib' : 'grib'}.get(fmt, fmt)
+        parts = [str(self.dataset)] + [str(vv) for vv in values]
+        return '_'.join(parts) + f'.{ext}'
+
+class CDSAPIClient():
+    '''
+    Submit requests through the cdsapi package without waiting for them.
+    Credentials are read from ~/.cdsapirc unless url and key are given.
+    '''
+
+    def __init__(self, url = None, key = None):
+
+        try:
+            import cdsapi
+        except ImportError:
+            raise ImportError("CDSBatch requires cdsapi. Install it with: pip install cdsapi")
+
+        self.client = cdsapi.Client(url = url, key = key, quiet = True,
+                                    wait_until_complete = False, delete = False)
+
+    def submit(self, dataset, request):
+        return self.client.retrieve(dataset, request)
+
+    def poll(self, handle):
+        handle.update()
+        reply = getattr(handle, 'reply', None)
+        if reply is not None:
+            return reply['state']
+        # Newer clients expose the status directly
+        return {'accepted' : 'queued', 'successful' : 'completed'}.get(handle.status, handle.status)
+
+    def download(self, handle, target):
+        handle.download(target)
+
+class HTTPCDSClient():
+    '''
+    Minimal client for the CDS REST API (as used by the legacy cdsapi). It
+    needs no extra packages and is what is used to talk to FakeCDSServer.
+
+    Requests are POSTed as JSON to {url}/resources/{dataset}. The reply has a
+    'state' of queued, running, completed or failed and a 'request_id'.
+    Status is polled at {url}/tasks/{request_id} and, once completed, the
+    result is downloaded from reply['location'].
+    '''
+
+    def __init__(self, url, key = None):
+        self.url = url.rstrip('/')
+        self.key = key
+
+    def submit(self, dataset, request):
+        return self._call('POST', f'{self.url}/resources/{dataset}', request)
+
+    def poll(self, handle):
+        if handle['state'] not in ['completed', 'failed']:
+            handle.update(self._call('GET', f"{self.url}/tasks/{handle['request_id']}"))
+        return handle['state']
+
+    def download(self, handle, target):
+        req = self._request('GET', handle['location'])
+        tmp_target = target + '.part'
+        try:
+            with urllib.request.urlopen(req) as response, open(tmp_target, 'wb') as fh:
+                while True:
+                    chunk = response.read(1 << 20)
+                    if not chunk:
+                        break
+                    fh.write(chunk)
+            os.replace(tmp_target, target)
+        except BaseException:
+            # Don't leave a partial download behind
+            if path.exists(tmp_target):
+                os.remove(tmp_target)
+            raise
+
+    def _call(self, method, url, data = None):
+        req = self._request(method, url, data)
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read().decode('utf-8'))
+
+    def _request(self, method, url, data = None):
+        body = None if data is None else json.dumps(data).encode('utf-8')
+        req = urllib.request.Request(url, data = body, method = method)
+        req.add_header('Content-Type', 'application/json')
+        if self.key is not None:
+            token = base64.b64encode(self.key.encode('utf-8')).decode('ascii')
+            req.add_header('Authorization', f'Basic {token}')
+        return req
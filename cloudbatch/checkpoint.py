@@ -0,0 +1,88 @@
+import os
+import os.path as path
+import pickle
+
+class Checkpoint():
+    '''
+    Append-only journal of finished batches for apply_batch_func.
+
+    The journal is a file of pickled records. The first record is a header
+    describing the run (number of batches, files and batch sizes). Every
+    other record holds a batch index and the output of func for that batch.
+    Each record is flushed to disk as soon as it is written, so a run that
+    dies part way through loses at most the batch in progress. A partly
+    written final record is ignored when reading, and cut off when the run
+    is resumed so that new records follow the last complete one.
+
+    INPUTS
+        filename (str)  :: Path of the journal file.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def start(self, header, resume = False):
+        ''' Open the journal for a run. If resume is True and the journal
+        exists, return a dictionary of {batch_index : output} for the
+        finished batches. Otherwise a new journal is started and an empty
+        dictionary is returned. '''
+
+        if resume and path.isfile(self.filename):
+            old_header, done, end = self.load()
+            if old_header is not None:
+                if old_header != header:
+                    raise Exception(f"Checkpoint {self.filename} was written for a different set of batches: {old_header}")
+                # Drop any torn record left by a crash, or records appended
+                # after it could never be read back
+                if end < path.getsize(self.filename):
+                    with open(self.filename, 'r+b') as fh:
+                        fh.truncate(end)
+                        fh.flush()
+                        os.fsync(fh.fileno())
+                return done
+
+        dn = path.dirname(self.filename)
+        if dn != '':
+            os.makedirs(dn, exist_ok = True)
+
+        with open(self.filename, 'wb') as fh:
+            self._write(fh, {'header' : header})
+
+        return {}
+
+    def record(self, batch_index, output):
+        ''' Append the output of a finished batch '''
+        with open(self.filename, 'ab') as fh:
+            self._write(fh, {'batch' : int(batch_index), 'output' : output})
+
+    def load(self):
+        ''' Read the journal. Returns (header, {batch_index : output}, end),
+        where end is the byte offset just past the last complete record. '''
+
+        header = None
+        done = {}
+        end = 0
+        with open(self.filename, 'rb') as fh:
+            while True:
+                try:
+                    rec = pickle.load(fh)
+                except (EOFError, ValueError, pickle.UnpicklingError):
+                    break
+                if 'header' in rec:
+                    header = rec['header']
+                else:
+                    done[rec['batch']] = rec['output']
+                end = fh.tell()
+
+        return header, done, end
+
+    def finished_batches(self):
+        ''' Sorted list of batch indices recorded as finished '''
+        if not path.isfile(self.filename):
+            return []
+        return sorted(self.load()[1])
+
+    def _write(self, fh, rec):
+        pickle.dump(rec, fh, protocol = pickle.HIGHEST_PROTOCOL)
+        fh.flush()
+        os.fsync(fh.fileno())
@@ -0,0 +1,146 @@
+import base64
+import hashlib
+import os.path as path
+import warnings
+
+# Google Storage reports CRC32C and MD5 as base64 of the big-endian digest.
+# A compiled CRC32C is used if one is installed; otherwise MD5 is used where
+# the object has one. The pure python CRC32C is far too slow for large
+# objects, so objects with only a CRC32C (e.g. composite uploads) are then
+# checked on size alone.
+try:
+    import google_crc32c as _google_crc32c
+except ImportError:
+    _google_crc32c = None
+
+try:
+    import crc32c as _crc32c
+except ImportError:
+    _crc32c = None
+
+_CHUNK_SIZE = 1 << 20
+
+def _make_table():
+    # Castagnoli polynomial, reflected
+    table = []
+    for ii in range(256):
+        crc = ii
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82F63B78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+_TABLE = _make_table()
+
+class CRC32C():
+    ''' Streaming CRC32C with the same interface as hashlib objects '''
+
+    def __init__(self):
+        if _google_crc32c is not None:
+            self._checksum = _google_crc32c.Checksum()
+        else:
+            self._crc = 0
+
+    def update(self, data):
+        if _google_crc32c is not None:
+            self._checksum.update(data)
+        elif _crc32c is not None:
+            self._crc = _crc32c.crc32c(data, self._crc)
+        else:
+            crc = self._crc ^ 0xFFFFFFFF
+            table = _TABLE
+            for byte in bytes(data):
+                crc = table[(crc ^ byte) & 0xFF] ^ (crc >> 8)
+            self._crc = crc ^ 0xFFFFFFFF
+
+    def digest(self):
+        if _google_crc32c is not None:
+            return self._checksum.digest()
+        return self._crc.to_bytes(4, 'big')
+
+def fast_crc32c():
+    ''' True if a compiled CRC32C implementation is installed '''
+    return _google_crc32c is not None or _crc32c is not None
+
+class Hasher():
+    '''
+    Computes several hashes in one pass over a stream of data.
+
+    INPUTS
+        algorithms (list)  :: Any of 'md5' and 'crc32c'. [ Default = ['crc32c', 'md5'] ]
+
+    Example
+
+        hasher = Hasher(['md5'])
+        for chunk in chunks:
+            hasher.update(chunk)
+        hasher.digests()   -> {'md5' : 'rL0Y20zC+Fzt72VPzMSk2A=='}
+    '''
+
+    def __init__(self, algorithms = ('crc32c', 'md5')):
+        self._hashes = {}
+        for name in algorithms:
+            if name == 'md5':
+                self._hashes[name] = hashlib.md5()
+            elif name == 'crc32c':
+                self._hashes[name] = CRC32C()
+            else:
+                raise Exception(f"Unrecognised hash {name}. Choose: ['md5','crc32c']")
+
+    def update(self, data):
+        for hh in self._hashes.values():
+            hh.update(data)
+
+    def digests(self):
+        ''' Dictionary of base64 digests, in the form Google Storage reports '''
+        return {name : base64.b64encode(hh.digest()).decode('ascii')
+                for name, hh in self._hashes.items()}
+
+def file_hashes(filename, algorithms = ('crc32c', 'md5'), chunk_size = _CHUNK_SIZE):
+    ''' Hashes of a file, read once in chunks '''
+    hasher = Hasher(algorithms)
+    with open(filename, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            hasher.update(chunk)
+    return hasher.digests()
+
+def pick_algorithm(info):
+    ''' Hash to check against object metadata info, or None if it has none
+    that can be checked. Composite objects only have a CRC32C, which is only
+    checked if a compiled CRC32C is installed. Otherwise a warning is given
+    and None is returned, so only the size is compared. '''
+    if info.get('crc32c') and fast_crc32c():
+        return 'crc32c'
+    if info.get('md5'):
+        return 'md5'
+    if info.get('crc32c'):
+        warnings.warn("Objects with only a CRC32C hash are checked on size alone, as no "
+                      "compiled CRC32C is installed. Install one with: pip install google-crc32c")
+    return None
+
+def check_file(filename, info, verify = 'hash'):
+    ''' Compare a local file with object metadata. Returns None if they match,
+    or a description of the difference.
+
+    verify is 'size', to compare sizes only, or 'hash', to also compare a
+    hash when the metadata has one. Sizes are compared first, so a
+    truncated file is caught without reading it. '''
+
+    if not path.isfile(filename):
+        return 'file is missing'
+
+    size = path.getsize(filename)
+    if info.get('size') is not None and size != int(info['size']):
+        return f"size is {size} bytes, expected {info['size']}"
+
+    if verify == 'size':
+        return None
+
+    algorithm = pick_algorithm(info)
+    if algorithm is None:
+        return None
+    digest = file_hashes(filename, [algorithm])[algorithm]
+    if digest != info[algorithm]:
+        return f"{algorithm} is {digest}, expected {info[algorithm]}"
+
+    return None
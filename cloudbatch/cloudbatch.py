@@ -3,9 +3,28 @@ import numpy as np
 import os
 import os.path as path
 import glob
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .backends import get_backend, LocalBackend, _join_remote
+from .cache import DiskCache
+from .retry import RetryPolicy, TransferError
+from .listing import Lister
+from .sharding import shard_batches
+from .manifest import Manifest
+from .checksum import check_file, file_hashes, pick_algorithm
+from .autotune import BatchAutotuner
+from .shards import write_shard
+from .remotefile import RemoteFile
 
 class CloudBatch():
     
+    '''
+    Base class for batch objects. Children set up self.files and the batch
+    counters (see _init_batches()) and a TransferBackend in self.backend,
+    which is used for all transfers, listings and existence checks.
+    '''
+    
     def __init__(self, 
                  file_list = None, 
                  file_dir = None,
@@ -18,17 +37,13 @@ class CloudBatch():
             
     def next_batch(self):
         if self.current_batch < self.n_batches - 1:
-            self.current_batch = self.current_batch + 1
-            self.current_file = self.current_file + self.batch_size
-            self._update_batch()
+            self.goto_batch(self.current_batch + 1)
         else:
             print('Final batch has been reached. Cannot increase index.')
         
     def prev_batch(self):
         if self.current_batch > 0:
-            self.current_batch = self.current_batch - 1
-            self.current_file = self.current_file - self.batch_size
-            self._update_batch()
+            self.goto_batch(self.current_batch - 1)
         else:
             print('This is the first batch. Cannot decrease index')
         
@@ -38,24 +53,127 @@ class CloudBatch():
         self._update_batch()
         return
     
-    def get_batch(self):
-        error_msg = 'This child of CloudBatch has not implemented this method'
-        raise NotImplemented(error_msg)
+    def goto_batch(self, batch_index):
+        ''' Move straight to batch number batch_index '''
+        if batch_index < 0 or batch_index >= self.n_batches:
+            raise Exception(f"Batch index {batch_index} is out of range for {self.n_batches} batches.")
+        self.current_batch = batch_index
+        self.current_file = self._batch_slice(batch_index)[0]
+        self._update_batch()
+    
+    def __iter__(self):
+        ''' Cycle through all batches, yielding the list of files in each.
+        
+        For remote objects each batch is downloaded before it is yielded
+        and its files are deleted as soon as the loop moves on, so only one
+        batch is ever on disk. For local objects files_batch is yielded.
+        '''
+        
+        try:
+            for bb in range(self.n_batches):
+                self.goto_batch(bb)
+                if self.source == 'remote':
+                    self.get_batch()
+                    yield list(self.tmp_files)
+                    self.delete_tmp_files()
+                else:
+                    yield list(self.files_batch)
+        finally:
+            if self.source == 'remote':
+                self.delete_tmp_files()
+    
+    def get_batch(self):  
+        
+        got_files = self._get_files(self.files_batch)
+        self.tmp_files = self.tmp_files + got_files
         
-    def put_batch(self):  
-        error_msg = 'This child of CloudBatch has not implemented this method'
-        raise NotImplemented(error_msg)
+    def put_batch(self, sync = None):  
+        ''' Upload the current batch. With sync (default self.sync), files
+        whose uploaded copy already has the same hash are skipped. '''
+        self._put_files(self.files_batch, sync)
         return
     
     def set_batch_size(self, batch_size):
         
         self.batch_size = batch_size
-        n_batches = np.ceil( self.n_files / batch_size ).astype(int)
-        last_batch_size = self.n_files % batch_size
+        self.batch_bytes = None
         
-        self.n_batches = n_batches
-        self.last_batch_size = last_batch_size
-        self._update_batch()
+        bounds = np.arange(0, self.n_files, batch_size)
+        self._set_bounds( np.append(bounds, self.n_files) )
+        
+    def resize_remaining(self, from_batch, batch_size):
+        ''' Re-cut the files of batch number from_batch onwards into batches
+        of batch_size. Earlier batches keep their files and indices, so this
+        can be called part way through a run. Used by batch_size='auto'. '''
+        
+        if from_batch >= self.n_batches:
+            return
+        start = int(self.batch_bounds[from_batch])
+        bounds = np.append(self.batch_bounds[:from_batch], np.arange(start, self.n_files, batch_size))
+        
+        self.batch_size = batch_size
+        self.batch_bytes = None
+        self._set_bounds( np.append(bounds, self.n_files) )
+        
+    def set_batch_bytes(self, batch_bytes, max_batch_files = None, file_sizes = None):
+        ''' Cut files into batches by total size rather than by count.
+        
+        Files are kept in order and a new batch is started whenever adding
+        the next file would take the batch over batch_bytes, or over
+        max_batch_files files. A single file larger than batch_bytes gets
+        a batch of its own.
+        
+        INPUTS
+            batch_bytes (int)      :: Byte budget for each batch.
+            max_batch_files (int)  :: Optional cap on files per batch. [ Default = None ]
+            file_sizes (array)     :: Size of every file in self.files. If None,
+                                      sizes come from a bulk listing. [ Default = None ]
+        '''
+        
+        if file_sizes is None:
+            file_sizes = self.get_file_sizes()
+        sizes = np.asarray(file_sizes, dtype=np.int64)
+        if len(sizes) != self.n_files:
+            raise Exception("file_sizes must have one element per file.")
+        
+        bounds = [0]
+        total = 0
+        count = 0
+        for ii, size in enumerate(sizes):
+            full = total + size > batch_bytes
+            if max_batch_files is not None:
+                full = full or count >= max_batch_files
+            if count > 0 and full:
+                bounds.append(ii)
+                total = 0
+                count = 0
+            total += size
+            count += 1
+        if self.n_files > 0:
+            bounds.append(self.n_files)
+            
+        self.batch_bytes = batch_bytes
+        self.max_batch_files = max_batch_files
+        self.file_sizes = sizes
+        self._set_bounds( np.array(bounds) )
+        
+        # Largest batch, for information
+        self.batch_size = int(np.max(np.diff(self.batch_bounds), initial=0))
+        
+    def get_file_sizes(self):
+        ''' Size in bytes of every file, from a bulk listing '''
+        
+        listing = getattr(self, '_listing', None)
+        if listing is not None and listing[0] is self.files:
+            infos = self._listed_info(self.files)
+        else:
+            infos = self._file_info(self.files)
+        n_missing = sum([info is None for info in infos])
+        if n_missing > 0:
+            raise Exception(f"Could not get the size of {n_missing} missing files.")
+        
+        self.file_sizes = np.array([info['size'] for info in infos], dtype=np.int64)
+        return self.file_sizes
                         
     def is_final_batch(self):
         if self.current_batch == self.n_batches - 1:
@@ -68,12 +186,26 @@ class CloudBatch():
             files_to_delete = self.tmp_files.copy()
             self.tmp_files = []
             
+        # Members of downloaded shards go with their shard
+        shards = getattr(self, '_unpacked', None)
+        if shards is not None:
+            files_to_delete = shards.remove(files_to_delete)
+            
         for ff in files_to_delete:
+            if isinstance(ff, RemoteFile):
+                # Also removes its local copy, if it was downloaded whole
+                self._count_remote(ff)
+                ff.close()
+                continue
             try:
                 os.remove(ff)
             except:
                 pass
             
+        staging = getattr(self, 'staging', None)
+        if staging is not None:
+            staging.release(files_to_delete)
+            
     def delete_batch_files(self):
         for ff in self.files_batch:
             os.remove(ff)
@@ -87,47 +219,635 @@ class CloudBatch():
         print(f'   Current batch number:  {self.current_batch+1}')
         
         
-    def _update_batch(self):
+    def batch_files(self, batch_index):
+        ''' Return the list of files in batch number batch_index without
+        moving the current batch. Used for staging batches ahead of time. '''
+        start_idx, end_idx = self._batch_slice(batch_index)
+        return self.files[start_idx:end_idx]
         
-        start_idx = self.current_file
+    def shard_batches(self, shard_index = None, num_shards = None):
+        ''' Batch indices handled by one of num_shards workers. Batches are
+        dealt out round robin, so every worker gets a disjoint set and
+        aligned objects with the same number of batches get the same
+        indices. With no arguments the shard comes from the environment
+        (see sharding.shard_from_env()). '''
+        return shard_batches(self.n_batches, shard_index, num_shards)
+    
+    def mark_batch(self, batch_index, status = 'done', failed = None):
+        ''' Record the objects of batch number batch_index in the manifest
+        with the given status. failed is a list of positions in the batch
+        whose objects are marked 'failed' instead, e.g. files for which func
+        raised. Does nothing without a manifest. '''
         
-        if self.current_batch < self.n_batches - 1:
-            end_idx = self.current_file + self.batch_size
+        manifest = getattr(self, 'manifest', None)
+        if manifest is None:
+            return
+        
+        files = self.batch_files(batch_index)
+        known = self._manifest_info
+        unknown = [ff for ff in files if ff not in known]
+        if len(unknown) > 0:
+            # e.g. outputs written during the run
+            for ff, info in zip(unknown, self._stat_each(unknown)):
+                known[ff] = {'path' : ff} if info is None else dict(info, path = ff)
+        
+        failed = set() if failed is None else set(failed)
+        ok = [known[ff] for ii, ff in enumerate(files) if ii not in failed]
+        bad = [known[ff] for ii, ff in enumerate(files) if ii in failed]
+        if len(ok) > 0:
+            manifest.mark(ok, status, batch_index)
+        if len(bad) > 0:
+            manifest.mark(bad, 'failed', batch_index)
+        
+    def _use_manifest(self, files, manifest, job = 'default', incremental = False):
+        ''' Set up self.manifest and return the files to batch. With
+        incremental, only objects that are new, have changed or were not
+        finished according to the manifest are kept. Objects that can't be
+        found are always kept. '''
+        
+        if manifest is None:
+            if incremental:
+                raise Exception("incremental = True requires a manifest.")
+            self.manifest = None
+            return files
+        
+        if not isinstance(manifest, Manifest):
+            manifest = Manifest(manifest, job)
+        self.manifest = manifest
+        
+        # Listings must be fresh to spot new objects
+        infos = self._file_info(files, cached = False)
+        found = [ii for ii, info in enumerate(infos) if info is not None]
+        
+        keep = np.ones(len(files), dtype=bool)
+        if incremental:
+            keep[found] = manifest.changed([dict(infos[ii], path = files[ii]) for ii in found])
+        self.n_unchanged = int(len(files) - np.sum(keep))
+        
+        kept = [files[ii] for ii in np.flatnonzero(keep)]
+        self._manifest_info = {files[ii] : dict(infos[ii], path = files[ii]) 
+                               for ii in found if keep[ii]}
+        # Reuse this listing for the run (see _listed_info())
+        self._listing = (kept, False, {files[ii] : infos[ii] for ii in found if keep[ii]})
+        
+        return kept
+        
+    def _batch_slice(self, batch_index):
+        
+        if self.n_batches == 0:
+            return 0, 0
+        
+        start_idx = int(self.batch_bounds[batch_index])
+        end_idx = int(self.batch_bounds[batch_index + 1])
+            
+        return start_idx, end_idx
+    
+    def _set_bounds(self, bounds):
+        ''' Set the batch boundaries. bounds holds the index of the first file
+        of every batch, followed by n_files. '''
+        
+        self.batch_bounds = np.asarray(bounds, dtype=np.int64)
+        self.n_batches = len(self.batch_bounds) - 1
+        
+        if self.n_batches > 0:
+            self.last_batch_size = int(self.batch_bounds[-1] - self.batch_bounds[-2])
         else:
-            end_idx = self.current_file + self.last_batch_size
+            self.last_batch_size = 0
+            
+        self.current_batch = min(self.current_batch, max(self.n_batches - 1, 0))
+        self.current_file = self._batch_slice(self.current_batch)[0]
+        self._update_batch()
         
+    def _rebatch(self):
+        ''' Rebuild the batches after self.files has changed '''
+        self.n_files = len(self.files)
+        if self.batch_bytes is not None:
+            self.set_batch_bytes(self.batch_bytes, self.max_batch_files, self.file_sizes)
+        else:
+            self.set_batch_size(self.batch_size)
+        
+    def _update_batch(self):
+        
+        start_idx, end_idx = self._batch_slice(self.current_batch)
         self.files_batch = self.files[start_idx:end_idx]
         
+    def _init_batches(self, files, batch_size, 
+                      batch_bytes = None, max_batch_files = None):
+        
+        # Initialise batches
+        self.current_file = 0
+        self.current_batch = 0
+        
+        self.n_files = len(files)
+        self.files = files
+        self.is_last_batch = False
+        self.tmp_files = []
+        self.file_sizes = None
+        self.failures = []
+        self._listing_lock = threading.Lock()
+        
+        # Start auto sized batches small and let apply_batch_func resize them
+        if batch_size == 'auto':
+            if getattr(self, 'autotune', None) is None:
+                self.autotune = BatchAutotuner()
+            batch_size = self.autotune.size
+        
+        if batch_bytes is not None:
+            self.set_batch_bytes(batch_bytes, max_batch_files)
+        else:
+            self.set_batch_size(batch_size)
+        
+    def _get_files(self, files, ticket = None):
+        ''' Download files into get_dir and return the local paths. Does not
+        touch the batch state, so it is safe to call from a background thread.
+        If self.staging is set, waits for staging space first. ticket is the
+        place in the staging queue (see _staging_ticket()). '''
+        
+        staging = getattr(self, 'staging', None)
+        if getattr(self, 'materialize', 'copy') == 'lazy':
+            # Nothing is downloaded up front, so there is nothing to stage
+            if staging is not None and ticket is not None:
+                staging.cancel(ticket)
+            return self._open_remote(files)
+        if staging is None:
+            return self._unpack(self._download(files))
+        
+        try:
+            sizes = self._staging_sizes(files)
+        except BaseException:
+            if ticket is not None:
+                staging.cancel(ticket)
+            raise
+        staging.reserve(sizes, ticket)
+        try:
+            return self._unpack(self._download(files))
+        except BaseException:
+            staging.release(list(sizes))
+            raise
+        
+    def _staging_ticket(self):
+        ''' Queue position for a download that is about to be scheduled, or
+        None if there is no staging quota '''
+        staging = getattr(self, 'staging', None)
+        if staging is None:
+            return None
+        return staging.ticket()
+    
+    def _staging_sizes(self, files):
+        ''' Dictionary of local target path to object size for files '''
+        targets = self.backend._local_targets(files, self.get_dir)
+        return dict(zip(targets, self._object_sizes(files)))
+    
+    def _object_sizes(self, files):
+        ''' Size of each object in files, from a bulk listing of all files '''
+        
+        if self.file_sizes is None:
+            self.get_file_sizes()
+        if getattr(self, '_size_map', None) is None or self._size_map[0] is not self.file_sizes:
+            self._size_map = (self.file_sizes, dict(zip(self.files, self.file_sizes.tolist())))
+        size_of = self._size_map[1]
+        return [size_of[ff] for ff in files]
+    
+    def _open_remote(self, files):
+        ''' RemoteFile handles for files, which fetch byte ranges as they
+        are read (see materialize in GSBatch) '''
+        
+        policy = self._retry_policy()
+        return [RemoteFile(ff, size, self.backend,
+                           block_size = self.block_size,
+                           cache_bytes = self.block_cache_bytes,
+                           local_dir = self.get_dir,
+                           retry = policy)
+                for ff, size in zip(files, self._object_sizes(files))]
+    
+    def _count_remote(self, handle):
+        ''' Add a closed RemoteFile's transfers to self.remote_stats '''
+        stats = getattr(self, 'remote_stats', None)
+        if stats is None:
+            stats = {'files' : 0, 'object_bytes' : 0, 'bytes_fetched' : 0,
+                     'requests' : 0, 'materialized' : 0}
+            self.remote_stats = stats
+        stats['files'] += 1
+        stats['object_bytes'] += handle.size
+        stats['bytes_fetched'] += handle.bytes_fetched
+        stats['requests'] += handle.n_requests
+        stats['materialized'] += int(handle.materialized)
+    
+    def _split_for_staging(self):
+        ''' Re-cut batches that are larger than the staging quota '''
+        
+        staging = self.staging
+        if self.file_sizes is None:
+            self.get_file_sizes()
+        if self.n_batches == 0:
+            return
+        batch_totals = np.add.reduceat(self.file_sizes, self.batch_bounds[:-1])
+        if np.max(batch_totals) > staging.max_bytes:
+            max_files = self.max_batch_files if self.batch_bytes is not None else self.batch_size
+            self.set_batch_bytes(staging.max_bytes, max_files, self.file_sizes)
+        
+    def _unpack(self, files):
+        ''' Members of the downloaded shards in files when the objects are
+        shards (see bundle in GSBatch), otherwise files unchanged '''
+        shards = getattr(self, '_unpacked', None)
+        if shards is None:
+            return files
+        return shards.unpack(files)
+    
+    def _download(self, files):
+        ''' Download files into get_dir without any staging checks '''
+        
+        if getattr(self, 'cache', None) is not None:
+            return self._get_files_cached(files)
+        
+        got_files, failed = self._fetch(files, self.get_dir)
+        
+        if len(failed) > 0:
+            self.delete_tmp_files(got_files)
+            self._raise_failures(failed, 'get')
+            
+        return got_files
+    
+    def _fetch(self, files, local_dir, retry = None):
+        ''' Download files into local_dir, retrying only the ones that fail.
+        Returns the local paths and a list of (file, attempts, error) for the
+        files that never arrived. retry overrides self.retry. '''
+        
+        policy = retry if retry is not None else self._retry_policy()
+        got_files = self.backend._local_targets(files, local_dir)
+        target_of = dict(zip(files, got_files))
+        remaining = list(files)
+        
+        # With verify, downloads that don't match the object's size or hash
+        # are deleted and retried like missing ones. Expected sizes and
+        # hashes come from one listing for the whole run (see _listed_info()).
+        verify = getattr(self, 'verify', None)
+        expected = {}
+        if verify is not None:
+            infos = self._listed_info(files, hashes = verify == 'hash')
+            expected = {ff : info for ff, info in zip(files, infos) if info is not None}
+        errors = {}
+        refreshed = set()
+        
+        for attempt in range(policy.max_attempts):
+            if attempt > 0:
+                policy.sleep(attempt - 1)
+            self.backend.get(remaining, local_dir)
+            
+            retry = []
+            mismatched = []
+            for ff in remaining:
+                if not path.isfile(target_of[ff]):
+                    errors[ff] = 'object was not downloaded'
+                    retry.append(ff)
+                    continue
+                if ff in expected:
+                    error = check_file(target_of[ff], expected[ff], verify)
+                    if error is not None:
+                        os.remove(target_of[ff])
+                        errors[ff] = f'download does not match: {error}'
+                        retry.append(ff)
+                        if ff not in refreshed:
+                            mismatched.append(ff)
+            remaining = retry
+            if len(remaining) == 0:
+                break
+            
+            # The object may have changed since it was listed, so look up
+            # anything that didn't match again, once, before retrying
+            if len(mismatched) > 0:
+                for ff, info in zip(mismatched, self._refresh_info(mismatched)):
+                    if info is not None:
+                        expected[ff] = info
+                refreshed.update(mismatched)
+                
+        failed = [(ff, policy.max_attempts, errors[ff]) for ff in remaining]
+        return got_files, failed
+    
+    def _raise_failures(self, failed, op):
+        ''' Add failed transfers to self.failures and raise a TransferError '''
+        
+        report = [{'path' : ff, 'op' : op, 'attempts' : attempts, 'error' : error} 
+                  for ff, attempts, error in failed]
+        if not hasattr(self, 'failures'):
+            self.failures = []
+        self.failures.extend(report)
+        
+        raise TransferError(f"Failed to {op} {len(report)} files after retrying.", report)
+    
+    def _retry_policy(self):
+        policy = getattr(self, 'retry', None)
+        if policy is None:
+            policy = RetryPolicy()
+        return policy
+    
+    def _get_files_cached(self, files):
+        ''' Version of _get_files() that goes through self.cache. Only cache
+        misses are downloaded, everything is then linked into get_dir. '''
+        
+        cache = self.cache
+        # Cache keys come from one listing for the whole run. Objects that
+        # aren't in the cache under it are looked up again on their own, in
+        # case they have changed since.
+        infos = self._listed_info(files)
+        targets = [path.join(self.get_dir, path.basename(ff)) for ff in files]
+        
+        missing = [(ff, 1, 'object not found') for ff, info in zip(files, infos) if info is None]
+        if len(missing) > 0:
+            self._raise_failures(missing, 'get')
+        
+        keys = [self._cache_key(ff, info) for ff, info in zip(files, infos)]
+        misses = [ii for ii, key in enumerate(keys) if cache.lookup(key) is None]
+        if len(misses) > 0:
+            fresh = self._refresh_info([files[ii] for ii in misses])
+            gone = [(files[ii], 1, 'object not found') for ii, info in zip(misses, fresh) if info is None]
+            if len(gone) > 0:
+                self._raise_failures(gone, 'get')
+            for ii, info in zip(misses, fresh):
+                infos[ii] = info
+                keys[ii] = self._cache_key(files[ii], info)
+        
+        misses = []
+        for ff, info, key, target in zip(files, infos, keys, targets):
+            cached = cache.lookup(key)
+            if cached is None:
+                misses.append((ff, key, target))
+            else:
+                cache.link(cached, target)
+                cache.record(True, info['size'])
+                
+        if len(misses) > 0:
+            incoming = cache.incoming()
+            try:
+                got_files, failed = self._fetch([mm[0] for mm in misses], incoming)
+                if len(failed) > 0:
+                    self.delete_tmp_files(targets)
+                    self._raise_failures(failed, 'get')
+                for (ff, key, target), got in zip(misses, got_files):
+                    nbytes = path.getsize(got)
+                    cache.link(cache.add(key, ff, got), target)
+                    cache.record(False, nbytes)
+            finally:
+                shutil.rmtree(incoming, ignore_errors = True)
+                
+        cache.evict(keep = keys)
+        
+        return targets
+    
+    def _cache_key(self, ff, info):
+        version = info['generation'] if info['generation'] is not None else info['md5']
+        return self.cache.key(ff, version, info['size'])
+    
+    def _listed_info(self, files, hashes = False):
+        ''' Metadata dictionary for each file in files, None where missing.
+        
+        Comes from one fresh bulk listing of all of self.files, taken the
+        first time it is needed and reused for every later batch, so that
+        batches don't list their directories again. With hashes, the listing
+        includes object hashes. Objects missing from the listing are looked
+        up again on their own.
+        '''
+        
+        with self._listing_lock:
+            listing = getattr(self, '_listing', None)
+            if listing is None or listing[0] is not self.files or (hashes and not listing[1]):
+                infos = self._file_info(self.files, cached = False, hashes = hashes)
+                listing = (self.files, hashes, {ff : info for ff, info in zip(self.files, infos)
+                                                if info is not None})
+                self._listing = listing
+        known = listing[2]
+        
+        infos = [known.get(ff) for ff in files]
+        missing = [ii for ii, info in enumerate(infos) if info is None]
+        if len(missing) > 0:
+            for ii, info in zip(missing, self._refresh_info([files[ii] for ii in missing])):
+                infos[ii] = info
+        return infos
+    
+    def _refresh_info(self, files):
+        ''' Look files up again on their own, updating the listing kept by
+        _listed_info(). Returns their metadata, None where missing. '''
+        
+        infos = self._stat_each(files)
+        listing = getattr(self, '_listing', None)
+        if listing is not None:
+            for ff, info in zip(files, infos):
+                if info is not None:
+                    listing[2][ff] = info
+        return infos
+    
+    def _stat_each(self, files, max_workers = 16):
+        ''' Metadata for each file in files from its own stat call, None where
+        missing. Used for a few files, where listing their directories would
+        cost more. '''
+        return self._file_info(files, list_threshold = len(files) + 1, max_workers = max_workers)
+    
+    def _file_info(self, files, list_threshold = 5, max_workers = 16, 
+                   cached = True, hashes = False):
+        ''' Metadata dictionary for each file in files, None where missing.
+        
+        Files are grouped by parent directory. Any directory holding at least
+        list_threshold of the files is listed once with its metadata and the
+        files are looked up in the listing. Remaining scattered files are
+        checked with concurrent stat calls, max_workers at a time. If cached
+        is False, cached listings (see listing_cache) are not used. If hashes
+        is True, remote directories are listed with the backend's full
+        list_info(), which includes object hashes, rather than the streamed
+        listing.
+        '''
+        
+        if self.source == 'remote':
+            backend = self.backend
+            list_info = backend.list_info if hashes else self._lister(cached).list_info
+        else:
+            backend = LocalBackend()
+            list_info = backend.list_info
+            
+        return self._lookup_info(files, backend, list_info, list_threshold, max_workers)
+    
+    def _lookup_info(self, files, backend, list_info, list_threshold = 5, max_workers = 16):
+        ''' Body of _file_info(), for any backend and listing function '''
+        
+        infos = [None] * len(files)
+        
+        # Group file indices by their parent directory
+        parents = {}
+        for ii, ff in enumerate(files):
+            parents.setdefault(path.dirname(ff), []).append(ii)
+            
+        to_stat = []
+        for parent, idx in parents.items():
+            if len(idx) < list_threshold:
+                to_stat = to_stat + idx
+                continue
+            listed = {info['path'] : info for info in list_info(parent + '/*')}
+            for ii in idx:
+                infos[ii] = listed.get(files[ii])
+            
+        if len(to_stat) > 0:
+            with ThreadPoolExecutor(max_workers = max_workers) as pool:
+                stats = list(pool.map(backend.stat, [files[ii] for ii in to_stat]))
+            for ii, info in zip(to_stat, stats):
+                infos[ii] = info
+                
+        return infos
+    
+    def _put_files(self, files, sync = None):
+        ''' Upload files to put_dir. Safe to call from a background thread.
+        Uploads that fail are retried on their own. With sync (default
+        self.sync), files already uploaded with the same hash are skipped.
+        With self.bundle, files are packed into one shard which is uploaded
+        instead. '''
+        
+        if getattr(self, 'bundle', False) and len(files) > 0:
+            shard_file = self._pack(files)
+            try:
+                self._upload([shard_file], sync)
+            finally:
+                os.remove(shard_file)
+            return
+        
+        self._upload(files, sync)
+        
+    def _pack(self, files):
+        ''' Write files into a shard named after their batch, next to them '''
+        
+        # Look up which batch these files are from
+        if getattr(self, '_positions', None) is None or self._positions[0] is not self.files:
+            self._positions = (self.files, {ff : ii for ii, ff in enumerate(self.files)})
+        first = self._positions[1][files[0]]
+        batch_index = int(np.searchsorted(self.batch_bounds, first, side='right')) - 1
+        
+        shard_file = path.join(path.dirname(files[0]), f'{self.bundle_prefix}{batch_index:08d}.tar')
+        write_shard(shard_file, files, self.bundle_compression)
+        return shard_file
+        
+    def _upload(self, files, sync = None):
+        ''' Body of _put_files() '''
+        
+        if sync is None:
+            sync = getattr(self, 'sync', False)
+        if sync:
+            files = self._unsynced(files)
+        
+        failed = self._push(files)
+        if len(failed) > 0:
+            self._raise_failures(failed, 'put')
+            
+    def _push(self, files, retry = None):
+        ''' Upload files to put_dir, retrying only the ones that fail. 
+        Returns a list of (file, attempts, error) for the files that never 
+        made it. retry overrides self.retry. '''
+        
+        policy = retry if retry is not None else self._retry_policy()
+        remaining = list(files)
+        
+        for attempt in range(policy.max_attempts):
+            if attempt > 0:
+                policy.sleep(attempt - 1)
+            remaining = self.backend.put(remaining, self.put_dir)
+            if len(remaining) == 0:
+                break
+            
+        return [(ff, policy.max_attempts, 'upload failed') for ff in remaining]
+        
+    def _unsynced(self, files):
+        ''' Files that differ from their uploaded copy in put_dir. Objects
+        are compared by size, then by hash if the remote has one. Files whose
+        copy has no hash to compare are uploaded again. '''
+        
+        remote = [_join_remote(self.put_dir, path.basename(ff)) for ff in files]
+        infos = self._lookup_info(remote, self.backend, self.backend.list_info)
+        
+        out = []
+        for ff, info in zip(files, infos):
+            if info is None or info.get('size') != path.getsize(ff):
+                out.append(ff)
+                continue
+            algorithm = pick_algorithm(info)
+            if algorithm is None or file_hashes(ff, [algorithm])[algorithm] != info[algorithm]:
+                out.append(ff)
+        
+        self.n_synced = getattr(self, 'n_synced', 0) + len(files) - len(out)
+        return out
+        
+    def check_files(self, drop_missing = False, list_threshold = 5, 
+                    max_workers = 16):
+        ''' Check which files in self.files exist. 
+        
+        Directories holding at least list_threshold of the files are listed
+        once and everything else is checked with concurrent stat calls. See
+        _file_info().
+        
+        INPUTS
+            drop_missing (bool)   :: Remove missing files from self.files and
+                                     rebuild the batches. [ Default = False ]
+            list_threshold (int)  :: Minimum number of files in a directory for
+                                     it to be listed. [ Default = 5 ]
+            max_workers (int)     :: Number of concurrent stat calls. [ Default = 16 ]
+            
+        OUTPUTS
+            Boolean numpy array, True where the file exists. Also stored in
+            self.file_exists.
+        '''
+        
+        infos = self._file_info(self.files, list_threshold, max_workers)
+        checked = np.array([info is not None for info in infos], dtype=bool)
+                
+        self.file_exists = checked
+        
+        if drop_missing and not np.all(checked):
+            self.files = [ff for ff, ok in zip(self.files, checked) if ok]
+            if self.file_sizes is not None:
+                self.file_sizes = self.file_sizes[checked]
+            self.current_batch = 0
+            self._rebatch()
+            
+        return checked
+        
+    def _gsls(self, path):
+        return self.backend.list(path)
+    
+    def _gsstat(self, path):
+        return self.backend.exists(path)
+        
     def _localstat(self, path):
         return os.path.exists(path)
     
     def _ls(self, path):
         
-        cmd = f"ls {path}"
-        output = subprocess.check_output(cmd, shell=True)
-        output = str(output)[2:-1]
+        output = subprocess.check_output(['ls', path])
         
-        output_split = output.split('\\n')[:-1]
-        
-        return output_split
+        return output.decode('utf-8').splitlines()
+    
+    def _lister(self, cached = True):
+        ''' Lister for remote files. Listings are cached on disk if
+        self.listing_cache is set. '''
+        cache_dir = getattr(self, 'listing_cache', None) if cached else None
+        return Lister(self.backend, 
+                      cache_dir = cache_dir,
+                      ttl = getattr(self, 'listing_ttl', 3600))
     
     def _expand_wildcards(self, list_of_paths, source):
+        ''' Replace every path containing a wildcard with the matching paths.
+        Remote patterns are listed together, so directory levels they share
+        are only listed once. '''
+        
+        wildcards = [pp for pp in list_of_paths if '*' in pp]
+        if len(wildcards) == 0:
+            return list(list_of_paths)
+        
+        if source == 'remote':
+            expanded = dict(zip(wildcards, self._lister().expand(wildcards)))
+        elif source == 'local':
+            expanded = {pp : glob.glob(pp) for pp in wildcards}
         
         output_list = []
-        n_str = len(list_of_paths)
-        
-        for ii in range(n_str):
-            path = list_of_paths[ii]
-            if '*' in path:
-                if source == 'remote':
-                    wc_files = self._gsls(path)
-                elif source == 'local':
-                    wc_files = glob.glob(path)
-                if type(wc_files) is not list:
-                    wc_files = [wc_files]
-                output_list = output_list + wc_files
+        for pp in list_of_paths:
+            if '*' in pp:
+                output_list.extend(expanded[pp])
             else:
-                output_list.append(path)
+                output_list.append(pp)
                 
         return output_list
             
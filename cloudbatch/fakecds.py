@@ -0,0 +1,167 @@
+import json
+import threading
+import time
+import uuid
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeCDSServer():
+    '''
+    Local stand-in for the CDS API, for testing CDSBatch offline.
+
+    Speaks the same REST protocol as HTTPCDSClient. Requests wait in a queue
+    for queue_delay seconds, then run for run_delay seconds, with at most
+    slots requests running at once, like the real server's per-user limits.
+    The result of a request is payload_bytes of data starting with the
+    request as JSON.
+
+    INPUTS
+        queue_delay (float)  :: Seconds a request spends queued. [ Default = 1 ]
+        run_delay (float)    :: Seconds a request spends running. [ Default = 1 ]
+        slots (int)          :: Requests that can run at once. [ Default = 2 ]
+        payload_bytes (int)  :: Size of each result. [ Default = 1024 ]
+        fail (function)      :: Optional function taking a request dict and
+                                returning True if that request should fail.
+        port (int)           :: Port to listen on. 0 picks a free port.
+
+    Example
+
+        server = FakeCDSServer(queue_delay = 0.5).start()
+        cds = CDSBatch(cds_dict, cds_loop, dataset = 'test', url = server.url, ...)
+        ...
+        server.stop()
+    '''
+
+    def __init__(self, queue_delay = 1, run_delay = 1, slots = 2,
+                 payload_bytes = 1024, fail = None, host = '127.0.0.1', port = 0):
+
+        self.queue_delay = queue_delay
+        self.run_delay = run_delay
+        self.slots = slots
+        self.payload_bytes = payload_bytes
+        self.fail = fail
+        self.tasks = {}
+        self.order = []
+        self._lock = threading.Lock()
+
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.url = f'http://{host}:{self.httpd.server_address[1]}'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self.httpd.serve_forever, daemon = True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def submit(self, dataset, request):
+        with self._lock:
+            task_id = uuid.uuid4().hex
+            self.tasks[task_id] = {'dataset' : dataset, 'request' : request,
+                                   'state' : 'queued', 'submitted' : time.time(),
+                                   'started' : None}
+            self.order.append(task_id)
+        return self.reply(task_id)
+
+    def reply(self, task_id):
+        self._update()
+        task = self.tasks[task_id]
+        out = {'request_id' : task_id, 'state' : task['state']}
+        if task['state'] == 'completed':
+            out['location'] = f'{self.url}/download/{task_id}'
+            out['content_length'] = self.payload_bytes
+        return out
+
+    def payload(self, task_id):
+        data = json.dumps(self.tasks[task_id]['request']).encode('utf-8')
+        return data + b' ' * max(0, self.payload_bytes - len(data))
+
+    def _update(self):
+        ''' Move tasks through queued -> running -> completed '''
+
+        now = time.time()
+        with self._lock:
+            running = 0
+            for task_id in self.order:
+                task = self.tasks[task_id]
+                if task['state'] == 'running' and now >= task['started'] + self.run_delay:
+                    failed = self.fail is not None and self.fail(task['request'])
+                    task['state'] = 'failed' if failed else 'completed'
+                if task['state'] == 'running':
+                    running += 1
+
+            for task_id in self.order:
+                task = self.tasks[task_id]
+                if running >= self.slots:
+                    break
+                if task['state'] == 'queued' and now >= task['submitted'] + self.queue_delay:
+                    task['state'] = 'running'
+                    task['started'] = now
+                    running += 1
+
+    def _handler(self):
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_POST(self):
+                parts = self.path.strip('/').split('/')
+                if len(parts) != 2 or parts[0] != 'resources':
+                    return self._send(404, {'error' : 'not found'})
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length).decode('utf-8'))
+                self._send(202, server.submit(parts[1], request))
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if len(parts) != 2 or parts[1] not in server.tasks:
+                    return self._send(404, {'error' : 'not found'})
+                if parts[0] == 'tasks':
+                    return self._send(200, server.reply(parts[1]))
+                if parts[0] == 'download':
+                    data = server.payload(parts[1])
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'application/octet-stream')
+                    self.send_header('Content-Length', str(len(data)))
+                    self.end_headers()
+                    self.wfile.write(data)
+                    return
+                self._send(404, {'error' : 'not found'})
+
+            def _send(self, code, body):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Run a fake CDS API server for testing CDSBatch.')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--queue-delay', type = float, default = 1)
+    parser.add_argument('--run-delay', type = float, default = 1)
+    parser.add_argument('--slots', type = int, default = 2)
+    parser.add_argument('--payload-bytes', type = int, default = 1024)
+    args = parser.parse_args()
+
+    server = FakeCDSServer(queue_delay = args.queue_delay, run_delay = args.run_delay,
+                           slots = args.slots, payload_bytes = args.payload_bytes,
+                           port = args.port)
+    print(f'Fake CDS server listening on {server.url}')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
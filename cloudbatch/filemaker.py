@@ -1,57 +1,116 @@
+import itertools
+import operator
+import os.path as path
+from collections.abc import Sequence
 import numpy as np
 
+class ComponentFileList(Sequence):
+    ''' Lazy list of the file names made from every combination of
+    components. Names are built when they are asked for, so a grid of
+    tens of millions of files takes no more memory than its components.
+
+    Supports len(), indexing, slicing (which returns a list) and iteration,
+    and can be passed to GSBatch or LocalBatch in place of a list of files.
+    The last component varies fastest. For example:
+
+    components = (['a','b'], [1, 2, 3])
+    files = ComponentFileList(components, file_ext='nc', join_str='_')
+
+    len(files)   -> 6
+    files[4]     -> 'b_2.nc'
+    files[1:3]   -> ['a_2.nc', 'a_3.nc']
+
+    INPUTS
+        components (list)  :: List of lists or tuples. Each element is the list
+                              of values to iterate over for that component of
+                              the file name. Values are converted to str.
+        file_ext (str)     :: Extension added to every name, without the '.'.
+                              [ Default = '' ]
+        join_str (str)     :: String placed between components. [ Default = '_' ]
+        prefix (str)       :: Directory added to the front of every name.
+                              [ Default = None ]
+    '''
+
+    def __init__(self, components, file_ext = '', join_str = '_', prefix = None):
+
+        self.components = [[str(ss) for ss in cc] for cc in components]
+        self.file_ext = file_ext
+        self.join_str = join_str
+        self.prefix = prefix
+
+        self.shape = tuple([len(cc) for cc in self.components])
+        self._n_files = int(np.prod(self.shape)) if len(self.shape) > 0 else 0
+        self._head = '' if prefix is None else path.join(prefix, '')
+        self._tail = f'.{file_ext}' if file_ext else ''
+
+    def __len__(self):
+        return self._n_files
+
+    def __getitem__(self, index):
+
+        if isinstance(index, slice):
+            return [self._name(ii) for ii in range(*index.indices(self._n_files))]
+
+        index = operator.index(index)
+        if index < 0:
+            index += self._n_files
+        if index < 0 or index >= self._n_files:
+            raise IndexError("ComponentFileList index out of range")
+
+        return self._name(index)
+
+    def __iter__(self):
+        if self._n_files == 0:
+            return iter([])
+        return (self._join(parts) for parts in itertools.product(*self.components))
+
+    def __repr__(self):
+        return (f"ComponentFileList({self._n_files} files, shape={self.shape}, "
+                f"file_ext={self.file_ext!r}, join_str={self.join_str!r}, prefix={self.prefix!r})")
+
+    def with_prefix(self, prefix):
+        ''' Return a copy with prefix joined to the front of every name '''
+        if self.prefix is not None:
+            prefix = path.join(self.prefix, prefix)
+        return ComponentFileList(self.components, self.file_ext, self.join_str, prefix)
+
+    def component_index(self, index):
+        ''' Position of file number index along each component '''
+        digits = []
+        for nn in reversed(self.shape):
+            index, rem = divmod(index, nn)
+            digits.append(rem)
+        return tuple(reversed(digits))
+
+    def _name(self, index):
+        # Mixed radix: peel off the fastest varying component first
+        parts = [cc[ii] for cc, ii in zip(self.components, self.component_index(index))]
+        return self._join(parts)
+
+    def _join(self, parts):
+        return self._head + self.join_str.join(parts) + self._tail
+
 def file_list_from_components(components, file_ext='', join_str='_'):
     ''' Create list of files from components.
     Input should be a list of lists or tuples.
     Each element of components is a list to iterate over for
     that specific component of a file name. For example:
-    
+
     component1 = ['a','b']
     component2 = [1, 2, 3]
-    component3 = ['A']
-    components = (component1, component2, component3)
-    
-    file_list_from_components(components, file_ext='nc', join_str='_') 
-    
+    components = (component1, component2)
+
+    file_list_from_components(components, file_ext='nc', join_str='_')
+
     will give:
-    
+
     ['a_1.nc', 'a_2.nc', 'a_3.nc', 'b_1.nc', 'b_2.nc', 'b_3.nc']
-    
-    NOTE even if you have a component with just one subcomponent
-    (e.g. ['.nc'] above), it should still be provided in a list.
-    
+
+    NOTE even if you have a component with just one subcomponent,
+    it should still be provided in a list.
+
+    For large grids use ComponentFileList, which gives the same names
+    without building the whole list.
     '''
 
-    n_components = len(components)
-    n_subcomponents = [len(cc) for cc in components]
-    n_files = np.prod(n_subcomponents)
-    file_list = components[0]
-
-    for ii in np.arange(1,n_components):
-        file_list = _iterate_list(file_list, n_subcomponents[ii])
-        c_ii = components[ii]
-        
-        # Convert all components to string
-        c_ii = [str(ss) for ss in c_ii]
-        
-        # Add join string to beginning of remaining components
-        c_ii = ['_' + ss for ss in c_ii]
-        
-        n_ii = n_subcomponents[ii]
-        for jj in range(len(file_list)):
-            file_list[jj] = file_list[jj] + c_ii[jj%n_ii]
-            
-    file_list = [fn + f'.{file_ext}' for fn in file_list]
-
-    return file_list
-
-def _iterate_list(inlist, it=2):
-    ''' TODO: write docstring '''
-        
-    n_elements = len(inlist)
-    new_list = ['' for ii in range(it*n_elements)]
-        
-    for ii in range(it):
-        new_list[ii::it] = inlist
-            
-    return new_list
\ No newline at end of file
+    return list(ComponentFileList(components, file_ext, join_str))
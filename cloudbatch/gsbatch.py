@@ -4,6 +4,12 @@ import os
 import os.path as path
 import glob
 from .cloudbatch import CloudBatch
+from .backends import get_backend
+from .retry import RetryPolicy
+from .cache import DiskCache
+from .filemaker import ComponentFileList
+from .staging import StagingArea
+from .shards import UnpackedShards
 
 class GSBatch(CloudBatch):
     
@@ -12,7 +18,9 @@ class GSBatch(CloudBatch):
     upload files in parallel.
     
     INPUTS
-        file_list (list)  :: List of file names or complete file paths.
+        file_list (list)  :: List of file names or complete file paths, or a
+                             ComponentFileList, which is kept lazy so only the
+                             current batch of names is built.
         file_dir (str)    :: Directory to append to front of all files in file_list.
                              [ Default = None ]
         get_dir (str)     :: Directory of where to download temporary batch files if
@@ -21,7 +29,103 @@ class GSBatch(CloudBatch):
                              Required to use .put_batch()
         source (str)      :: Either 'remote' or 'local. Signifies whether the data 
                              files to be moved will be downloaded or uploaded.
-        batch_size (int)  :: Number of files in a batch.
+        batch_size (int)  :: Number of files in a batch, or 'auto' to have
+                             apply_batch_func pick it from measured transfer
+                             and func times as the run goes (see autotune).
+        batch_bytes (int) :: If set, batch by total size instead of by count.
+                             Object sizes come from a bulk listing and batches
+                             are kept under this many bytes. batch_size is then
+                             ignored. [ Default = None ]
+        max_batch_files (int) :: Cap on the number of files in a batch when 
+                             using batch_bytes. [ Default = None ]
+        retry             :: RetryPolicy for failed transfers. Only the objects that
+                             fail are retried, with exponential backoff. Objects
+                             that still fail raise a TransferError and are listed
+                             in self.failures. [ Default = RetryPolicy() ]
+        backend           :: TransferBackend instance or one of 'gsutil', 'gcs', 
+                             'local'. If None, gs:// paths use gsutil and other
+                             paths use the local backend. [ Default = None ]
+        cache             :: DiskCache instance, or a directory to keep one in.
+                             Downloads go through the cache and are linked into
+                             get_dir, so repeated runs only fetch cache misses.
+                             [ Default = None ]
+        cache_bytes (int) :: Size cap for a cache created from a directory.
+                             Least recently used objects are evicted past it.
+                             [ Default = None ]
+        listing_cache (str) :: Directory to cache remote listings in. Wildcards
+                             in files are expanded from a cached listing when
+                             one is fresh enough, and listings used for
+                             check_files() and batch_bytes are cached too.
+                             [ Default = None ]
+        listing_ttl (float) :: Seconds a cached listing is used for.
+                             [ Default = 3600 ]
+        staging           :: Byte quota for files downloaded into get_dir. An int
+                             number of bytes, 'auto' for the free space on
+                             get_dir's disk, or a StagingArea, which can be
+                             shared between objects. Downloads wait until their
+                             objects fit, using sizes from a bulk listing, and
+                             space is released by delete_tmp_files(). The peak
+                             is in self.staging.peak_bytes. [ Default = None ]
+        staging_split (bool) :: Split any batch that is larger than the staging
+                             quota on its own into smaller batches. Otherwise
+                             such a batch raises when it is downloaded.
+                             [ Default = False ]
+        manifest          :: Manifest, or the path of its SQLite database, in
+                             which apply_batch_func records every object as its
+                             batch finishes. Objects whose func call raised
+                             (see executor) are recorded as failed, so an
+                             incremental run does them again. [ Default = None ]
+        job (str)         :: Name of the job in the manifest. [ Default = 'default' ]
+        incremental (bool) :: Only batch objects that are new, have changed or
+                             did not finish according to the manifest. The
+                             number left out is in self.n_unchanged.
+                             [ Default = False ]
+        verify (str)      :: Check every download against the object's metadata,
+                             retrying any that don't match. 'size' compares
+                             sizes. 'hash' also compares the CRC32C or MD5 hash,
+                             computed in one streamed read of the file, for
+                             objects that have one. Objects with only a CRC32C
+                             need google-crc32c or crc32c installed, and are
+                             otherwise checked on size with a warning. Sizes
+                             and hashes come from one listing for the run.
+                             [ Default = None ]
+        sync (bool)       :: put_batch() skips files whose copy in put_dir
+                             already has the same size and hash. The number
+                             skipped is in self.n_synced. [ Default = False ]
+        autotune          :: BatchAutotuner used when batch_size='auto', to set
+                             bounds on the size and other options. If None, one
+                             with default settings. [ Default = None ]
+        bundle (bool)     :: Move each batch as one shard archive (see shards.py)
+                             to save per-object overhead on many small files.
+                             With source='local', put_batch() packs the batch
+                             into <bundle_prefix><batch>.tar and uploads that.
+                             With source='remote', files are shards and their
+                             members become the tmp_files. [ Default = False ]
+        bundle_compression (str) :: None or 'zstd'. Compress each member of
+                             uploaded shards (needs zstandard). [ Default = None ]
+        bundle_extract (str) :: 'eager' extracts every member of a downloaded
+                             shard. 'lazy' gives ShardMember objects, which can
+                             be used as paths and extract the member the first
+                             time they are. [ Default = 'eager' ]
+        bundle_prefix (str) :: Start of the names of uploaded shards.
+                             [ Default = 'shard-' ]
+        materialize (str) :: 'copy' downloads every object of a batch into
+                             get_dir. 'lazy' downloads nothing up front and
+                             makes the tmp_files RemoteFile objects (see
+                             remotefile.py), seekable file objects that fetch
+                             byte ranges as func reads them, with read-ahead
+                             and a block cache. An object is only downloaded
+                             whole, into get_dir, once enough of it has been
+                             read for that to be cheaper. Staging quotas do
+                             not count these downloads. Totals of the bytes
+                             fetched against the object sizes are kept in
+                             self.remote_stats (reads made in the workers of
+                             executor='process' are not counted).
+                             [ Default = 'copy' ]
+        block_size (int)  :: Bytes per range request block with materialize='lazy'.
+                             [ Default = 4 MiB ]
+        block_cache_bytes (int) :: Most bytes of blocks each RemoteFile keeps
+                             in memory. [ Default = 256 MiB ]
         
     METHODS
     '''
@@ -32,103 +136,100 @@ class GSBatch(CloudBatch):
                  get_dir = None,
                  put_dir = None,
                  source = 'remote',
-                 batch_size=10
+                 batch_size=10,
+                 backend = None,
+                 cache = None,
+                 cache_bytes = None,
+                 batch_bytes = None,
+                 max_batch_files = None,
+                 retry = None,
+                 listing_cache = None,
+                 listing_ttl = 3600,
+                 staging = None,
+                 staging_split = False,
+                 manifest = None,
+                 job = 'default',
+                 incremental = False,
+                 verify = None,
+                 sync = False,
+                 autotune = None,
+                 bundle = False,
+                 bundle_compression = None,
+                 bundle_extract = 'eager',
+                 bundle_prefix = 'shard-',
+                 materialize = 'copy',
+                 block_size = 4 * 2**20,
+                 block_cache_bytes = 256 * 2**20
                 ):
             
+        if type(files) is str:
+            files = [files]
+            
         # Add directory to file names if wanted
         if file_dir is not None:
-            files = [path.join(file_dir, fn) for fn in files]
-        
-        # Initialise batches
-        self.current_file = 0
-        self.current_batch = 0
-        
-        n_files = len(files)
-        
-        n_batches = np.ceil( n_files / batch_size ).astype(int)
-        last_batch_size = n_files % batch_size
+            if isinstance(files, ComponentFileList):
+                files = files.with_prefix(file_dir)
+            else:
+                files = [path.join(file_dir, fn) for fn in files]
         
-        self.n_batches = n_batches
-        self.n_files = n_files
-        self.files = files
-        self.last_batch_size = last_batch_size
-        self.batch_size = batch_size
-        self.is_last_batch = False
         self.source = source
-        self.tmp_files = []
         self.get_dir = get_dir
         self.put_dir = put_dir
         
-        self._update_batch() 
+        # Use the remote side of the transfers to pick a backend
+        if source == 'remote':
+            remote_example = files[0] if len(files) > 0 else None
+        else:
+            remote_example = put_dir
+        self.backend = get_backend(backend, remote_example)
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.listing_cache = listing_cache
+        self.listing_ttl = listing_ttl
         
-        return
-    
-    def get_batch(self):  
+        if verify not in [None, 'size', 'hash']:
+            raise Exception("Unrecognised verify. Choose: verify = [None, 'size', 'hash']")
+        self.verify = verify
+        self.sync = sync
+        self.autotune = autotune
         
-        # Create get command using gsutil and run from command line
-        get_cmd = 'gsutil -m cp '
-        for ff in self.files_batch:
-            get_cmd = get_cmd + f' {ff}'
-            
-        get_cmd += f' {self.get_dir}'
-        subprocess.run(get_cmd, shell=True,
-                       stdout=subprocess.DEVNULL,
-                       stderr=subprocess.STDOUT,)
+        if bundle_extract not in ['eager', 'lazy']:
+            raise Exception("Unrecognised bundle_extract. Choose: bundle_extract = ['eager','lazy']")
+        self.bundle = bundle and source == 'local'
+        self.bundle_compression = bundle_compression
+        self.bundle_prefix = bundle_prefix
+        if bundle and source == 'remote':
+            self._unpacked = UnpackedShards(lazy = bundle_extract == 'lazy')
         
-        # Save list of current temporary files
-        got_files = []
-        for ff in self.files_batch:
-            got_files.append(path.join(self.get_dir, path.basename(ff)))
-            
-        # Check if successful
-        for fn in got_files:
-            if not path.isfile(fn):
-                self.delete_tmp_files(got_files)
-                raise Exception("Failed to download files.")
-            
-        self.tmp_files = self.tmp_files + got_files
+        if materialize not in ['copy', 'lazy']:
+            raise Exception("Unrecognised materialize. Choose: materialize = ['copy','lazy']")
+        if materialize == 'lazy' and (bundle or cache is not None):
+            raise Exception("materialize='lazy' reads objects in place, so it cannot be used with bundle or cache.")
+        self.materialize = materialize if source == 'remote' else 'copy'
+        self.block_size = block_size
+        self.block_cache_bytes = block_cache_bytes
         
-    def put_batch(self):  
-        put_cmd = f'gsutil -m cp '
-        for ff in self.files_batch:
-            put_cmd = put_cmd + f' {ff}'
-        put_cmd += f' {self.put_dir}'
-        subprocess.run(put_cmd, shell=True,
-                       stdout=subprocess.DEVNULL,
-                       stderr=subprocess.STDOUT,)
-        return
+        if cache is not None and not isinstance(cache, DiskCache):
+            cache = DiskCache(cache, max_bytes = cache_bytes)
+        self.cache = cache
         
-    def check_files(self):
+        # Expand any wildcards. Component lists are left lazy.
+        if not isinstance(files, ComponentFileList):
+            files = self._expand_wildcards(files, source)
+            
+        files = self._use_manifest(files, manifest, job, incremental)
         
-        checked = np.zeros(self.n_files)
-        for ii in range(self.n_files):
-            if self.source == 'remote':
-                checked[ii] = self._gsstat(self.files[ii])
-            elif self.source == 'local':
-                checked[ii] = self._localstat(self.files[ii])
-            print(ii, self.n_files, checked[ii])
-                
-        self.file_exists = checked
-    
-    def _gsls(self, path):
+        self._init_batches(files, batch_size, batch_bytes, max_batch_files)
         
-        cmd = f"gsutil ls {path}"
-        output = subprocess.check_output(cmd, shell=True)
-        output = str(output)[2:-1]
+        if staging == 'auto':
+            staging = StagingArea(get_dir = get_dir)
+        elif staging is not None and not isinstance(staging, StagingArea):
+            staging = StagingArea(max_bytes = staging)
+        self.staging = staging
         
-        output_split = output.split('\\n')[:-1]
+        if staging is not None and source == 'remote':
+            if staging_split:
+                self._split_for_staging()
+            elif self.file_sizes is None:
+                self.get_file_sizes()
         
-        return output_split
-    
-    def _gsstat(self, path):
-        cmd = f"gsutil stat {path}"
-        try:
-            output = subprocess.check_output(cmd, shell=True)
-            if output[:2] == 'No':
-                return False
-            else:
-                return True
-        except:
-            return False
-            
-        
\ No newline at end of file
+        return
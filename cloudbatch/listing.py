@@ -0,0 +1,200 @@
+import hashlib
+import os
+import os.path as path
+import pickle
+import time
+from .backends import _walk_pattern, _split_level
+
+class Lister():
+    '''
+    Lists objects matching wildcard patterns, with metadata, through a
+    TransferBackend.
+
+    Like `gsutil ls`, each level of a pattern up to any ** is listed with a
+    / delimiter (the backend's list_level()), following only the
+    subdirectories that match, so gs://bucket/dir/*.nc lists dir/ alone and
+    gs://bucket/*/2020/*.nc only lists the 2020 directories and the top
+    level. Directory levels are listed once however many patterns share
+    them. From a ** on, everything under the literal prefix is listed
+    recursively, streamed from the backend's iter_prefix() a page at a time.
+
+    If cache_dir is given, every complete listing is also written to disk
+    and reused for ttl seconds, including for any narrower listing that
+    falls inside it, so rebuilding a batch over the same objects does not
+    list them again.
+
+    INPUTS
+        backend          :: TransferBackend to list through.
+        cache_dir (str)  :: Directory for cached listings. None disables the
+                            cache. [ Default = None ]
+        ttl (float)      :: Seconds a cached listing stays valid. [ Default = 3600 ]
+
+    Example
+
+        lister = Lister(GSUtilBackend(), cache_dir = '~/.cache/cloudbatch/listings')
+        files, = lister.expand(['gs://bucket/data/*.nc'])
+    '''
+
+    fields = ['path', 'size', 'mtime', 'generation', 'md5', 'crc32c']
+    chunk_size = 10000
+
+    def __init__(self, backend, cache_dir = None, ttl = 3600):
+        self.backend = backend
+        self.cache_dir = None if cache_dir is None else path.expanduser(cache_dir)
+        self.ttl = ttl
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok = True)
+
+    def list_info(self, pattern):
+        ''' Metadata dictionary (see TransferBackend.stat()) for every object
+        matching pattern, in listing order '''
+        return self.expand_info([pattern])[0]
+
+    def list(self, pattern):
+        return [info['path'] for info in self.list_info(pattern)]
+
+    def expand(self, patterns):
+        ''' List of matching paths for each pattern in patterns '''
+        return [[info['path'] for info in infos] for infos in self.expand_info(patterns)]
+
+    def expand_info(self, patterns):
+        ''' List of matching metadata dictionaries for each pattern in patterns.
+        Every directory level is listed once. '''
+
+        levels = {}
+        def list_level(prefix):
+            # Reuse a listing of the same level that covers prefix
+            base = prefix[:prefix.rfind('/') + 1]
+            for done, (infos, subdirs) in levels.items():
+                if prefix.startswith(done) and done.startswith(base):
+                    return ([info for info in infos if info['path'].startswith(prefix)],
+                            [ss for ss in subdirs if ss.startswith(prefix)])
+            levels[prefix] = self.list_level(prefix)
+            return levels[prefix]
+
+        return [list(_walk_pattern(pp, list_level, self.iter_prefix)) for pp in patterns]
+
+    def list_level(self, prefix):
+        ''' (infos, subdirs) for one directory level (see
+        TransferBackend.list_level()), from the cache if possible '''
+
+        if self.cache_dir is None:
+            return self.backend.list_level(prefix)
+
+        cached = self._lookup(prefix, level = True)
+        if cached is not None:
+            header = self._header(cached)
+            if header.get('level', False):
+                infos = [info for info in self._read(cached) if info['path'].startswith(prefix)]
+                return infos, [ss for ss in header['subdirs'] if ss.startswith(prefix)]
+            return _split_level(prefix, self._read(cached))
+
+        infos, subdirs = self.backend.list_level(prefix)
+        for _ in self._write_cache(prefix, infos, level = True, subdirs = subdirs):
+            pass
+        return infos, subdirs
+
+    def iter_prefix(self, prefix):
+        ''' Generator of metadata for every object under prefix, from the
+        cache if possible '''
+
+        if self.cache_dir is None:
+            yield from self.backend.iter_prefix(prefix)
+            return
+
+        cached = self._lookup(prefix)
+        if cached is not None:
+            for info in self._read(cached):
+                if info['path'].startswith(prefix):
+                    yield info
+            return
+
+        yield from self._list_and_cache(prefix)
+
+    def clear(self):
+        ''' Remove every cached listing '''
+        if self.cache_dir is None:
+            return
+        for fn in os.listdir(self.cache_dir):
+            if fn.endswith('.listing') or fn.endswith('.tmp'):
+                os.remove(path.join(self.cache_dir, fn))
+
+    def _list_and_cache(self, prefix):
+        ''' Stream a listing from the backend, writing it to the cache as it
+        goes '''
+        yield from self._write_cache(prefix, self.backend.iter_prefix(prefix))
+
+    def _write_cache(self, prefix, infos, level = False, subdirs = None):
+        ''' Pass infos through, writing them to the cache as they go. The
+        cache file only appears once the listing is complete. level marks a
+        listing of one directory level, with its subdirectories. '''
+
+        final = self._cache_file(prefix, level)
+        tmp = f'{final}.{os.getpid()}.tmp'
+        complete = False
+        try:
+            with open(tmp, 'wb') as fh:
+                pickle.dump({'prefix' : prefix, 'time' : time.time(), 'fields' : self.fields,
+                             'level' : level, 'subdirs' : subdirs}, fh)
+                chunk = []
+                for info in infos:
+                    chunk.append(tuple([info.get(ff) for ff in self.fields]))
+                    if len(chunk) >= self.chunk_size:
+                        pickle.dump(chunk, fh)
+                        chunk = []
+                    yield info
+                pickle.dump(chunk, fh)
+                # Marks the listing as complete
+                pickle.dump(None, fh)
+            os.replace(tmp, final)
+            complete = True
+        finally:
+            if not complete and path.exists(tmp):
+                os.remove(tmp)
+
+    def _lookup(self, prefix, level = False):
+        ''' Path of a fresh cached listing covering prefix, or None. With
+        level, listings of the same directory level also count. '''
+
+        now = time.time()
+        best = None
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith('.listing'):
+                continue
+            fp = path.join(self.cache_dir, fn)
+            try:
+                header = self._header(fp)
+            except Exception:
+                continue
+            if now - header['time'] > self.ttl:
+                continue
+            if header.get('level', False):
+                # Only covers its own directory level
+                rest = prefix[len(header['prefix']):]
+                if not level or not prefix.startswith(header['prefix']) or '/' in rest:
+                    continue
+            if prefix.startswith(header['prefix']):
+                # Prefer the narrowest listing
+                if best is None or len(header['prefix']) > len(best[0]):
+                    best = (header['prefix'], fp)
+
+        return None if best is None else best[1]
+
+    def _header(self, fp):
+        with open(fp, 'rb') as fh:
+            return pickle.load(fh)
+
+    def _read(self, fp):
+        with open(fp, 'rb') as fh:
+            header = pickle.load(fh)
+            fields = header['fields']
+            while True:
+                chunk = pickle.load(fh)
+                if chunk is None:
+                    return
+                for row in chunk:
+                    yield dict(zip(fields, row))
+
+    def _cache_file(self, prefix, level = False):
+        key = hashlib.sha1((('level:' if level else '') + prefix).encode('utf-8')).hexdigest()
+        return path.join(self.cache_dir, f'{key}.listing')
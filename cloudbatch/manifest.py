@@ -0,0 +1,144 @@
+import os
+import os.path as path
+import sqlite3
+import threading
+import time
+import numpy as np
+
+class Manifest():
+    '''
+    SQLite record of the objects each named job has processed.
+
+    There is one row per job and object path, holding the object's size,
+    generation and modification time when it was processed and its status
+    ('done' or 'failed'). Comparing a fresh listing with these rows gives
+    the objects that are new, have changed or were not finished, which is
+    what GSBatch(incremental=True) batches up. apply_batch_func marks the
+    objects of each batch as it finishes.
+
+    An object counts as changed if its size differs, or its generation
+    differs. Objects with no generation are compared on modification time
+    instead.
+
+    INPUTS
+        filename (str)  :: Path of the SQLite database. Created if missing.
+        job (str)       :: Name of the job. Each job keeps its own status for
+                           every object, so several jobs can share one
+                           manifest. [ Default = 'default' ]
+
+    Example
+
+        gsb = GSBatch('gs://bucket/data/*.nc', get_dir='tmp',
+                      manifest='manifest.db', job='nightly', incremental=True)
+    '''
+
+    def __init__(self, filename, job = 'default'):
+        self.filename = path.expanduser(filename)
+        self.job = job
+        self._lock = threading.Lock()
+
+        dn = path.dirname(self.filename)
+        if dn != '':
+            os.makedirs(dn, exist_ok = True)
+
+        # Batches can finish in background threads
+        self._conn = sqlite3.connect(self.filename, check_same_thread = False)
+        # Each batch is a small transaction, so avoid a full sync for each
+        self._conn.execute('PRAGMA journal_mode = WAL')
+        self._conn.execute('PRAGMA synchronous = NORMAL')
+        with self._lock, self._conn:
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS objects (
+                                      job TEXT NOT NULL,
+                                      path TEXT NOT NULL,
+                                      size INTEGER,
+                                      generation TEXT,
+                                      mtime TEXT,
+                                      status TEXT NOT NULL,
+                                      batch INTEGER,
+                                      updated REAL,
+                                      PRIMARY KEY (job, path))''')
+
+    def changed(self, infos):
+        ''' Boolean array, True for each object in infos (metadata
+        dictionaries, see TransferBackend.stat()) that is not recorded as
+        done with the same size and generation or mtime. '''
+
+        if len(infos) == 0:
+            return np.zeros(0, dtype=bool)
+
+        with self._lock, self._conn:
+            conn = self._conn
+            conn.execute('''CREATE TEMP TABLE IF NOT EXISTS listing (
+                                idx INTEGER PRIMARY KEY, path TEXT, size INTEGER,
+                                generation TEXT, mtime TEXT)''')
+            conn.execute('DELETE FROM listing')
+            conn.executemany('INSERT INTO listing VALUES (?, ?, ?, ?, ?)',
+                             ((ii,) + _row(info) for ii, info in enumerate(infos)))
+            rows = conn.execute('''SELECT l.idx FROM listing l
+                                   LEFT JOIN objects o ON o.job = ? AND o.path = l.path
+                                   WHERE o.path IS NULL
+                                      OR o.status != 'done'
+                                      OR o.size IS NOT l.size
+                                      OR (l.generation IS NOT NULL AND o.generation IS NOT l.generation)
+                                      OR (l.generation IS NULL AND o.mtime IS NOT l.mtime)''',
+                                (self.job,)).fetchall()
+            conn.execute('DELETE FROM listing')
+
+        out = np.zeros(len(infos), dtype=bool)
+        out[[rr[0] for rr in rows]] = True
+        return out
+
+    def mark(self, infos, status = 'done', batch_index = None):
+        ''' Record the status of objects, given their metadata dictionaries '''
+
+        now = time.time()
+        batch_index = None if batch_index is None else int(batch_index)
+        with self._lock, self._conn:
+            self._conn.executemany('''INSERT OR REPLACE INTO objects
+                                      (job, path, size, generation, mtime, status, batch, updated)
+                                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                   ((self.job,) + _row(info) + (status, batch_index, now) for info in infos))
+
+    def status(self, paths = None):
+        ''' Dictionary of path to status for this job, for every recorded
+        object or just those in paths '''
+
+        with self._lock:
+            rows = self._conn.execute('SELECT path, status FROM objects WHERE job = ?',
+                                      (self.job,)).fetchall()
+        status = dict(rows)
+        if paths is None:
+            return status
+        return {pp : status[pp] for pp in paths if pp in status}
+
+    def summary(self):
+        ''' Number of objects with each status for this job '''
+        with self._lock:
+            rows = self._conn.execute('SELECT status, COUNT(*) FROM objects WHERE job = ? GROUP BY status',
+                                      (self.job,)).fetchall()
+        return dict(rows)
+
+    def forget(self, paths = None):
+        ''' Remove objects from this job's record, or every object if paths
+        is None, so they are processed again '''
+        with self._lock, self._conn:
+            if paths is None:
+                self._conn.execute('DELETE FROM objects WHERE job = ?', (self.job,))
+            else:
+                self._conn.executemany('DELETE FROM objects WHERE job = ? AND path = ?',
+                                       ((self.job, pp) for pp in paths))
+
+    def close(self):
+        self._conn.close()
+
+def _row(info):
+    ''' (path, size, generation, mtime) for the manifest from a metadata
+    dictionary. Generations and times are stored as text, as they come in
+    different types from different backends. '''
+    size = info.get('size')
+    generation = info.get('generation')
+    mtime = info.get('mtime')
+    return (info['path'],
+            None if size is None else int(size),
+            None if generation is None else str(generation),
+            None if mtime is None else str(mtime))
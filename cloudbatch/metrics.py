@@ -0,0 +1,239 @@
+import sys
+import threading
+import time
+import numpy as np
+
+class Callback():
+    '''
+    Base class for hooks into apply_batch_func. Override any of the methods.
+    Plain functions can also be passed as callbacks, in which case they are
+    called as on_batch_end(record).
+    '''
+
+    def on_run_start(self, n_batches):
+        pass
+
+    def on_batch_start(self, batch_index):
+        pass
+
+    def on_batch_end(self, record):
+        pass
+
+    def on_rebatch(self, n_batches):
+        pass
+
+    def on_run_end(self, stats):
+        pass
+
+class BatchStats():
+    '''
+    Per-batch timings and throughput for a run of apply_batch_func, available
+    as app.stats.
+
+    For each batch a record is kept with:
+
+        batch        :: Batch index.
+        n_files      :: Number of files in the batch.
+        get_s        :: Seconds spent downloading. With prefetch this is the
+                        time the background download took.
+        get_wait_s   :: Seconds the main loop waited for the download.
+        apply_s      :: Seconds spent applying func to the batch.
+        put_s        :: Seconds spent uploading.
+        delete_s     :: Seconds spent deleting temporary files.
+        bytes_in     :: Bytes downloaded.
+        bytes_out    :: Bytes uploaded.
+        func_mean_s  :: Mean seconds per func call.
+        func_max_s   :: Slowest func call in seconds.
+        wall_s       :: Seconds from the start of the batch to when it finished.
+        files_per_s  :: n_files / wall_s.
+        failed       :: True if the batch was skipped because of a transfer error.
+
+    Records can be exported with to_records() (a list of dicts) or
+    to_arrays() (a dict of numpy arrays, e.g. for pandas.DataFrame()).
+    Per-file func latencies are in func_latencies().
+    '''
+
+    fields = ['batch', 'n_files', 'get_s', 'get_wait_s', 'apply_s', 'put_s',
+              'delete_s', 'bytes_in', 'bytes_out', 'func_mean_s', 'func_max_s',
+              'wall_s', 'files_per_s', 'failed']
+
+    def __init__(self, callbacks = None):
+        self.records = {}
+        self.finished = []
+        self.callbacks = [] if callbacks is None else list(callbacks)
+        self.n_batches = 0
+        self.start_time = None
+        self._latencies = {}
+        self._started = {}
+        self._lock = threading.Lock()
+
+    def run_start(self, n_batches):
+        self.n_batches = n_batches
+        self.start_time = time.perf_counter()
+        self._call('on_run_start', n_batches)
+
+    def run_end(self):
+        self._call('on_run_end', self)
+
+    def rebatch(self, n_batches):
+        ''' The number of batches changed part way through the run '''
+        self.n_batches = n_batches
+        self._call('on_rebatch', n_batches)
+
+    def batch_start(self, batch_index):
+        with self._lock:
+            self._record(batch_index)
+            self._started[batch_index] = time.perf_counter()
+        self._call('on_batch_start', batch_index)
+
+    def add(self, batch_index, key, value):
+        ''' Add value to field key of a batch record. Thread safe. '''
+        with self._lock:
+            rec = self._record(batch_index)
+            rec[key] = rec[key] + value
+
+    def set(self, batch_index, key, value):
+        with self._lock:
+            self._record(batch_index)[key] = value
+
+    def add_latencies(self, batch_index, latencies):
+        latencies = np.asarray(latencies, dtype=float)
+        with self._lock:
+            self._latencies[batch_index] = latencies
+            rec = self._record(batch_index)
+            if len(latencies) > 0:
+                rec['func_mean_s'] = float(np.mean(latencies))
+                rec['func_max_s'] = float(np.max(latencies))
+
+    def batch_end(self, batch_index, failed = False):
+        ''' Close a batch record and pass it to the callbacks '''
+        with self._lock:
+            rec = self._record(batch_index)
+            started = self._started.pop(batch_index, None)
+            if started is not None:
+                rec['wall_s'] = time.perf_counter() - started
+            if rec['wall_s'] > 0:
+                rec['files_per_s'] = rec['n_files'] / rec['wall_s']
+            rec['failed'] = failed
+            self.finished.append(batch_index)
+            rec = dict(rec)
+        self._call('on_batch_end', rec)
+
+    def timer(self, batch_index, key):
+        ''' Context manager adding the time spent inside it to field key '''
+        return _Timer(self, batch_index, key)
+
+    def to_records(self):
+        return [dict(self.records[bb]) for bb in sorted(self.records)]
+
+    def to_arrays(self):
+        records = self.to_records()
+        return {ff : np.array([rec[ff] for rec in records]) for ff in self.fields}
+
+    def func_latencies(self):
+        ''' Seconds taken by every func call, in batch order '''
+        if len(self._latencies) == 0:
+            return np.array([])
+        return np.concatenate([self._latencies[bb] for bb in sorted(self._latencies)])
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0
+        return time.perf_counter() - self.start_time
+
+    def totals(self):
+        ''' Sum of every numeric field over all batches, plus overall rates '''
+        arrays = self.to_arrays()
+        out = {ff : float(np.sum(arrays[ff])) for ff in ['n_files', 'get_s', 'get_wait_s', 'apply_s',
+                                                         'put_s', 'delete_s', 'bytes_in', 'bytes_out']}
+        elapsed = self.elapsed()
+        out['elapsed_s'] = elapsed
+        out['files_per_s'] = out['n_files'] / elapsed if elapsed > 0 else 0
+        out['mb_per_s'] = (out['bytes_in'] + out['bytes_out']) / elapsed / 1e6 if elapsed > 0 else 0
+        return out
+
+    def _record(self, batch_index):
+        if batch_index not in self.records:
+            rec = {ff : 0 for ff in self.fields}
+            rec['batch'] = batch_index
+            rec['failed'] = False
+            self.records[batch_index] = rec
+        return self.records[batch_index]
+
+    def _call(self, hook, arg):
+        for cb in self.callbacks:
+            if isinstance(cb, Callback):
+                getattr(cb, hook)(arg)
+            elif hook == 'on_batch_end':
+                cb(arg)
+
+class _Timer():
+
+    def __init__(self, stats, batch_index, key):
+        self.stats = stats
+        self.batch_index = batch_index
+        self.key = key
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stats.add(self.batch_index, self.key, time.perf_counter() - self.t0)
+
+class ProgressReporter(Callback):
+    '''
+    Prints a single updating line with the percentage done, throughput and
+    estimated time left. Used by apply_batch_func when progress = True.
+    '''
+
+    def __init__(self, stream = None):
+        self.stream = stream
+        self.stats = None
+
+    def on_run_start(self, n_batches):
+        self.n_batches = n_batches
+        self.n_done = 0
+        self.n_files = 0
+        self.n_bytes = 0
+        self.t0 = time.perf_counter()
+        self._print()
+
+    def on_batch_end(self, record):
+        self.n_done += 1
+        self.n_files += record['n_files']
+        self.n_bytes += record['bytes_in'] + record['bytes_out']
+        self._print()
+
+    def on_rebatch(self, n_batches):
+        self.n_batches = n_batches
+
+    def on_run_end(self, stats):
+        self._write('\n')
+
+    def _print(self):
+        elapsed = time.perf_counter() - self.t0
+        # Can pass 100% when batches are taken over from other workers
+        percent_done = min(100, 100 * self.n_done / self.n_batches) if self.n_batches > 0 else 100
+        line = f"Progress: {percent_done:5.1f}% ({self.n_done}/{self.n_batches} batches)"
+        if self.n_done > 0 and elapsed > 0:
+            eta = elapsed / self.n_done * max(0, self.n_batches - self.n_done)
+            line += (f" | {self.n_files / elapsed:.1f} files/s"
+                     f" | {self.n_bytes / elapsed / 1e6:.1f} MB/s"
+                     f" | ETA {_format_seconds(eta)}")
+        self._write(line + ' ' * 4 + '\r')
+
+    def _write(self, text):
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write(text)
+        stream.flush()
+
+def _format_seconds(seconds):
+    seconds = int(round(seconds))
+    hours, rem = divmod(seconds, 3600)
+    minutes, secs = divmod(rem, 60)
+    if hours > 0:
+        return f"{hours}h{minutes:02d}m{secs:02d}s"
+    if minutes > 0:
+        return f"{minutes}m{secs:02d}s"
+    return f"{secs}s"
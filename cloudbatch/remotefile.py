@@ -0,0 +1,255 @@
+import io
+import os
+import os.path as path
+import threading
+from collections import OrderedDict
+from .retry import RetryPolicy, TransferError
+
+class RemoteFile(io.RawIOBase):
+    '''
+    Read-only, seekable file object for a remote object that fetches byte
+    ranges as they are read instead of downloading the whole object. Used as
+    the tmp_files of a GSBatch with materialize='lazy', so func can open
+    e.g. one variable of a large NetCDF or HDF5 file (h5py, h5netcdf and
+    xarray accept file objects) and only the blocks it touches are moved.
+
+    The object is read in blocks of block_size, kept in a least recently
+    used cache of up to cache_bytes. Reads that carry on from where the last
+    one stopped are treated as sequential and fetch a growing number of
+    blocks ahead, in one request. Once the bytes fetched reach
+    full_fraction of the object (and for objects of no more than two blocks
+    straight away), the rest is no longer worth fetching piece by piece and
+    the whole object is downloaded into local_dir and read from there.
+
+    Range requests are retried with the RetryPolicy, raising a TransferError
+    if they keep failing. A RemoteFile can be pickled, e.g. to send it to a
+    process pool, and arrives closed to its cache and at position 0.
+
+    INPUTS
+        remote_path (str)     :: Path of the object.
+        size (int)            :: Size of the object in bytes.
+        backend               :: TransferBackend with read_range().
+        block_size (int)      :: Bytes per block. [ Default = 4 MiB ]
+        cache_bytes (int)     :: Most bytes of blocks kept in memory.
+                                 [ Default = 256 MiB ]
+        local_dir (str)       :: Where to download the whole object. If None,
+                                 objects are never downloaded whole.
+                                 [ Default = None ]
+        full_fraction (float) :: Share of the object fetched after which it is
+                                 downloaded whole. [ Default = 0.5 ]
+        retry                 :: RetryPolicy for range requests. [ Default = RetryPolicy() ]
+
+    ATTRIBUTES
+        bytes_fetched (int)   :: Bytes moved so far, including any full download.
+        n_requests (int)      :: Number of range requests and downloads made.
+        materialized (bool)   :: Whether the whole object has been downloaded.
+    '''
+
+    max_readahead = 16
+
+    def __init__(self, remote_path, size, backend, block_size = 4 * 2**20,
+                 cache_bytes = 256 * 2**20, local_dir = None, full_fraction = 0.5,
+                 retry = None):
+        super().__init__()
+        self.name = remote_path
+        self.remote_path = remote_path
+        self.size = int(size)
+        self.backend = backend
+        self.block_size = int(block_size)
+        self.cache_bytes = cache_bytes
+        self.local_dir = local_dir
+        self.full_fraction = full_fraction
+        self.retry = retry if retry is not None else RetryPolicy()
+
+        self.bytes_fetched = 0
+        self.n_requests = 0
+        self.materialized = False
+        self.local_path = None
+
+        self._n_blocks = (self.size + self.block_size - 1) // self.block_size
+        self._blocks = OrderedDict()
+        self._max_blocks = max(1, int(cache_bytes // self.block_size))
+        self._pos = 0
+        self._next_sequential = None
+        self._readahead = 0
+        self._local = None
+        self._lock = threading.RLock()
+
+    def __reduce__(self):
+        return (RemoteFile, (self.remote_path, self.size, self.backend, self.block_size,
+                             self.cache_bytes, self.local_dir, self.full_fraction, self.retry))
+
+    def __repr__(self):
+        return (f"RemoteFile({self.remote_path!r}, size={self.size}, "
+                f"fetched={self.bytes_fetched}, materialized={self.materialized})")
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence {whence}")
+        if pos < 0:
+            raise ValueError("Negative seek position")
+        self._pos = pos
+        return pos
+
+    def readinto(self, buffer):
+        if self.closed:
+            raise ValueError("I/O operation on closed file.")
+
+        with self._lock:
+            start = self._pos
+            n_bytes = min(len(buffer), self.size - start)
+            if n_bytes <= 0:
+                return 0
+            out = memoryview(buffer).cast('B')
+
+            # Grow read-ahead while reads carry on from the last one
+            if start == self._next_sequential:
+                self._readahead = min(self.max_readahead, max(1, 2 * self._readahead))
+            else:
+                self._readahead = 0
+
+            if self._local is None and self._worth_downloading(n_bytes + self._readahead * self.block_size):
+                self.materialize()
+            if self._local is not None:
+                self._local.seek(start)
+                got = self._local.readinto(out[:n_bytes])
+                self._pos = start + got
+                return got
+
+            first = start // self.block_size
+            last = (start + n_bytes - 1) // self.block_size
+            self._fetch(first, min(last + self._readahead, self._n_blocks - 1), keep = range(first, last + 1))
+
+            written = 0
+            for bb in range(first, last + 1):
+                block = self._blocks[bb]
+                self._blocks.move_to_end(bb)
+                lo = max(start, bb * self.block_size) - bb * self.block_size
+                hi = min(start + n_bytes, (bb + 1) * self.block_size) - bb * self.block_size
+                out[written:written + hi - lo] = block[lo:hi]
+                written += hi - lo
+
+            self._pos = start + written
+            self._next_sequential = self._pos
+            return written
+
+    def readall(self):
+        return self.read(max(0, self.size - self._pos))
+
+    def materialize(self):
+        ''' Download the whole object into local_dir and read from there.
+        Returns the local path. '''
+
+        with self._lock:
+            if self._local is not None:
+                return self.local_path
+            if self.local_dir is None:
+                raise Exception("RemoteFile needs a local_dir to download the whole object.")
+
+            policy = self.retry
+            target = self.backend._local_targets([self.remote_path], self.local_dir)[0]
+            for attempt in range(policy.max_attempts):
+                if attempt > 0:
+                    policy.sleep(attempt - 1)
+                self.n_requests += 1
+                self.backend.get([self.remote_path], self.local_dir)
+                if path.isfile(target) and path.getsize(target) == self.size:
+                    break
+            else:
+                raise TransferError(f"Failed to get 1 files after retrying.",
+                                    [{'path' : self.remote_path, 'op' : 'get',
+                                      'attempts' : policy.max_attempts,
+                                      'error' : 'object was not downloaded'}])
+
+            self.bytes_fetched += self.size
+            self.local_path = target
+            self._local = open(target, 'rb')
+            self._blocks.clear()
+            self.materialized = True
+            return target
+
+    def close(self):
+        ''' Close the handle, dropping the block cache and any downloaded copy '''
+        if self.closed:
+            return
+        with self._lock:
+            self._blocks.clear()
+            if self._local is not None:
+                self._local.close()
+                self._local = None
+                try:
+                    os.remove(self.local_path)
+                except OSError:
+                    pass
+        super().close()
+
+    def _worth_downloading(self, n_bytes):
+        if self.local_dir is None:
+            return False
+        if self._n_blocks <= 2:
+            return True
+        return self.bytes_fetched + n_bytes >= self.full_fraction * self.size
+
+    def _fetch(self, first, last, keep):
+        ''' Make sure blocks first to last are cached, fetching each run of
+        missing blocks with one range request '''
+
+        missing = [bb for bb in range(first, last + 1) if bb not in self._blocks]
+        runs = []
+        for bb in missing:
+            if len(runs) > 0 and runs[-1][1] == bb - 1:
+                runs[-1][1] = bb
+            else:
+                runs.append([bb, bb])
+
+        for lo, hi in runs:
+            start = lo * self.block_size
+            length = min(self.size, (hi + 1) * self.block_size) - start
+            data = self._read_range(start, length)
+            for bb in range(lo, hi + 1):
+                offset = bb * self.block_size - start
+                self._blocks[bb] = data[offset:offset + self.block_size]
+
+        # Evict the least recently used blocks, never the ones being read
+        keep = set(keep)
+        for bb in list(self._blocks):
+            if len(self._blocks) <= self._max_blocks:
+                break
+            if bb not in keep:
+                del self._blocks[bb]
+
+    def _read_range(self, start, length):
+        policy = self.retry
+        error = None
+        for attempt in range(policy.max_attempts):
+            if attempt > 0:
+                policy.sleep(attempt - 1)
+            self.n_requests += 1
+            try:
+                data = self.backend.read_range(self.remote_path, start, length)
+            except Exception as err:
+                error = err
+                continue
+            if len(data) == length:
+                self.bytes_fetched += length
+                return data
+            error = f"got {len(data)} of {length} bytes"
+
+        raise TransferError(f"Failed to read bytes {start}-{start + length - 1} of {self.remote_path} after retrying.",
+                            [{'path' : self.remote_path, 'op' : 'get',
+                              'attempts' : policy.max_attempts, 'error' : str(error)}])
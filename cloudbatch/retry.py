@@ -0,0 +1,48 @@
+import random
+import time
+
+class RetryPolicy():
+    '''
+    How to retry failed object transfers.
+
+    Each failed attempt waits for a random time between 0 and
+    min(max_delay, base_delay * 2**attempt) seconds ("full jitter"
+    exponential backoff) before only the objects that failed are tried again.
+
+    INPUTS
+        max_attempts (int)   :: Total number of tries per object, including the
+                                first. 1 disables retries. [ Default = 5 ]
+        base_delay (float)   :: Backoff after the first failure, in seconds.
+                                [ Default = 1 ]
+        max_delay (float)    :: Cap on the backoff, in seconds. [ Default = 60 ]
+        jitter (bool)        :: Randomise the backoff. [ Default = True ]
+    '''
+
+    def __init__(self, max_attempts = 5, base_delay = 1, max_delay = 60, jitter = True):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        ''' Seconds to wait after failed attempt number attempt (from 0) '''
+        cap = min(self.max_delay, self.base_delay * 2 ** attempt)
+        if self.jitter:
+            return random.uniform(0, cap)
+        return cap
+
+    def sleep(self, attempt):
+        time.sleep(self.delay(attempt))
+
+class TransferError(Exception):
+    '''
+    Raised when some objects could not be transferred after every retry.
+
+    ATTRIBUTES
+        failures (list)  :: One dictionary per object with keys 'path', 'op'
+                            ('get' or 'put'), 'attempts' and 'error'.
+    '''
+
+    def __init__(self, message, failures):
+        super().__init__(message)
+        self.failures = failures
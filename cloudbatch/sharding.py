@@ -0,0 +1,165 @@
+import os
+import re
+import socket
+import time
+import uuid
+from .backends import get_backend, _join_remote
+
+# Environment variables giving the index of this worker and the number of
+# workers, in order of preference. None means the count has to come from
+# CLOUDBATCH_NUM_SHARDS.
+_SHARD_ENV = [('CLOUDBATCH_SHARD_INDEX', 'CLOUDBATCH_NUM_SHARDS'),
+              ('BATCH_TASK_INDEX', 'BATCH_TASK_COUNT'),
+              ('SLURM_ARRAY_TASK_ID', 'SLURM_ARRAY_TASK_COUNT'),
+              ('JOB_COMPLETION_INDEX', None),
+              ('AWS_BATCH_JOB_ARRAY_INDEX', None)]
+
+def shard_from_env(environ = None):
+    ''' Return (shard_index, num_shards) from the environment.
+
+    Understands CLOUDBATCH_SHARD_INDEX / CLOUDBATCH_NUM_SHARDS, Google Batch
+    (BATCH_TASK_INDEX / BATCH_TASK_COUNT), Slurm job arrays
+    (SLURM_ARRAY_TASK_ID / SLURM_ARRAY_TASK_COUNT, offset by
+    SLURM_ARRAY_TASK_MIN), Kubernetes indexed jobs (JOB_COMPLETION_INDEX) and
+    AWS Batch array jobs (AWS_BATCH_JOB_ARRAY_INDEX). Where the scheduler does
+    not give the number of workers, set CLOUDBATCH_NUM_SHARDS. Returns (0, 1)
+    if none are set. '''
+
+    env = os.environ if environ is None else environ
+
+    for index_var, count_var in _SHARD_ENV:
+        if index_var not in env:
+            continue
+        shard_index = int(env[index_var])
+        if index_var == 'SLURM_ARRAY_TASK_ID':
+            shard_index -= int(env.get('SLURM_ARRAY_TASK_MIN', 0))
+        if count_var is not None and count_var in env:
+            num_shards = int(env[count_var])
+        elif 'CLOUDBATCH_NUM_SHARDS' in env:
+            num_shards = int(env['CLOUDBATCH_NUM_SHARDS'])
+        else:
+            raise Exception(f"{index_var} is set but the number of shards is not. Set CLOUDBATCH_NUM_SHARDS.")
+        return _check_shard(shard_index, num_shards)
+
+    return 0, 1
+
+def shard_batches(n_batches, shard_index = None, num_shards = None):
+    ''' Batch indices belonging to one shard. Batches are dealt out round
+    robin, so shard i gets batches i, i + num_shards, ... If shard_index and
+    num_shards are None they come from the environment (see shard_from_env()). '''
+
+    if shard_index is None and num_shards is None:
+        shard_index, num_shards = shard_from_env()
+    elif shard_index is None or num_shards is None:
+        raise Exception("Set both shard_index and num_shards, or neither.")
+    shard_index, num_shards = _check_shard(shard_index, num_shards)
+
+    return list(range(shard_index, n_batches, num_shards))
+
+def _check_shard(shard_index, num_shards):
+    shard_index = int(shard_index)
+    num_shards = int(num_shards)
+    if num_shards < 1 or shard_index < 0 or shard_index >= num_shards:
+        raise Exception(f"Invalid shard {shard_index} of {num_shards}. Need 0 <= shard_index < num_shards.")
+    return shard_index, num_shards
+
+class BatchLeases():
+    '''
+    Lease files in a shared directory or bucket that let workers take over
+    each other's batches.
+
+    Before processing a batch a worker creates the lease file
+    b<batch>.<attempt>.lease, which only succeeds for one worker (see
+    TransferBackend.create_exclusive()). Once the batch is done the worker
+    writes b<batch>.done. A lease that is still not done ttl seconds after
+    this worker first saw it is treated as abandoned (e.g. a preempted VM)
+    and the batch is claimed again with the next attempt number. Using the
+    time a lease was first seen means clocks don't need to agree between
+    machines. Use a fresh lease_dir for each job, as batches marked done by
+    an earlier job are skipped.
+
+    INPUTS
+        lease_dir (str)        :: Shared directory or bucket path for leases.
+        backend                :: TransferBackend or name. If None, chosen from
+                                  lease_dir. [ Default = None ]
+        ttl (float)            :: Seconds before someone else's unfinished lease
+                                  can be taken over. Should be well above the
+                                  time a batch takes. [ Default = 600 ]
+        poll_interval (float)  :: Seconds between checks for abandoned leases
+                                  once there is nothing left to claim. If None,
+                                  the smaller of 10 and ttl / 4. [ Default = None ]
+    '''
+
+    _name_regex = re.compile(r'b(\d+)\.(?:(\d+)\.lease|done)$')
+
+    def __init__(self, lease_dir, backend = None, ttl = 600, poll_interval = None):
+        self.lease_dir = lease_dir
+        self.backend = get_backend(backend, lease_dir)
+        self.ttl = ttl
+        self.poll_interval = poll_interval if poll_interval is not None else min(10, ttl / 4)
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.claimed = set()
+        self._first_seen = {}
+
+    def claims(self, batch_ids):
+        ''' Generator of batch indices claimed by this worker, trying them in
+        the order of batch_ids. Once every batch is either done or leased,
+        waits for abandoned leases to take over and stops when every batch
+        is done or leased by this worker. '''
+
+        batch_ids = list(batch_ids)
+        while True:
+            done, attempts = self._state()
+            waiting = False
+            for bb in batch_ids:
+                if bb in done or bb in self.claimed:
+                    continue
+                if bb not in attempts:
+                    attempt = 0
+                else:
+                    attempt = attempts[bb]
+                    seen = self._first_seen.setdefault((bb, attempt), time.time())
+                    if time.time() - seen < self.ttl:
+                        waiting = True
+                        continue
+                    attempt += 1
+                if self._claim(bb, attempt):
+                    yield bb
+                else:
+                    waiting = True
+
+            if not waiting:
+                return
+            time.sleep(self.poll_interval)
+
+    def done(self, batch_index):
+        ''' Mark a batch as finished '''
+        self.backend.create_exclusive(self._path(f'b{batch_index:08d}.done'), self.owner.encode('utf-8'))
+
+    def _claim(self, batch_index, attempt):
+        ok = self.backend.create_exclusive(self._path(f'b{batch_index:08d}.{attempt}.lease'),
+                                           self.owner.encode('utf-8'))
+        if ok:
+            self.claimed.add(batch_index)
+        return ok
+
+    def _state(self):
+        ''' Finished batches and the latest lease attempt of every other batch,
+        from one listing of lease_dir '''
+
+        done = set()
+        attempts = {}
+        for pp in self.backend.list(self._path('*')):
+            match = self._name_regex.search(pp)
+            if match is None:
+                continue
+            bb = int(match.group(1))
+            if match.group(2) is None:
+                done.add(bb)
+            else:
+                attempts[bb] = max(attempts.get(bb, 0), int(match.group(2)))
+
+        return done, attempts
+
+    def _path(self, name):
+        return _join_remote(self.lease_dir, name)
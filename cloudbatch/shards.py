@@ -0,0 +1,280 @@
+import io
+import json
+import os
+import os.path as path
+import shutil
+import struct
+import tarfile
+import tempfile
+import threading
+
+# A shard is a plain tar file, so standard tools can unpack it. Members can
+# each be zstd compressed (name + '.zst'), which keeps them individually
+# readable. The last member is a JSON index of where every member's data
+# starts, and after the end of the tar comes a trailer giving the position
+# of the index, so a member can be found without reading the whole archive.
+_INDEX_NAME = '__index__.json'
+_MAGIC = b'CBSHARD1'
+_TRAILER = struct.Struct('<8sQQ')
+
+def write_shard(filename, files, compression = None, level = 3):
+    ''' Pack files into a shard archive at filename. Members are named by
+    the base name of each file. compression is None or 'zstd'. Returns the
+    index dictionary. '''
+
+    compressor = _compressor(compression, level)
+    members = []
+
+    with open(filename, 'wb') as fh:
+        with tarfile.open(fileobj = fh, mode = 'w', format = tarfile.PAX_FORMAT) as tar:
+            for ff in files:
+                name = path.basename(ff)
+                st = os.stat(ff)
+                with open(ff, 'rb') as src:
+                    # Members are streamed into the archive. The tar header
+                    # needs the compressed size, so compressed members go
+                    # through a temporary file first.
+                    data = src
+                    size = st.st_size
+                    if compressor is not None:
+                        data = tempfile.TemporaryFile(dir = path.dirname(path.abspath(filename)))
+                        compressor.copy_stream(src, data)
+                        size = data.tell()
+                        data.seek(0)
+                        name = name + '.zst'
+
+                    info = tarfile.TarInfo(name)
+                    info.size = size
+                    # The file's own mtime keeps the archive the same for the same
+                    # files, so sync can skip it on a rerun
+                    info.mtime = int(st.st_mtime)
+                    info.mode = 0o644
+                    try:
+                        tar.addfile(info, data)
+                    finally:
+                        if data is not src:
+                            data.close()
+
+                members.append({'name' : path.basename(ff),
+                                'offset' : tar.offset - _padded(size),
+                                'size' : size,
+                                'raw_size' : st.st_size})
+
+            index = {'version' : 1, 'compression' : compression, 'members' : members}
+            raw = json.dumps(index).encode('utf-8')
+            info = tarfile.TarInfo(_INDEX_NAME)
+            info.size = len(raw)
+            tar.addfile(info, io.BytesIO(raw))
+            index_offset = tar.offset - _padded(len(raw))
+
+        fh.write(_TRAILER.pack(_MAGIC, index_offset, len(raw)))
+
+    return index
+
+class ShardArchive():
+    '''
+    Read members of a shard written by write_shard(), or of any tar file.
+
+    The index is read from the trailer, so opening a shard does not scan it.
+    A tar file without an index is scanned once instead.
+
+    INPUTS
+        filename (str)  :: Path of the shard.
+
+    Example
+
+        shard = ShardArchive('shard-00000003.tar')
+        shard.names()
+        data = shard.read('out_12.nc')
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        index = self._read_index()
+        self.compression = index.get('compression')
+        self.members = {mm['name'] : mm for mm in index['members']}
+
+    def names(self):
+        return list(self.members)
+
+    def __len__(self):
+        return len(self.members)
+
+    def read(self, name):
+        ''' Bytes of a member, decompressed '''
+        member = self.members[name]
+        with open(self.filename, 'rb') as fh:
+            fh.seek(member['offset'])
+            data = fh.read(member['size'])
+        if self.compression == 'zstd':
+            data = _decompressor().decompress(data)
+        return data
+
+    def extract(self, name, dest_dir):
+        ''' Write one member into dest_dir and return its path '''
+        os.makedirs(dest_dir, exist_ok = True)
+        target = path.join(dest_dir, name)
+        tmp = f'{target}.part'
+        with open(tmp, 'wb') as fh:
+            fh.write(self.read(name))
+        os.replace(tmp, target)
+        return target
+
+    def extract_all(self, dest_dir):
+        return [self.extract(name, dest_dir) for name in self.members]
+
+    def _read_index(self):
+        size = path.getsize(self.filename)
+        if size >= _TRAILER.size:
+            with open(self.filename, 'rb') as fh:
+                fh.seek(size - _TRAILER.size)
+                magic, offset, length = _TRAILER.unpack(fh.read(_TRAILER.size))
+                if magic == _MAGIC:
+                    fh.seek(offset)
+                    return json.loads(fh.read(length).decode('utf-8'))
+
+        # Plain tar file
+        members = []
+        with tarfile.open(self.filename, mode = 'r:') as tar:
+            for info in tar:
+                if info.isfile():
+                    members.append({'name' : info.name, 'offset' : info.offset_data,
+                                    'size' : info.size, 'raw_size' : info.size})
+        return {'version' : 1, 'compression' : None, 'members' : members}
+
+class ShardMember(os.PathLike):
+    '''
+    One member of a downloaded shard, extracted the first time its path is
+    used. Anything that takes a path (open(), numpy, xarray, ...) can be
+    given a ShardMember directly, and only the members that are read are
+    ever written to disk. A ShardMember can be pickled, e.g. to send it to
+    a process pool.
+
+    ATTRIBUTES
+        name (str)        :: Member name.
+        size (int)        :: Uncompressed size in bytes.
+        extracted (bool)  :: Whether the member has been written to disk.
+    '''
+
+    def __init__(self, archive, name, dest_dir):
+        self.archive = archive
+        self.name = name
+        self.size = archive.members[name]['raw_size']
+        self.path = path.join(dest_dir, name)
+        self.dest_dir = dest_dir
+        self.extracted = False
+        self._lock = threading.Lock()
+
+    def __reduce__(self):
+        return (ShardMember, (self.archive, self.name, self.dest_dir), {'extracted' : self.extracted})
+
+    def __fspath__(self):
+        with self._lock:
+            if not self.extracted:
+                self.archive.extract(self.name, self.dest_dir)
+                self.extracted = True
+        return self.path
+
+    def __repr__(self):
+        return f"ShardMember({self.name!r}, archive={self.archive.filename!r}, extracted={self.extracted})"
+
+    def remove(self):
+        with self._lock:
+            if self.extracted and path.exists(self.path):
+                os.remove(self.path)
+            self.extracted = False
+
+class UnpackedShards():
+    '''
+    Keeps track of the shards a CloudBatch has downloaded and the members
+    handed out from them, so that each shard and its extracted members are
+    removed once every member has been deleted.
+    '''
+
+    def __init__(self, lazy = False):
+        self.lazy = lazy
+        self._remaining = {}
+        self._shard_of = {}
+        self._lock = threading.Lock()
+
+    def unpack(self, shard_files):
+        ''' Members of every shard in shard_files, as paths of extracted files
+        or as ShardMember objects if lazy '''
+
+        out = []
+        for shard_file in shard_files:
+            archive = ShardArchive(shard_file)
+            dest_dir = _extract_dir(shard_file)
+            if self.lazy:
+                members = [ShardMember(archive, name, dest_dir) for name in archive.names()]
+            else:
+                members = archive.extract_all(dest_dir)
+            with self._lock:
+                self._remaining[shard_file] = set([self._key(mm) for mm in members])
+                for mm in members:
+                    self._shard_of[self._key(mm)] = shard_file
+            out = out + members
+
+        return out
+
+    def remove(self, files):
+        ''' Delete members in files, and any shard with no members left.
+        Returns the shard files removed. Anything that is not a member is
+        returned too, for the caller to remove. '''
+
+        removed = []
+        for ff in files:
+            key = self._key(ff)
+            with self._lock:
+                shard_file = self._shard_of.pop(key, None)
+            if shard_file is None:
+                removed.append(ff)
+                continue
+
+            if isinstance(ff, ShardMember):
+                ff.remove()
+            elif path.exists(ff):
+                os.remove(ff)
+
+            with self._lock:
+                remaining = self._remaining.get(shard_file)
+                remaining.discard(key)
+                if len(remaining) > 0:
+                    continue
+                del self._remaining[shard_file]
+            shutil.rmtree(_extract_dir(shard_file), ignore_errors = True)
+            removed.append(shard_file)
+
+        return removed
+
+    def _key(self, member):
+        return member.path if isinstance(member, ShardMember) else member
+
+def member_size(ff):
+    ''' Size of a file or a ShardMember, without extracting it '''
+    if isinstance(ff, ShardMember):
+        return ff.size
+    return path.getsize(ff) if path.isfile(ff) else 0
+
+def _extract_dir(shard_file):
+    return shard_file + '.d'
+
+def _padded(size):
+    return ((size + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+def _compressor(compression, level):
+    if compression is None:
+        return None
+    if compression != 'zstd':
+        raise Exception("Unrecognised compression. Choose: compression = [None, 'zstd']")
+    return _zstd().ZstdCompressor(level = level)
+
+def _decompressor():
+    return _zstd().ZstdDecompressor()
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed shards require zstandard. Install it with: pip install zstandard")
+    return zstandard
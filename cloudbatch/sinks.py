@@ -0,0 +1,317 @@
+import bisect
+import json
+import os
+import os.path as path
+import re
+import numpy as np
+
+class Sink():
+    '''
+    Where apply_batch_func puts the output of each batch as it finishes.
+
+    open() is called before the first batch, write() once per batch in the
+    order batches finish, and close() at the end of the run, including when
+    it stops with an exception, so everything written so far is kept.
+    result() is what apply_batch_func stores in self.output.
+
+    A batch skipped because of a transfer error has an output of None.
+    Sinks that write to disk leave it out.
+    '''
+
+    def open(self):
+        pass
+
+    def write(self, batch_index, output):
+        raise NotImplementedError("Sink subclasses must implement write()")
+
+    def close(self):
+        pass
+
+    def result(self):
+        return None
+
+class MemorySink(Sink):
+    ''' Keep every batch output in memory. The default for apply_batch_func.
+    result() is a list of outputs ordered by batch index. '''
+
+    def open(self):
+        self.outputs = {}
+
+    def write(self, batch_index, output):
+        self.outputs[batch_index] = output
+
+    def result(self):
+        return [self.outputs[bb] for bb in sorted(self.outputs)]
+
+class JSONLinesSink(Sink):
+    ''' Append one line of JSON per batch to a file:
+
+        {"batch": 3, "output": [...]}
+
+    numpy arrays and scalars are written as lists and numbers. Each line is
+    flushed as it is written. The file is overwritten when the run starts.
+    read_results() reads it back. '''
+
+    def __init__(self, filename):
+        self.filename = path.expanduser(filename)
+        self._fh = None
+
+    def open(self):
+        _make_parent(self.filename)
+        self._fh = open(self.filename, 'w')
+
+    def write(self, batch_index, output):
+        if output is None:
+            return
+        line = json.dumps({'batch' : int(batch_index), 'output' : output}, default = _json_default)
+        self._fh.write(line + '\n')
+        self._fh.flush()
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def result(self):
+        return self.filename
+
+class NpySink(Sink):
+    ''' Write each batch output as a numpy array in its own .npy chunk,
+    batch_<index>.npy, in out_dir. The outputs of a batch must stack into
+    one array (e.g. one array of the same shape per file), which becomes
+    axis 0 of the chunk. A scalar output, e.g. one number per batch with
+    pass_args='all', is a chunk of one row. Chunks are written to a temporary name and renamed,
+    so a crash never leaves a partial chunk. Chunks from an earlier run are
+    removed when the run starts.
+
+    result() is an NpyResults that memory-maps the chunks as one array.
+
+    .npy is used rather than .npz because numpy can only memory-map
+    uncompressed .npy files. '''
+
+    def __init__(self, out_dir, dtype = None):
+        self.out_dir = path.expanduser(out_dir)
+        self.dtype = dtype
+
+    def open(self):
+        os.makedirs(self.out_dir, exist_ok = True)
+        for fn in os.listdir(self.out_dir):
+            if NpyResults._name_regex.match(fn) or fn.endswith('.npy.tmp'):
+                os.remove(path.join(self.out_dir, fn))
+
+    def write(self, batch_index, output):
+        if output is None:
+            return
+        arr = np.atleast_1d(np.asarray(output, dtype = self.dtype))
+        if arr.dtype == object:
+            raise Exception(f"NpySink needs the outputs of a batch to stack into one array, "
+                            f"but batch {batch_index} gave an object array.")
+        final = path.join(self.out_dir, f'batch_{batch_index:08d}.npy')
+        tmp = f'{final}.tmp'
+        with open(tmp, 'wb') as fh:
+            np.save(fh, arr)
+        os.replace(tmp, final)
+
+    def result(self):
+        return NpyResults(self.out_dir)
+
+class NpyResults():
+    '''
+    Read-only view of the chunks written by NpySink, memory-mapped so that
+    nothing is read from disk until it is used.
+
+    Indexing is along the combined axis 0 of every chunk in batch order, so
+    with pass_args='one' results[ii] is the output for the ii'th file.
+    Slices return a new array.
+
+    INPUTS
+        out_dir (str)  :: Directory written by NpySink.
+
+    Example
+
+        results = NpyResults('out')
+        len(results), results[10], results.batch(3)
+    '''
+
+    _name_regex = re.compile(r'batch_(\d+)\.npy$')
+
+    def __init__(self, out_dir):
+        self.out_dir = path.expanduser(out_dir)
+
+        chunks = {}
+        for fn in os.listdir(self.out_dir):
+            match = self._name_regex.match(fn)
+            if match is not None:
+                chunks[int(match.group(1))] = path.join(self.out_dir, fn)
+
+        self.batch_ids = sorted(chunks)
+        self._files = [chunks[bb] for bb in self.batch_ids]
+        # Chunks of scalars are read as one row
+        self._arrays = [np.atleast_1d(np.load(fn, mmap_mode = 'r')) for fn in self._files]
+        self._offsets = np.cumsum([0] + [len(arr) for arr in self._arrays]).tolist()
+
+    def __len__(self):
+        return self._offsets[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return np.asarray([self[ii] for ii in range(*index.indices(len(self)))])
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("NpyResults index out of range")
+        cc = bisect.bisect_right(self._offsets, index) - 1
+        return self._arrays[cc][index - self._offsets[cc]]
+
+    def __iter__(self):
+        for arr in self._arrays:
+            yield from arr
+
+    def batch(self, batch_index):
+        ''' Memory-mapped output array of one batch '''
+        return self._arrays[self.batch_ids.index(batch_index)]
+
+    def to_array(self):
+        ''' Read every chunk into one in-memory array '''
+        return np.concatenate(self._arrays) if len(self._arrays) > 0 else np.array([])
+
+class ParquetSink(Sink):
+    ''' Write each batch as one row group of a Parquet file, with one row per
+    file. Columns are 'batch', 'file' (position in the batch) and 'output'.
+    If the outputs are dictionaries, each key becomes a column instead of
+    'output'. The schema is taken from the first batch. Requires pyarrow.
+    read_results() memory-maps the file. '''
+
+    def __init__(self, filename, compression = 'snappy'):
+        self.filename = path.expanduser(filename)
+        self.compression = compression
+        self._writer = None
+
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("ParquetSink requires pyarrow. Install it with: pip install pyarrow")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+
+    def open(self):
+        _make_parent(self.filename)
+        if path.exists(self.filename):
+            os.remove(self.filename)
+
+    def write(self, batch_index, output):
+        if output is None:
+            return
+        output = list(output)
+        columns = {'batch' : [int(batch_index)] * len(output),
+                   'file' : list(range(len(output)))}
+        if len(output) > 0 and all([isinstance(oo, dict) for oo in output]):
+            for key in output[0]:
+                columns[key] = [_to_python(oo.get(key)) for oo in output]
+        else:
+            columns['output'] = [_to_python(oo) for oo in output]
+
+        if self._writer is None:
+            table = self._pa.Table.from_pydict(columns)
+            self._writer = self._pq.ParquetWriter(self.filename, table.schema,
+                                                  compression = self.compression)
+        else:
+            table = self._pa.Table.from_pydict(columns, schema = self._writer.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def result(self):
+        return self.filename
+
+class ZarrSink(Sink):
+    ''' Append each batch output to a Zarr array along axis 0, one Zarr chunk
+    per batch. The outputs of a batch must stack into one array, as for
+    NpySink. A second array, 'batch', holds the batch index of every row.
+    Requires zarr. result() is the zarr group, which reads lazily. '''
+
+    def __init__(self, store, dtype = None):
+        self.store = path.expanduser(store) if isinstance(store, str) else store
+        self.dtype = dtype
+        self._group = None
+
+        try:
+            import zarr
+        except ImportError:
+            raise ImportError("ZarrSink requires zarr. Install it with: pip install zarr")
+        self._zarr = zarr
+
+    def open(self):
+        self._group = self._zarr.open_group(self.store, mode = 'w')
+        self._output = None
+        self._batch = None
+
+    def write(self, batch_index, output):
+        if output is None:
+            return
+        arr = np.atleast_1d(np.asarray(output, dtype = self.dtype))
+        if arr.dtype == object:
+            raise Exception(f"ZarrSink needs the outputs of a batch to stack into one array, "
+                            f"but batch {batch_index} gave an object array.")
+        index = np.full(len(arr), batch_index, dtype = 'int64')
+
+        if self._output is None:
+            # create_array() in zarr 3, create_dataset() in zarr 2
+            create = getattr(self._group, 'create_array', None) or self._group.create_dataset
+            self._output = create('output', shape = (0,) + arr.shape[1:],
+                                  chunks = (max(1, len(arr)),) + arr.shape[1:], dtype = arr.dtype)
+            self._batch = create('batch', shape = (0,), chunks = (max(1, len(arr)),), dtype = 'int64')
+        self._output.append(arr)
+        self._batch.append(index)
+
+    def result(self):
+        return self._zarr.open_group(self.store, mode = 'r')
+
+def read_results(location):
+    ''' Open the results written by a sink without loading them into memory.
+
+    A directory of NpySink chunks gives an NpyResults. A .parquet file gives
+    a pyarrow Table read through a memory map. A .zarr store gives the zarr
+    group. A .jsonl file gives a generator of (batch_index, output). '''
+
+    location = path.expanduser(location)
+
+    if location.endswith('.zarr'):
+        import zarr
+        return zarr.open_group(location, mode = 'r')
+    if path.isdir(location):
+        return NpyResults(location)
+    if location.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.read_table(location, memory_map = True)
+    if location.endswith('.jsonl') or location.endswith('.json'):
+        return _iter_json_lines(location)
+
+    raise Exception(f"Don't know how to read results from {location}.")
+
+def _iter_json_lines(filename):
+    with open(filename) as fh:
+        for line in fh:
+            if line.strip():
+                record = json.loads(line)
+                yield record['batch'], record['output']
+
+def _json_default(obj):
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def _to_python(obj):
+    ''' numpy values as plain python, so pyarrow can infer a type '''
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    return obj
+
+def _make_parent(filename):
+    parent = path.dirname(filename)
+    if parent:
+        os.makedirs(parent, exist_ok = True)
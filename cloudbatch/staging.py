@@ -0,0 +1,111 @@
+import heapq
+import itertools
+import shutil
+import threading
+
+class StagingArea():
+    '''
+    Byte quota on the files staged in a get_dir.
+
+    Every download reserves the size of its objects before it starts and
+    blocks until the reservation fits under the quota. Reservations are
+    released when the files are removed with delete_tmp_files(). One
+    StagingArea can be shared by several objects downloading to the same
+    disk.
+
+    Waiting reservations are admitted strictly in ticket order. Tickets are
+    taken when a batch is queued for download, so a batch staged ahead by
+    prefetch can never hold the space that the batch being worked on is
+    waiting for. A single reservation larger than the whole quota raises an
+    exception, as it could never be admitted (see staging_split in GSBatch).
+
+    INPUTS
+        max_bytes (int)   :: Quota in bytes. If None, the free space on
+                             get_dir's disk when the area is made, minus
+                             headroom. [ Default = None ]
+        get_dir (str)     :: Directory used to find the free space when
+                             max_bytes is None. [ Default = None ]
+        headroom (int)    :: Bytes of free space to leave untouched when
+                             max_bytes is None. [ Default = 0 ]
+        timeout (float)   :: Seconds to wait for space before raising. None
+                             waits for ever. [ Default = None ]
+
+    ATTRIBUTES
+        staged_bytes (int) :: Bytes currently reserved.
+        peak_bytes (int)   :: Largest number of bytes reserved at once.
+    '''
+
+    def __init__(self, max_bytes = None, get_dir = None, headroom = 0, timeout = None):
+
+        if max_bytes is None:
+            if get_dir is None:
+                raise Exception("StagingArea needs max_bytes or get_dir.")
+            max_bytes = shutil.disk_usage(get_dir).free - headroom
+
+        self.max_bytes = int(max_bytes)
+        self.timeout = timeout
+        self.staged_bytes = 0
+        self.peak_bytes = 0
+        self._held = {}
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._cond = threading.Condition()
+
+    def ticket(self):
+        ''' Take a place in the queue for a reservation. Pass it to reserve(),
+        or to cancel() if the reservation will not be made. '''
+        with self._cond:
+            ticket = next(self._tickets)
+            heapq.heappush(self._waiting, ticket)
+        return ticket
+
+    def cancel(self, ticket):
+        ''' Give up a ticket without reserving '''
+        with self._cond:
+            self._drop(ticket)
+            self._cond.notify_all()
+
+    def reserve(self, sizes, ticket = None):
+        ''' Reserve space for files. sizes is a dictionary of local path to
+        bytes. Blocks until every earlier ticket has been admitted and the
+        files fit under the quota. '''
+
+        if ticket is None:
+            ticket = self.ticket()
+
+        nbytes = sum(sizes.values())
+        with self._cond:
+            try:
+                if nbytes > self.max_bytes:
+                    raise Exception(f"Staging {nbytes} bytes is more than the staging quota of {self.max_bytes} bytes.")
+
+                admitted = self._cond.wait_for(lambda: self._waiting[0] == ticket and
+                                               self.staged_bytes + nbytes <= self.max_bytes,
+                                               timeout = self.timeout)
+                if not admitted:
+                    raise Exception(f"Timed out waiting for {nbytes} bytes of staging space.")
+
+                for fn, size in sizes.items():
+                    self.staged_bytes += size - self._held.get(fn, 0)
+                    self._held[fn] = size
+                self.peak_bytes = max(self.peak_bytes, self.staged_bytes)
+            finally:
+                self._drop(ticket)
+                self._cond.notify_all()
+
+    def release(self, files):
+        ''' Release the space held by files '''
+        with self._cond:
+            for fn in files:
+                self.staged_bytes -= self._held.pop(fn, 0)
+            self._cond.notify_all()
+
+    def stats(self):
+        return {'max_bytes' : self.max_bytes,
+                'staged_bytes' : self.staged_bytes,
+                'peak_bytes' : self.peak_bytes}
+
+    def _drop(self, ticket):
+        if ticket in self._waiting:
+            self._waiting.remove(ticket)
+            heapq.heapify(self._waiting)
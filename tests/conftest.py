@@ -0,0 +1,24 @@
+import os
+import pytest
+
+@pytest.fixture
+def bucket(tmp_path):
+    ''' Directory standing in for a bucket, holding f00.txt to f11.txt, where
+    file i holds i + 1 copies of its own name '''
+    root = tmp_path / 'bucket'
+    root.mkdir()
+    for ii in range(12):
+        name = f'f{ii:02d}.txt'
+        (root / name).write_text(name * (ii + 1))
+    return root
+
+@pytest.fixture
+def bucket_files(bucket):
+    ''' Sorted paths of the files in bucket '''
+    return sorted([str(bucket / fn) for fn in os.listdir(bucket)])
+
+@pytest.fixture
+def get_dir(tmp_path):
+    out = tmp_path / 'get'
+    out.mkdir()
+    return out
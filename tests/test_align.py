@@ -0,0 +1,84 @@
+import os
+import pytest
+from cloudbatch import GSBatch, AlignmentError, apply_batch_func, check_alignment, join_on_key
+from cloudbatch.align import key_function
+
+def outputs_for(tmp_path, names, batch_size = 4):
+    return GSBatch([str(tmp_path / 'out' / nn) for nn in names], put_dir = str(tmp_path / 'up'),
+                   source = 'local', batch_size = batch_size, backend = 'local')
+
+def make_batch(bucket_files, get_dir, batch_size = 4):
+    return GSBatch(bucket_files, get_dir = str(get_dir), batch_size = batch_size, backend = 'local')
+
+def test_key_functions():
+    assert key_function((0, 2))('dir/a_b_c.nc') == 'a_c'
+    assert key_function(r'f(?P<key>\d+)')('dir/f07.txt') == '07'
+    assert key_function(r'(\w)(\d)', sep = '-')('x1') == 'x-1'
+    assert key_function(str.upper)('ab') == 'AB'
+    with pytest.raises(AlignmentError) as info:
+        key_function(r'\d+')('abc')
+    assert info.value.mismatches[0]['kind'] == 'no_match'
+
+def test_different_batch_counts_are_refused(bucket_files, get_dir, tmp_path):
+    out = outputs_for(tmp_path, [f'o{ii:02d}' for ii in range(8)])
+
+    with pytest.raises(AlignmentError, match = 'different numbers of batches') as info:
+        check_alignment([make_batch(bucket_files, get_dir), out])
+    assert info.value.mismatches[0]['kind'] == 'n_batches'
+
+def test_different_batch_sizes_are_refused(bucket_files, get_dir, tmp_path):
+    out = outputs_for(tmp_path, [f'o{ii:02d}' for ii in range(11)], batch_size = 5)
+
+    with pytest.raises(AlignmentError, match = 'Batch sizes differ'):
+        apply_batch_func(os.path.basename, [make_batch(bucket_files, get_dir, 5), out], progress = False)
+    # Sizes don't need to match when whole batches are passed
+    check_alignment([make_batch(bucket_files, get_dir, 5), out], same_sizes = False)
+
+def test_keys_are_checked(bucket_files, get_dir, tmp_path):
+    names = [f'f{ii:02d}.out' for ii in range(12)]
+    names[3], names[4] = names[4], names[3]
+
+    with pytest.raises(AlignmentError, match = 'not paired by key') as info:
+        check_alignment([make_batch(bucket_files, get_dir), outputs_for(tmp_path, names)],
+                        key = r'f\d+')
+    assert [mm['file'] for mm in info.value.mismatches] == [3, 4]
+
+def test_exact_join_reorders_files(bucket_files, get_dir, tmp_path):
+    names = [f'f{ii:02d}.out' for ii in reversed(range(12))]
+    def write_name(fp_in, fp_out):
+        os.makedirs(os.path.dirname(fp_out), exist_ok = True)
+        with open(fp_out, 'w') as fh:
+            fh.write(os.path.basename(fp_in))
+
+    apply_batch_func(write_name, [make_batch(bucket_files, get_dir), outputs_for(tmp_path, names)],
+                     align = 'exact', align_key = r'f\d+', progress = False)
+
+    assert (tmp_path / 'up' / 'f03.out').read_text() == 'f03.txt'
+    assert len(os.listdir(tmp_path / 'up')) == 12
+
+def test_exact_join_needs_the_same_keys(bucket_files, get_dir, tmp_path):
+    names = [f'f{ii:02d}.out' for ii in range(1, 13)]
+
+    with pytest.raises(AlignmentError, match = "don't have the same keys") as info:
+        join_on_key([make_batch(bucket_files, get_dir), outputs_for(tmp_path, names)], r'f\d+')
+    assert sorted([(mm['object'], mm['key']) for mm in info.value.mismatches]) == [(0, 'f12'), (1, 'f00')]
+
+def test_inner_join_drops_unmatched_files(bucket_files, get_dir, tmp_path):
+    inputs = make_batch(bucket_files, get_dir)
+    out = outputs_for(tmp_path, [f'f{ii:02d}.out' for ii in range(6, 20)])
+
+    join_on_key([inputs, out], r'f\d+', how = 'inner')
+
+    assert [os.path.basename(ff) for ff in inputs.files] == [f'f{ii:02d}.txt' for ii in range(6, 12)]
+    assert [os.path.basename(ff) for ff in out.files] == [f'f{ii:02d}.out' for ii in range(6, 12)]
+    assert list(inputs.batch_bounds) == list(out.batch_bounds) == [0, 4, 6]
+
+def test_duplicate_keys_are_refused(bucket_files, get_dir, tmp_path):
+    out = outputs_for(tmp_path, ['f00.a', 'f00.b'] + [f'f{ii:02d}.out' for ii in range(2, 12)])
+
+    with pytest.raises(AlignmentError, match = 'not unique'):
+        join_on_key([make_batch(bucket_files, get_dir), out], r'f\d+')
+
+def test_join_needs_a_key(bucket_files, get_dir, tmp_path):
+    with pytest.raises(Exception, match = 'requires an align_key'):
+        apply_batch_func(os.path.basename, make_batch(bucket_files, get_dir), align = 'inner')
@@ -0,0 +1,113 @@
+import asyncio
+import os
+import pytest
+from cloudbatch import (AsyncGSBatch, GSBatch, LocalBackend, RetryPolicy, TransferError,
+                        async_apply_batch_func)
+from cloudbatch.asyncbatch import set_max_concurrency
+
+class FlakyBackend(LocalBackend):
+    ''' LocalBackend whose transfers fail for objects in fail_times, as many
+    times as given there. Records the objects passed to each call. '''
+
+    def __init__(self, fail_times):
+        self.fail_times = dict(fail_times)
+        self.calls = []
+
+    def _fails(self, name):
+        name = os.path.basename(name)
+        if self.fail_times.get(name, 0) > 0:
+            self.fail_times[name] -= 1
+            return True
+        return False
+
+    def get(self, remote_paths, local_dir):
+        self.calls.extend([os.path.basename(ff) for ff in remote_paths])
+        super().get([ff for ff in remote_paths if not self._fails(ff)], local_dir)
+        return self._local_targets(remote_paths, local_dir)
+
+    def put(self, local_paths, remote_dir):
+        self.calls.extend([os.path.basename(ff) for ff in local_paths])
+        failed = [ff for ff in local_paths if self._fails(ff)]
+        super().put([ff for ff in local_paths if ff not in failed], remote_dir)
+        return failed
+
+@pytest.fixture
+def concurrency():
+    yield set_max_concurrency
+    set_max_concurrency(64)
+
+def make_batch(bucket_files, get_dir, backend = 'local', retry = None):
+    return AsyncGSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4, backend = backend,
+                        retry = retry or RetryPolicy(max_attempts = 1))
+
+def run(func, batch, **kwargs):
+    return asyncio.run(async_apply_batch_func(func, batch, progress = False, **kwargs))
+
+def names(bucket_files, bb):
+    return [os.path.basename(ff) for ff in bucket_files[bb * 4:(bb + 1) * 4]]
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_outputs_keep_batch_order(bucket_files, get_dir, prefetch):
+    out = run(os.path.basename, make_batch(bucket_files, get_dir), prefetch = prefetch)
+
+    assert out == [names(bucket_files, bb) for bb in range(3)]
+    assert os.listdir(get_dir) == []
+
+def test_plain_batch_objects_are_transferred_in_threads(bucket_files, get_dir):
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4, backend = 'local')
+
+    assert run(os.path.basename, gsb)[2] == names(bucket_files, 2)
+
+def test_retry_backoff_does_not_hold_a_slot(bucket_files, get_dir, concurrency):
+    concurrency(1)
+    backend = FlakyBackend({'f01.txt' : 1})
+    gsb = make_batch(bucket_files[:4], get_dir, backend,
+                     RetryPolicy(max_attempts = 2, base_delay = 0.2, jitter = False))
+
+    asyncio.run(gsb.get_batch())
+
+    # The other objects went ahead while f01.txt was waiting to be retried
+    assert backend.calls == ['f00.txt', 'f01.txt', 'f02.txt', 'f03.txt', 'f01.txt']
+    assert sorted(os.listdir(get_dir)) == names(bucket_files, 0)
+
+def test_get_failure_raises_transfer_error(bucket, bucket_files, get_dir):
+    backend = FlakyBackend({'f02.txt' : 10})
+    gsb = make_batch(bucket_files, get_dir, backend, RetryPolicy(max_attempts = 3, base_delay = 0))
+
+    with pytest.raises(TransferError) as info:
+        asyncio.run(gsb.get_batch())
+
+    assert info.value.failures[0]['path'] == str(bucket / 'f02.txt')
+    assert info.value.failures[0]['attempts'] == 3
+    assert backend.calls.count('f02.txt') == 3
+    assert os.listdir(get_dir) == []
+
+def test_failed_downloads_can_be_skipped(bucket_files, get_dir):
+    out = run(os.path.basename, make_batch(bucket_files, get_dir, FlakyBackend({'f05.txt' : 10})),
+              on_transfer_error = 'skip')
+
+    assert out == [names(bucket_files, 0), None, names(bucket_files, 2)]
+
+def test_failed_uploads_are_not_written_as_done(bucket_files, tmp_path):
+    up = AsyncGSBatch(bucket_files, put_dir = str(tmp_path / 'up'), source = 'local', batch_size = 4,
+                      backend = FlakyBackend({'f05.txt' : 10}), retry = RetryPolicy(max_attempts = 1))
+
+    out = run(os.path.basename, up, on_transfer_error = 'skip')
+
+    assert out == [names(bucket_files, 0), None, names(bucket_files, 2)]
+    assert 'f05.txt' not in os.listdir(tmp_path / 'up')
+
+def test_resume_from_checkpoint(bucket_files, get_dir, tmp_path):
+    checkpoint = str(tmp_path / 'run.ckpt')
+    calls = []
+    def record(ff):
+        calls.append(os.path.basename(ff))
+        return os.path.basename(ff)
+
+    run(record, make_batch(bucket_files, get_dir, FlakyBackend({'f09.txt' : 10})),
+        checkpoint = checkpoint, on_transfer_error = 'skip')
+    calls.clear()
+    out = run(record, make_batch(bucket_files, get_dir), checkpoint = checkpoint, resume = True)
+
+    assert calls == names(bucket_files, 2)
+    assert out == [names(bucket_files, bb) for bb in range(3)]
@@ -0,0 +1,108 @@
+import os
+import pytest
+from cloudbatch import GSBatch, LocalBackend, GSUtilBackend, TransferBackend
+from cloudbatch.backends import get_backend
+
+def test_get_copies_objects(bucket, bucket_files, get_dir):
+    backend = LocalBackend()
+
+    got = backend.get(bucket_files[:3], str(get_dir))
+
+    assert got == [str(get_dir / os.path.basename(ff)) for ff in bucket_files[:3]]
+    assert (get_dir / 'f02.txt').read_text() == (bucket / 'f02.txt').read_text()
+
+def test_get_skips_missing_objects(bucket, get_dir):
+    got = LocalBackend().get([str(bucket / 'nope.txt')], str(get_dir))
+
+    assert got == [str(get_dir / 'nope.txt')]
+    assert os.listdir(get_dir) == []
+
+def test_put_returns_failed_files(bucket_files, tmp_path):
+    remote = tmp_path / 'remote'
+
+    failed = LocalBackend().put(bucket_files[:2] + [str(tmp_path / 'nope.txt')], str(remote))
+
+    assert failed == [str(tmp_path / 'nope.txt')]
+    assert sorted(os.listdir(remote)) == ['f00.txt', 'f01.txt']
+
+def test_file_urls(bucket, get_dir):
+    backend = LocalBackend()
+    url = 'file://' + str(bucket / 'f03.txt')
+
+    assert backend.list('file://' + str(bucket / 'f0[3-4].txt')) == [url, url.replace('f03', 'f04')]
+    assert backend.stat(url)['size'] == os.path.getsize(bucket / 'f03.txt')
+    assert backend.get([url], str(get_dir)) == [str(get_dir / 'f03.txt')]
+
+def test_stat(bucket):
+    backend = LocalBackend()
+
+    info = backend.stat(str(bucket / 'f01.txt'))
+
+    assert info['size'] == 14 and info['generation'] is not None
+    assert backend.stat(str(bucket / 'nope.txt')) is None
+    assert backend.exists(str(bucket / 'f01.txt'))
+    assert not backend.exists(str(bucket / 'nope.txt'))
+
+def test_iter_prefix_and_list_level(bucket):
+    (bucket / 'sub').mkdir()
+    (bucket / 'sub' / 'f50.txt').write_text('x')
+    backend = LocalBackend()
+
+    names = [info['path'] for info in backend.iter_prefix(str(bucket / 'f0'))]
+    assert names == [str(bucket / f'f{ii:02d}.txt') for ii in range(10)]
+    assert str(bucket / 'sub' / 'f50.txt') in [info['path'] for info in backend.iter_prefix(str(bucket) + '/')]
+
+    infos, subdirs = backend.list_level(str(bucket) + '/')
+    assert len(infos) == 12
+    assert subdirs == [str(bucket / 'sub') + '/']
+
+def test_read_range(bucket):
+    data = (bucket / 'f05.txt').read_bytes()
+
+    assert LocalBackend().read_range(str(bucket / 'f05.txt'), 3, 10) == data[3:13]
+
+def test_delete_and_create_exclusive(bucket, tmp_path):
+    backend = LocalBackend()
+    backend.delete([str(bucket / 'f00.txt'), str(bucket / 'nope.txt')])
+    assert not (bucket / 'f00.txt').exists()
+
+    lock = str(tmp_path / 'locks' / 'a.lock')
+    assert backend.create_exclusive(lock, b'me')
+    assert not backend.create_exclusive(lock, b'you')
+    assert open(lock, 'rb').read() == b'me'
+
+def test_get_backend():
+    backend = LocalBackend()
+
+    assert get_backend(backend) is backend
+    assert isinstance(get_backend(None, 'gs://bucket/x'), GSUtilBackend)
+    assert isinstance(get_backend(None, '/data/x'), LocalBackend)
+    assert isinstance(get_backend('local'), LocalBackend)
+    with pytest.raises(Exception):
+        get_backend('ftp')
+
+def test_unimplemented_methods_raise():
+    with pytest.raises(NotImplementedError):
+        TransferBackend().get([], '.')
+
+def test_batches_go_through_the_backend(bucket_files, get_dir, tmp_path):
+    class Recording(LocalBackend):
+        def __init__(self):
+            self.calls = []
+        def get(self, remote_paths, local_dir):
+            self.calls.append(('get', len(remote_paths)))
+            return super().get(remote_paths, local_dir)
+        def put(self, local_paths, remote_dir):
+            self.calls.append(('put', len(local_paths)))
+            return super().put(local_paths, remote_dir)
+
+    backend = Recording()
+    down = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 5, backend = backend)
+    down.get_batch()
+    up = GSBatch(bucket_files, put_dir = str(tmp_path / 'up'), source = 'local',
+                 batch_size = 5, backend = backend)
+    up.put_batch()
+
+    assert backend.calls == [('get', 5), ('put', 5)]
+    assert len(down.tmp_files) == 5
+    assert len(os.listdir(tmp_path / 'up')) == 5
@@ -0,0 +1,37 @@
+import os
+import numpy as np
+from cloudbatch import GSBatch
+
+def test_batch_bytes_bounds(bucket_files, get_dir):
+    sizes = np.array([os.path.getsize(ff) for ff in bucket_files])
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_bytes = 150, backend = 'local')
+
+    totals = np.add.reduceat(sizes, gsb.batch_bounds[:-1])
+    counts = np.diff(gsb.batch_bounds)
+    assert gsb.batch_bounds[0] == 0 and gsb.batch_bounds[-1] == len(bucket_files)
+    # Every batch fits, unless it is a single file that is too big on its own
+    assert np.all((totals <= 150) | (counts == 1))
+    # and no batch could have taken the next file
+    assert np.all(totals[:-1] + sizes[gsb.batch_bounds[1:-1]] > 150)
+
+def test_batch_bytes_max_files(bucket_files, get_dir):
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_bytes = 10**6,
+                  max_batch_files = 5, backend = 'local')
+
+    assert list(gsb.batch_bounds) == [0, 5, 10, 12]
+
+def test_oversized_file_gets_its_own_batch(bucket, bucket_files, get_dir):
+    big = bucket / 'f99.txt'
+    big.write_bytes(b'x' * 1000)
+    files = bucket_files[:6] + [str(big)] + bucket_files[6:]
+    gsb = GSBatch(files, get_dir = str(get_dir), batch_bytes = 200, backend = 'local')
+
+    assert 6 in list(gsb.batch_bounds) and 7 in list(gsb.batch_bounds)
+
+def test_batches_download_their_files(bucket_files, get_dir):
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_bytes = 150, backend = 'local')
+
+    gsb.goto_batch(1)
+    gsb.get_batch()
+
+    assert sorted(os.listdir(get_dir)) == [os.path.basename(ff) for ff in gsb.batch_files(1)]
@@ -0,0 +1,26 @@
+import json
+import numpy as np
+from cloudbatch import bench
+
+def test_bench_writes_a_report(tmp_path):
+    output = tmp_path / 'bench.json'
+
+    bench.main(['--n-files', '6', '--mean-bytes', '1000', '--batch-sizes', '3',
+                '--prefetch', '0', '1', '--work-dir', str(tmp_path / 'work'),
+                '--output', str(output)])
+
+    report = json.loads(output.read_text())
+    assert [(res['batch_size'], res['prefetch']) for res in report['results']] == [(3, 0), (3, 1)]
+    assert all(res['n_files'] == 6 and res['peak_rss_mb'] > 0 for res in report['results'])
+    assert len(list((tmp_path / 'work' / 'run' / 'put').iterdir())) == 6
+
+def test_peak_rss_is_for_the_case_only(tmp_path):
+    bucket_dir = str(tmp_path / 'bucket')
+    names = bench.make_dataset(bucket_dir, 4, mean_bytes = 1000)
+    # 400MB held by this process while the case runs
+    big = np.ones(50 * 10**6)
+
+    res = bench.run_case_isolated(bucket_dir, names, str(tmp_path / 'run'), 2)
+
+    assert res['peak_rss_mb'] < bench._peak_rss_mb() - 300
+    assert big[-1] == 1
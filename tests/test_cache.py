@@ -0,0 +1,71 @@
+import os
+import time
+from cloudbatch import GSBatch, DiskCache
+
+def fill(cache, tmp_path, names, size = 10):
+    keys = []
+    for name in names:
+        fn = tmp_path / name
+        fn.write_bytes(b'x' * size)
+        key = cache.key(name, 1, size)
+        cache.add(key, name, str(fn))
+        keys.append(key)
+        time.sleep(0.01)
+    return keys
+
+def test_second_run_is_served_from_the_cache(bucket_files, tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'))
+    for run in ['a', 'b']:
+        get_dir = tmp_path / run
+        get_dir.mkdir()
+        gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 12, cache = cache,
+                      backend = 'local')
+        gsb.get_batch()
+        assert sorted(os.listdir(get_dir)) == [os.path.basename(ff) for ff in bucket_files]
+        assert (get_dir / 'f03.txt').read_text() == 'f03.txt' * 4
+
+    stats = cache.stats()
+    assert (stats['misses'], stats['hits']) == (12, 12)
+    assert stats['hit_bytes'] == stats['miss_bytes'] == stats['total_bytes']
+
+def test_changed_objects_are_not_served(bucket, bucket_files, tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'))
+    for run in ['a', 'b']:
+        get_dir = tmp_path / run
+        get_dir.mkdir()
+        GSBatch(bucket_files[:1], get_dir = str(get_dir), cache = cache, backend = 'local').get_batch()
+        (bucket / 'f00.txt').write_text('changed')
+
+    assert (tmp_path / 'b' / 'f00.txt').read_text() == 'changed'
+    assert cache.misses == 2
+
+def test_least_recently_used_are_evicted(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes = 30)
+    keys = fill(cache, tmp_path, ['a', 'b', 'c', 'd'])
+    assert cache.lookup(keys[0]) is not None
+
+    cache.evict()
+
+    assert cache.lookup(keys[1]) is None
+    assert all(cache.lookup(key) is not None for key in [keys[0], keys[2], keys[3]])
+    assert cache.total_bytes() == 30
+
+def test_kept_keys_are_not_evicted(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes = 10)
+    keys = fill(cache, tmp_path, ['a', 'b', 'c'])
+
+    cache.evict(keep = keys[:2])
+
+    assert [cache.lookup(key) is not None for key in keys] == [True, True, False]
+
+def test_linked_files_survive_eviction(tmp_path):
+    cache = DiskCache(str(tmp_path / 'cache'), max_bytes = 0)
+    key, = fill(cache, tmp_path, ['a'])
+    target = str(tmp_path / 'staged')
+
+    cache.link(cache.lookup(key), target)
+    cache.evict()
+
+    assert cache.lookup(key) is None
+    assert not os.path.islink(target)
+    assert open(target, 'rb').read() == b'x' * 10
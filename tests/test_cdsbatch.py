@@ -0,0 +1,139 @@
+import json
+import os
+import pytest
+import urllib.request
+from cloudbatch import CDSBatch, TransferError
+from cloudbatch.cdsbatch import HTTPCDSClient
+from cloudbatch.fakecds import FakeCDSServer
+
+class CountingClient(HTTPCDSClient):
+    ''' HTTPCDSClient that records the most requests it had queued at once '''
+
+    def __init__(self, url):
+        super().__init__(url)
+        self.queued = 0
+        self.max_queued = 0
+        self.submitted = 0
+
+    def submit(self, dataset, request):
+        self.submitted += 1
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        return super().submit(dataset, request)
+
+    def poll(self, handle):
+        state = super().poll(handle)
+        if state in ['completed', 'failed'] and not handle.get('_counted', False):
+            handle['_counted'] = True
+            self.queued -= 1
+        return state
+
+@pytest.fixture
+def server():
+    srv = FakeCDSServer(queue_delay = 0.05, run_delay = 0.05, slots = 2,
+                        fail = lambda request: request.get('year') == '2099').start()
+    yield srv
+    srv.stop()
+
+def test_scheduler_downloads_every_request(server, tmp_path):
+    client = CountingClient(server.url)
+    cds = CDSBatch({'variable' : 't2m', 'format' : 'netcdf'},
+                   {'year' : ['2000', '2001', '2002'], 'month' : ['01', '02']},
+                   dataset = 'era5', get_dir = str(tmp_path), batch_size = 6,
+                   max_queued = 3, poll_interval = 0.01, client = client)
+
+    cds.get_batch()
+    got = cds.tmp_files
+
+    assert got == [str(tmp_path / ff) for ff in cds.files]
+    for ff, request in zip(got, cds.requests):
+        with open(ff, 'rb') as fh:
+            data = fh.read()
+        assert len(data) == server.payload_bytes
+        assert json.loads(data.strip()) == request
+    assert client.submitted == 6
+    assert client.max_queued == 3
+
+def test_failed_requests_raise_transfer_error(server, tmp_path):
+    cds = CDSBatch({'variable' : 't2m'}, {'year' : ['2000', '2099']},
+                   dataset = 'era5', get_dir = str(tmp_path), batch_size = 2,
+                   poll_interval = 0.01, url = server.url)
+
+    with pytest.raises(TransferError) as info:
+        cds.get_batch()
+
+    assert len(info.value.failures) == 1
+    failure = info.value.failures[0]
+    assert failure['path'] == 'era5_2099.grib'
+    assert failure['op'] == 'get'
+    assert failure['request'] == {'variable' : 't2m', 'year' : '2099'}
+    assert cds.failures == info.value.failures
+    # The request that worked is cleaned up with the rest of the batch
+    assert os.listdir(tmp_path) == []
+
+def test_queue_is_kept_full_across_batches(server, tmp_path):
+    client = CountingClient(server.url)
+    cds = CDSBatch({'variable' : 't2m'}, {'year' : [str(yy) for yy in range(2000, 2006)]},
+                   dataset = 'era5', get_dir = str(tmp_path), batch_size = 2,
+                   max_queued = 3, poll_interval = 0.01, client = client)
+
+    cds.get_batch()
+    # Slots freed by the first batch went to the second
+    assert client.submitted in [3, 4]
+
+    for bb in [1, 2]:
+        cds.goto_batch(bb)
+        cds.get_batch()
+
+    assert client.submitted == 6
+    assert client.max_queued == 3
+    assert cds.tmp_files == [str(tmp_path / ff) for ff in cds.files]
+    for ff, request in zip(cds.tmp_files, cds.requests):
+        with open(ff, 'rb') as fh:
+            assert json.loads(fh.read().strip()) == request
+
+def test_requests_for_skipped_batches_are_dropped(server, tmp_path):
+    client = CountingClient(server.url)
+    cds = CDSBatch({'variable' : 't2m'}, {'year' : [str(yy) for yy in range(2000, 2006)]},
+                   dataset = 'era5', get_dir = str(tmp_path), batch_size = 2,
+                   max_queued = 2, poll_interval = 0.01, client = client)
+
+    cds.get_batch()
+    cds.goto_batch(2)
+    cds.get_batch()
+
+    assert cds.tmp_files == [str(tmp_path / ff) for ff in cds.files[:2] + cds.files[4:]]
+    assert cds._ahead == {}
+
+def test_queue_ahead_can_be_turned_off(server, tmp_path):
+    client = CountingClient(server.url)
+    cds = CDSBatch({'variable' : 't2m'}, {'year' : ['2000', '2001', '2002']},
+                   dataset = 'era5', get_dir = str(tmp_path), batch_size = 1,
+                   poll_interval = 0.01, client = client, queue_ahead = False)
+
+    cds.get_batch()
+
+    assert client.submitted == 1
+
+def test_failed_download_leaves_no_partial_file(tmp_path, monkeypatch):
+    class BrokenResponse():
+        ''' Response that breaks after its first chunk '''
+        def __init__(self):
+            self.chunks = 0
+        def __enter__(self):
+            return self
+        def __exit__(self, *args):
+            pass
+        def read(self, nbytes):
+            self.chunks += 1
+            if self.chunks > 1:
+                raise ConnectionResetError('connection lost')
+            return b'x' * 10
+
+    monkeypatch.setattr(urllib.request, 'urlopen', lambda req: BrokenResponse())
+    target = str(tmp_path / 'out.grib')
+
+    with pytest.raises(ConnectionResetError):
+        HTTPCDSClient('http://cds').download({'location' : 'http://cds/result'}, target)
+
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,70 @@
+import os
+import numpy as np
+from cloudbatch import GSBatch, LocalBackend
+
+class CountingBackend(LocalBackend):
+    ''' LocalBackend counting stat calls and directory listings. Stats made
+    by a listing itself aren't counted. '''
+
+    def __init__(self):
+        self.stats = 0
+        self.levels = 0
+        self._listing = False
+
+    def stat(self, path):
+        if not self._listing:
+            self.stats += 1
+        return super().stat(path)
+
+    def list_level(self, prefix):
+        self.levels += 1
+        self._listing = True
+        try:
+            return super().list_level(prefix)
+        finally:
+            self._listing = False
+
+def test_missing_files_are_found(bucket, bucket_files, get_dir):
+    files = bucket_files + [str(bucket / 'missing.txt')]
+    gsb = GSBatch(files, get_dir = str(get_dir), batch_size = 5, backend = 'local')
+
+    exists = gsb.check_files()
+
+    assert list(exists) == [True] * 12 + [False]
+    assert np.array_equal(gsb.file_exists, exists)
+
+def test_a_directory_with_many_files_is_listed_once(bucket_files, get_dir):
+    backend = CountingBackend()
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), backend = backend)
+
+    assert gsb.check_files().all()
+    assert backend.levels == 1
+    assert backend.stats == 0
+
+def test_scattered_files_are_stated(bucket, bucket_files, get_dir):
+    other = bucket / 'other'
+    other.mkdir()
+    (other / 'a.txt').write_text('a')
+    backend = CountingBackend()
+    gsb = GSBatch(bucket_files[:2] + [str(other / 'a.txt'), str(other / 'b.txt')],
+                  get_dir = str(get_dir), backend = backend)
+
+    assert list(gsb.check_files(list_threshold = 5)) == [True, True, True, False]
+    assert backend.levels == 0
+    assert backend.stats == 4
+
+def test_drop_missing_rebuilds_the_batches(bucket, bucket_files, get_dir):
+    files = [str(bucket / 'missing.txt')] + bucket_files
+    gsb = GSBatch(files, get_dir = str(get_dir), batch_size = 5, backend = 'local')
+
+    gsb.check_files(drop_missing = True)
+
+    assert gsb.files == bucket_files
+    assert gsb.n_batches == 3
+    assert list(gsb.batch_files(2)) == bucket_files[10:]
+
+def test_local_files_are_checked(bucket_files, tmp_path):
+    files = bucket_files[:3] + [str(tmp_path / 'not_written.txt')]
+    gsb = GSBatch(files, put_dir = str(tmp_path / 'up'), source = 'local', backend = 'local')
+
+    assert list(gsb.check_files()) == [True, True, True, False]
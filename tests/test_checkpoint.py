@@ -0,0 +1,102 @@
+import os
+import pickle
+import pytest
+from cloudbatch import GSBatch, Checkpoint, LocalBackend, RetryPolicy, TransferError, apply_batch_func
+
+calls = []
+
+def read_name(ff):
+    calls.append(os.path.basename(ff))
+    return os.path.basename(ff)
+
+def fail_on_f04(ff):
+    if ff.endswith('f04.txt'):
+        raise ValueError('bad file')
+    return os.path.basename(ff)
+
+class BrokenBackend(LocalBackend):
+    ''' LocalBackend that can't download anything from batch 2 on '''
+    def get(self, remote_paths, local_dir):
+        super().get([ff for ff in remote_paths if os.path.basename(ff) < 'f08'], local_dir)
+        return self._local_targets(remote_paths, local_dir)
+
+@pytest.fixture(autouse = True)
+def clear_calls():
+    calls.clear()
+
+def make_batch(bucket_files, get_dir, backend = 'local'):
+    return GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4,
+                   backend = backend, retry = RetryPolicy(max_attempts = 1))
+
+def all_names():
+    return [[f'f{ii:02d}.txt' for ii in range(bb, bb + 4)] for bb in [0, 4, 8]]
+
+def test_resume_skips_finished_batches(bucket_files, get_dir, tmp_path):
+    checkpoint = str(tmp_path / 'run.ckpt')
+    with pytest.raises(TransferError):
+        apply_batch_func(read_name, make_batch(bucket_files, get_dir, BrokenBackend()),
+                         checkpoint = checkpoint, progress = False)
+    assert Checkpoint(checkpoint).finished_batches() == [0, 1]
+
+    calls.clear()
+    app = apply_batch_func(read_name, make_batch(bucket_files, get_dir),
+                           checkpoint = checkpoint, resume = True, progress = False)
+
+    assert calls == ['f08.txt', 'f09.txt', 'f10.txt', 'f11.txt']
+    assert app.output == all_names()
+
+def test_torn_record_is_cut_off_on_resume(bucket_files, get_dir, tmp_path):
+    checkpoint = str(tmp_path / 'run.ckpt')
+    with pytest.raises(TransferError):
+        apply_batch_func(read_name, make_batch(bucket_files, get_dir, BrokenBackend()),
+                         checkpoint = checkpoint, progress = False)
+    # A record cut short by a crash
+    torn = pickle.dumps({'batch' : 2, 'output' : ['x'] * 100})
+    with open(checkpoint, 'ab') as fh:
+        fh.write(torn[:len(torn) // 2])
+
+    calls.clear()
+    app = apply_batch_func(read_name, make_batch(bucket_files, get_dir),
+                           checkpoint = checkpoint, resume = True, progress = False)
+    assert calls == ['f08.txt', 'f09.txt', 'f10.txt', 'f11.txt']
+
+    # The batch recorded after the torn record can be read back
+    calls.clear()
+    app = apply_batch_func(read_name, make_batch(bucket_files, get_dir),
+                           checkpoint = checkpoint, resume = True, progress = False)
+    assert calls == []
+    assert app.output == all_names()
+    assert Checkpoint(checkpoint).finished_batches() == [0, 1, 2]
+
+def test_without_resume_the_checkpoint_is_overwritten(bucket_files, get_dir, tmp_path):
+    checkpoint = str(tmp_path / 'run.ckpt')
+    apply_batch_func(read_name, make_batch(bucket_files, get_dir), checkpoint = checkpoint, progress = False)
+    calls.clear()
+
+    apply_batch_func(read_name, make_batch(bucket_files, get_dir), checkpoint = checkpoint, progress = False)
+
+    assert len(calls) == 12
+
+def test_batches_with_func_errors_are_not_checkpointed(bucket_files, get_dir, tmp_path):
+    checkpoint = str(tmp_path / 'run.ckpt')
+    app = apply_batch_func(fail_on_f04, make_batch(bucket_files, get_dir), executor = 'thread',
+                           checkpoint = checkpoint, progress = False)
+    assert len(app.errors) == 1
+
+    app = apply_batch_func(read_name, make_batch(bucket_files, get_dir), checkpoint = checkpoint,
+                           resume = True, progress = False)
+
+    assert calls == ['f04.txt', 'f05.txt', 'f06.txt', 'f07.txt']
+    assert app.output[1] == ['f04.txt', 'f05.txt', 'f06.txt', 'f07.txt']
+
+def test_checkpoint_for_other_batches_is_refused(bucket_files, get_dir, tmp_path):
+    checkpoint = str(tmp_path / 'run.ckpt')
+    apply_batch_func(read_name, make_batch(bucket_files, get_dir), checkpoint = checkpoint, progress = False)
+
+    with pytest.raises(Exception, match = 'different set of batches'):
+        apply_batch_func(read_name, make_batch(bucket_files[:8], get_dir), checkpoint = checkpoint,
+                         resume = True, progress = False)
+
+def test_resume_needs_a_checkpoint(bucket_files, get_dir):
+    with pytest.raises(Exception):
+        apply_batch_func(read_name, make_batch(bucket_files, get_dir), resume = True, progress = False)
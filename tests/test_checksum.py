@@ -0,0 +1,108 @@
+import base64
+import hashlib
+import os
+import pytest
+from cloudbatch import GSBatch, Hasher, LocalBackend, RetryPolicy, TransferError, check_file, file_hashes
+from cloudbatch import checksum
+from cloudbatch.checksum import CRC32C, pick_algorithm
+
+def b64(digest):
+    return base64.b64encode(digest).decode('ascii')
+
+class HashingBackend(LocalBackend):
+    ''' LocalBackend reporting MD5s, like Google Storage. Corrupts the first
+    download of each object in corrupt. '''
+
+    def __init__(self, corrupt = ()):
+        self.corrupt = set(corrupt)
+
+    def stat(self, path):
+        info = super().stat(path)
+        if info is not None:
+            info['md5'] = file_hashes(path, ['md5'])['md5']
+        return info
+
+    def list_level(self, prefix):
+        infos, subdirs = super().list_level(prefix)
+        for info in infos:
+            info['md5'] = file_hashes(info['path'], ['md5'])['md5']
+        return infos, subdirs
+
+    def get(self, remote_paths, local_dir):
+        got = super().get(remote_paths, local_dir)
+        for ff, local in zip(remote_paths, got):
+            if os.path.basename(ff) in self.corrupt:
+                self.corrupt.remove(os.path.basename(ff))
+                data = open(local, 'rb').read()
+                with open(local, 'wb') as fh:
+                    fh.write(bytes([data[0] ^ 1]) + data[1:])
+        return got
+
+@pytest.fixture
+def slow_crc32c(monkeypatch):
+    monkeypatch.setattr(checksum, '_google_crc32c', None)
+    monkeypatch.setattr(checksum, '_crc32c', None)
+
+def test_pure_python_crc32c(slow_crc32c):
+    crc = CRC32C()
+    crc.update(b'1234')
+    crc.update(b'56789')
+
+    assert crc.digest() == (0xE3069283).to_bytes(4, 'big')
+    assert not checksum.fast_crc32c()
+
+def test_hasher_matches_hashlib():
+    hasher = Hasher(['md5', 'crc32c'])
+    hasher.update(b'hello ')
+    hasher.update(b'world')
+
+    digests = hasher.digests()
+    assert digests['md5'] == b64(hashlib.md5(b'hello world').digest())
+    assert len(base64.b64decode(digests['crc32c'])) == 4
+    with pytest.raises(Exception):
+        Hasher(['sha1'])
+
+def test_file_hashes_do_not_depend_on_chunk_size(bucket):
+    fn = str(bucket / 'f11.txt')
+
+    assert file_hashes(fn, chunk_size = 7) == file_hashes(fn)
+    assert file_hashes(fn, ['md5'])['md5'] == b64(hashlib.md5(open(fn, 'rb').read()).digest())
+
+def test_pick_algorithm(slow_crc32c, monkeypatch):
+    assert pick_algorithm({'md5' : 'x', 'crc32c' : 'y'}) == 'md5'
+    assert pick_algorithm({}) is None
+    with pytest.warns(UserWarning, match = 'size alone'):
+        assert pick_algorithm({'crc32c' : 'y'}) is None
+
+    monkeypatch.setattr(checksum, 'fast_crc32c', lambda: True)
+    assert pick_algorithm({'md5' : 'x', 'crc32c' : 'y'}) == 'crc32c'
+
+def test_check_file(bucket):
+    fn = str(bucket / 'f02.txt')
+    info = {'size' : os.path.getsize(fn), 'md5' : file_hashes(fn, ['md5'])['md5']}
+
+    assert check_file(fn, info) is None
+    assert 'size is' in check_file(fn, dict(info, size = 1))
+    assert 'md5 is' in check_file(fn, dict(info, md5 = 'wrong'))
+    assert check_file(fn, dict(info, md5 = 'wrong'), verify = 'size') is None
+    assert check_file(str(bucket / 'nope.txt'), info) == 'file is missing'
+
+def test_corrupt_downloads_are_retried(bucket_files, get_dir):
+    backend = HashingBackend(corrupt = ['f01.txt'])
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4, backend = backend,
+                  verify = 'hash', retry = RetryPolicy(max_attempts = 2, base_delay = 0))
+
+    gsb.get_batch()
+
+    assert open(get_dir / 'f01.txt').read() == open(bucket_files[1]).read()
+
+def test_downloads_that_never_match_raise(bucket_files, get_dir):
+    backend = HashingBackend(corrupt = ['f01.txt'])
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4, backend = backend,
+                  verify = 'hash', retry = RetryPolicy(max_attempts = 1))
+
+    with pytest.raises(TransferError) as info:
+        gsb.get_batch()
+
+    assert 'md5' in info.value.failures[0]['error']
+    assert os.listdir(get_dir) == []
@@ -0,0 +1,64 @@
+import os
+import pickle
+import threading
+import pytest
+from cloudbatch import GSBatch, apply_batch_func
+
+# Can't be pickled, as it isn't found under its name
+unpicklable = lambda ff: ff
+
+def fail_on_f04(ff):
+    if ff.endswith('f04.txt'):
+        raise ValueError('bad file')
+    return os.path.basename(ff)
+
+def make_batch(bucket_files, get_dir):
+    return GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4, backend = 'local')
+
+@pytest.mark.parametrize('executor', [None, 'thread', 'process'])
+def test_outputs_keep_file_order(bucket_files, get_dir, executor):
+    app = apply_batch_func(os.path.basename, make_batch(bucket_files, get_dir),
+                           executor = executor, max_workers = 3, progress = False)
+
+    assert app.output == [[os.path.basename(ff) for ff in bucket_files[bb:bb + 4]] for bb in [0, 4, 8]]
+
+def test_thread_pool_runs_calls_at_once(bucket_files, get_dir):
+    barrier = threading.Barrier(4, timeout = 10)
+    def wait_for_all(ff):
+        # Only returns once four calls are running together
+        barrier.wait()
+        return 1
+
+    app = apply_batch_func(wait_for_all, make_batch(bucket_files, get_dir), executor = 'thread',
+                           max_workers = 4, progress = False)
+
+    assert app.output == [[1] * 4] * 3
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_pool_collects_func_errors(bucket_files, get_dir, executor):
+    app = apply_batch_func(fail_on_f04, make_batch(bucket_files, get_dir), executor = executor,
+                           max_workers = 2, progress = False)
+
+    assert app.output[0] == ['f00.txt', 'f01.txt', 'f02.txt', 'f03.txt']
+    assert app.output[1] == [None, 'f05.txt', 'f06.txt', 'f07.txt']
+    assert len(app.errors) == 1
+    error = app.errors[0]
+    assert (error['batch'], error['file']) == (1, 0)
+    assert isinstance(error['error'], ValueError)
+    assert os.listdir(get_dir) == []
+
+def test_process_pool_failures_are_raised(bucket_files, get_dir):
+    # func can't be sent to another process. That is not func's error, so
+    # it stops the run instead of being recorded.
+    with pytest.raises(pickle.PicklingError):
+        apply_batch_func(unpicklable, make_batch(bucket_files, get_dir), executor = 'process',
+                         progress = False)
+    assert os.listdir(get_dir) == []
+
+def test_without_a_pool_func_errors_are_raised(bucket_files, get_dir):
+    with pytest.raises(ValueError):
+        apply_batch_func(fail_on_f04, make_batch(bucket_files, get_dir), progress = False)
+
+def test_unknown_executor(bucket_files, get_dir):
+    with pytest.raises(Exception):
+        apply_batch_func(os.path.basename, make_batch(bucket_files, get_dir), executor = 'gpu')
@@ -0,0 +1,48 @@
+import os
+import pytest
+from cloudbatch import GSBatch, ComponentFileList, file_list_from_components
+
+components = (['a', 'b'], [1, 2, 3])
+
+def test_names_match_the_full_list():
+    files = ComponentFileList(components, file_ext = 'nc')
+
+    assert len(files) == 6
+    assert list(files) == ['a_1.nc', 'a_2.nc', 'a_3.nc', 'b_1.nc', 'b_2.nc', 'b_3.nc']
+    assert file_list_from_components(components, file_ext = 'nc') == list(files)
+
+def test_indexing_and_slicing():
+    files = ComponentFileList(components, file_ext = 'nc', join_str = '-')
+
+    assert files[4] == 'b-2.nc'
+    assert files[-1] == 'b-3.nc'
+    assert files[1:3] == ['a-2.nc', 'a-3.nc']
+    assert files[::4] == ['a-1.nc', 'b-2.nc']
+    assert files.component_index(4) == (1, 1)
+    with pytest.raises(IndexError):
+        files[6]
+
+def test_prefix():
+    files = ComponentFileList(components, prefix = 'gs://bucket').with_prefix('era5')
+
+    assert files[0] == 'gs://bucket/era5/a_1'
+
+def test_large_grids_are_not_built():
+    files = ComponentFileList([range(1000)] * 3, file_ext = 'nc')
+
+    assert len(files) == 10**9
+    assert files[10**9 - 1] == '999_999_999.nc'
+
+def test_empty_components():
+    assert len(ComponentFileList([])) == 0
+    assert list(ComponentFileList([['a'], []])) == []
+
+def test_batches_of_a_component_list(bucket, get_dir):
+    files = ComponentFileList([['f'], ['00', '01', '02', '03']], join_str = '', file_ext = 'txt',
+                              prefix = str(bucket))
+    gsb = GSBatch(files, get_dir = str(get_dir), batch_size = 3, backend = 'local')
+
+    assert gsb.n_batches == 2
+    assert list(gsb.batch_files(1)) == [str(bucket / 'f03.txt')]
+    gsb.get_batch()
+    assert sorted(os.listdir(get_dir)) == ['f00.txt', 'f01.txt', 'f02.txt']
@@ -0,0 +1,51 @@
+import os
+from cloudbatch import GSBatch, iter_apply
+
+def make_batch(bucket_files, get_dir):
+    return GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 5, backend = 'local')
+
+def test_batch_object_iterates_over_batches(bucket_files, get_dir):
+    seen = []
+    for files in make_batch(bucket_files, get_dir):
+        # Only the current batch is on disk
+        assert sorted(os.listdir(get_dir)) == [os.path.basename(ff) for ff in files]
+        seen.append(len(files))
+
+    assert seen == [5, 5, 2]
+    assert os.listdir(get_dir) == []
+
+def test_stopping_early_deletes_the_batch(bucket_files, get_dir):
+    for files in make_batch(bucket_files, get_dir):
+        break
+
+    assert os.listdir(get_dir) == []
+
+def test_local_objects_yield_their_files(bucket_files):
+    gsb = GSBatch(bucket_files, put_dir = '/nowhere', source = 'local', batch_size = 5, backend = 'local')
+
+    assert [files for files in gsb][2] == bucket_files[10:]
+
+def test_iter_apply_yields_each_batch(bucket_files, get_dir):
+    seen = []
+    for bb, out in iter_apply(os.path.basename, make_batch(bucket_files, get_dir), progress = False):
+        # Files are deleted before the batch is yielded
+        assert os.listdir(get_dir) == []
+        seen.append((bb, out))
+
+    assert [bb for bb, out in seen] == [0, 1, 2]
+    assert seen[2][1] == ['f10.txt', 'f11.txt']
+
+def test_iter_apply_with_prefetch(bucket_files, get_dir):
+    outs = dict(iter_apply(os.path.basename, make_batch(bucket_files, get_dir), prefetch = 2,
+                           progress = False))
+
+    assert sorted(outs) == [0, 1, 2]
+    assert outs[1] == [f'f{ii:02d}.txt' for ii in range(5, 10)]
+    assert os.listdir(get_dir) == []
+
+def test_iter_apply_can_stop_early(bucket_files, get_dir):
+    it = iter_apply(os.path.basename, make_batch(bucket_files, get_dir), prefetch = 1, progress = False)
+    next(it)
+    it.close()
+
+    assert os.listdir(get_dir) == []
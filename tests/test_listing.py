@@ -0,0 +1,95 @@
+import pytest
+from cloudbatch import LocalBackend, Lister
+
+class CountingBackend(LocalBackend):
+    ''' LocalBackend recording the prefixes it lists '''
+
+    def __init__(self):
+        self.levels = []
+        self.prefixes = []
+
+    def list_level(self, prefix):
+        self.levels.append(prefix)
+        return super().list_level(prefix)
+
+    def iter_prefix(self, prefix):
+        self.prefixes.append(prefix)
+        yield from super().iter_prefix(prefix)
+
+@pytest.fixture
+def tree(tmp_path):
+    ''' root/top.nc, root/2019/a.nc, root/2020/{a.nc, b.txt, sub/c.nc} '''
+    root = tmp_path / 'root'
+    for name in ['top.nc', '2019/a.nc', '2020/a.nc', '2020/b.txt', '2020/sub/c.nc']:
+        fn = root / name
+        fn.parent.mkdir(parents = True, exist_ok = True)
+        fn.write_text(name)
+    return str(root)
+
+def test_only_the_matching_level_is_listed(tree):
+    backend = CountingBackend()
+
+    assert Lister(backend).list(tree + '/2020/*.nc') == [tree + '/2020/a.nc']
+    assert backend.levels == [tree + '/2020/']
+    assert backend.prefixes == []
+
+def test_only_matching_subdirectories_are_followed(tree):
+    backend = CountingBackend()
+
+    assert Lister(backend).list(tree + '/20*/a.nc') == [tree + '/2019/a.nc', tree + '/2020/a.nc']
+    assert backend.levels == [tree + '/20', tree + '/2019/a.nc', tree + '/2020/a.nc']
+
+def test_double_star_lists_recursively(tree):
+    backend = CountingBackend()
+
+    found = Lister(backend).list(tree + '/2020/**.nc')
+
+    assert sorted(found) == [tree + '/2020/a.nc', tree + '/2020/sub/c.nc']
+    assert backend.prefixes == [tree + '/2020/']
+    assert backend.levels == []
+
+def test_shared_levels_are_listed_once(tree):
+    backend = CountingBackend()
+
+    nc, txt = Lister(backend).expand([tree + '/2020/*.nc', tree + '/2020/*.txt'])
+
+    assert nc == [tree + '/2020/a.nc'] and txt == [tree + '/2020/b.txt']
+    assert backend.levels == [tree + '/2020/']
+
+def test_metadata_is_listed(tree):
+    info, = Lister(LocalBackend()).list_info(tree + '/2019/*')
+
+    assert info['path'] == tree + '/2019/a.nc'
+    assert info['size'] == len('2019/a.nc')
+
+def test_cached_listings_are_reused(tree, tmp_path):
+    cache_dir = str(tmp_path / 'listings')
+    Lister(CountingBackend(), cache_dir = cache_dir).list(tree + '/**')
+
+    backend = CountingBackend()
+    lister = Lister(backend, cache_dir = cache_dir)
+
+    # Narrower listings come from the cached one
+    assert lister.list(tree + '/2020/*.nc') == [tree + '/2020/a.nc']
+    assert sorted(lister.list(tree + '/2020/**.nc')) == [tree + '/2020/a.nc', tree + '/2020/sub/c.nc']
+    assert backend.levels == [] and backend.prefixes == []
+
+def test_expired_listings_are_not_used(tree, tmp_path):
+    cache_dir = str(tmp_path / 'listings')
+    Lister(LocalBackend(), cache_dir = cache_dir).list(tree + '/2020/*')
+
+    backend = CountingBackend()
+    Lister(backend, cache_dir = cache_dir, ttl = -1).list(tree + '/2020/*')
+
+    assert backend.levels == [tree + '/2020/']
+
+def test_clear_removes_cached_listings(tree, tmp_path):
+    cache_dir = str(tmp_path / 'listings')
+    Lister(LocalBackend(), cache_dir = cache_dir).list(tree + '/2020/*')
+
+    backend = CountingBackend()
+    lister = Lister(backend, cache_dir = cache_dir)
+    lister.clear()
+    lister.list(tree + '/2020/*')
+
+    assert backend.levels == [tree + '/2020/']
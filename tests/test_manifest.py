@@ -0,0 +1,59 @@
+import os
+from cloudbatch import GSBatch, Manifest, apply_batch_func
+
+def fail_on_f04(ff):
+    if ff.endswith('f04.txt'):
+        raise ValueError('bad file')
+    return os.path.basename(ff)
+
+def make_batch(bucket, get_dir, manifest, incremental = True):
+    return GSBatch(str(bucket / '*.txt'), get_dir = str(get_dir), batch_size = 4,
+                   backend = 'local', manifest = manifest, incremental = incremental)
+
+def test_objects_are_marked_as_batches_finish(bucket, bucket_files, get_dir, tmp_path):
+    manifest = str(tmp_path / 'manifest.db')
+    apply_batch_func(os.path.basename, make_batch(bucket, get_dir, manifest), progress = False)
+
+    assert Manifest(manifest).summary() == {'done' : 12}
+    assert set(Manifest(manifest).status()) == set(bucket_files)
+
+def test_incremental_run_only_batches_new_and_changed_objects(bucket, get_dir, tmp_path):
+    manifest = str(tmp_path / 'manifest.db')
+    apply_batch_func(os.path.basename, make_batch(bucket, get_dir, manifest), progress = False)
+
+    (bucket / 'f03.txt').write_text('changed')
+    (bucket / 'f12.txt').write_text('new')
+    gsb = make_batch(bucket, get_dir, manifest)
+
+    assert gsb.files == [str(bucket / 'f03.txt'), str(bucket / 'f12.txt')]
+    assert gsb.n_unchanged == 11
+
+def test_objects_whose_func_failed_are_done_again(bucket, get_dir, tmp_path):
+    manifest = str(tmp_path / 'manifest.db')
+    app = apply_batch_func(fail_on_f04, make_batch(bucket, get_dir, manifest),
+                           executor = 'thread', progress = False)
+    assert len(app.errors) == 1
+    assert Manifest(manifest).summary() == {'done' : 11, 'failed' : 1}
+
+    gsb = make_batch(bucket, get_dir, manifest)
+    assert gsb.files == [str(bucket / 'f04.txt')]
+
+    apply_batch_func(os.path.basename, gsb, progress = False)
+    assert Manifest(manifest).summary() == {'done' : 12}
+
+def test_jobs_are_kept_apart(bucket, get_dir, tmp_path):
+    manifest = str(tmp_path / 'manifest.db')
+    apply_batch_func(os.path.basename, make_batch(bucket, get_dir, manifest), progress = False)
+
+    other = GSBatch(str(bucket / '*.txt'), get_dir = str(get_dir), backend = 'local',
+                    manifest = manifest, job = 'other', incremental = True)
+
+    assert other.n_files == 12
+
+def test_without_incremental_every_object_is_batched(bucket, get_dir, tmp_path):
+    manifest = str(tmp_path / 'manifest.db')
+    apply_batch_func(os.path.basename, make_batch(bucket, get_dir, manifest), progress = False)
+
+    gsb = make_batch(bucket, get_dir, manifest, incremental = False)
+
+    assert gsb.n_files == 12
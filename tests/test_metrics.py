@@ -0,0 +1,87 @@
+import io
+import os
+import pytest
+from cloudbatch import GSBatch, BatchStats, Callback, ProgressReporter, apply_batch_func
+
+class Recorder(Callback):
+    def __init__(self):
+        self.events = []
+    def on_run_start(self, n_batches):
+        self.events.append(('start', n_batches))
+    def on_batch_start(self, batch_index):
+        self.events.append(('batch_start', batch_index))
+    def on_batch_end(self, record):
+        self.events.append(('batch_end', record['batch']))
+    def on_run_end(self, stats):
+        self.events.append(('end', len(stats.to_records())))
+
+def make_batches(bucket_files, get_dir, tmp_path):
+    outputs = [str(tmp_path / f'o{ii:02d}.txt') for ii in range(12)]
+    down = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 5, backend = 'local')
+    up = GSBatch(outputs, put_dir = str(tmp_path / 'up'), source = 'local', batch_size = 5,
+                 backend = 'local')
+    return [down, up]
+
+def copy_name(fp_in, fp_out):
+    with open(fp_out, 'w') as fh:
+        fh.write(os.path.basename(fp_in))
+
+@pytest.mark.parametrize('prefetch', [0, 1])
+def test_stats_record_every_batch(bucket_files, get_dir, tmp_path, prefetch):
+    app = apply_batch_func(copy_name, make_batches(bucket_files, get_dir, tmp_path),
+                           prefetch = prefetch, progress = False)
+
+    records = app.stats.to_records()
+    assert [rec['batch'] for rec in records] == [0, 1, 2]
+    assert [rec['n_files'] for rec in records] == [5, 5, 2]
+    assert sum([rec['bytes_in'] for rec in records]) == sum([os.path.getsize(ff) for ff in bucket_files])
+    assert records[2]['bytes_out'] == len('f10.txt') + len('f11.txt')
+    assert all(rec['wall_s'] > 0 and not rec['failed'] for rec in records)
+    assert len(app.stats.func_latencies()) == 12
+
+    totals = app.stats.totals()
+    assert totals['n_files'] == 12
+    assert totals['files_per_s'] > 0
+    assert list(app.stats.to_arrays()['n_files']) == [5, 5, 2]
+
+def test_callbacks_are_called_in_order(bucket_files, get_dir, tmp_path):
+    recorder = Recorder()
+    records = []
+
+    apply_batch_func(copy_name, make_batches(bucket_files, get_dir, tmp_path),
+                     callbacks = [recorder, records.append], progress = False)
+
+    assert recorder.events == [('start', 3),
+                               ('batch_start', 0), ('batch_end', 0),
+                               ('batch_start', 1), ('batch_end', 1),
+                               ('batch_start', 2), ('batch_end', 2),
+                               ('end', 3)]
+    # Plain functions get each finished record
+    assert [rec['batch'] for rec in records] == [0, 1, 2]
+
+def test_stats_timers_and_failed_batches():
+    ended = []
+    stats = BatchStats([ended.append])
+    stats.run_start(2)
+    stats.batch_start(0)
+    stats.set(0, 'n_files', 4)
+    with stats.timer(0, 'apply_s'):
+        pass
+    stats.add(0, 'bytes_in', 10)
+    stats.add(0, 'bytes_in', 5)
+    stats.batch_end(0)
+    stats.batch_end(1, failed = True)
+
+    assert ended[0]['bytes_in'] == 15 and ended[0]['apply_s'] > 0
+    assert ended[0]['files_per_s'] > 0
+    assert [rec['failed'] for rec in ended] == [False, True]
+
+def test_progress_reporter_prints_one_line(bucket_files, get_dir, tmp_path):
+    stream = io.StringIO()
+
+    apply_batch_func(copy_name, make_batches(bucket_files, get_dir, tmp_path),
+                     callbacks = [ProgressReporter(stream)], progress = False)
+
+    text = stream.getvalue()
+    assert 'Progress: 100.0% (3/3 batches)' in text
+    assert text.endswith('\n') and text.count('\n') == 1
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pytest
+from cloudbatch import GSBatch, apply_batch_func
+
+def sizes(files):
+    return np.array([os.path.getsize(ff) for ff in files])
+
+def make_batch(bucket_files, get_dir, batch_size = 5):
+    return GSBatch(bucket_files, get_dir = str(get_dir), batch_size = batch_size, backend = 'local')
+
+def test_all_passes_each_batch_as_one_list(bucket_files, get_dir):
+    calls = []
+    def func(files):
+        calls.append([os.path.basename(ff) for ff in files])
+        return len(files)
+
+    app = apply_batch_func(func, make_batch(bucket_files, get_dir), pass_args = 'all', progress = False)
+
+    assert app.output == [5, 5, 2]
+    assert calls[2] == ['f10.txt', 'f11.txt']
+
+def test_all_passes_one_list_per_object(bucket_files, get_dir, tmp_path):
+    outputs = [str(tmp_path / f'o{ii:02d}.txt') for ii in range(12)]
+    def func(inputs, outs):
+        for ii, oo in zip(inputs, outs):
+            with open(oo, 'w') as fh:
+                fh.write(os.path.basename(ii))
+        return len(inputs)
+
+    up = GSBatch(outputs, source = 'local', put_dir = str(tmp_path / 'up'), batch_size = 5,
+                 backend = 'local')
+    apply_batch_func(func, [make_batch(bucket_files, get_dir), up], pass_args = 'all', progress = False)
+
+    assert sorted(os.listdir(tmp_path / 'up')) == [f'o{ii:02d}.txt' for ii in range(12)]
+    assert (tmp_path / 'up' / 'o07.txt').read_text() == 'f07.txt'
+
+def test_split_output_gives_one_output_per_file(bucket_files, get_dir):
+    app = apply_batch_func(sizes, make_batch(bucket_files, get_dir), pass_args = 'all',
+                           split_output = list, progress = False)
+
+    assert [len(out) for out in app.output] == [5, 5, 2]
+    assert app.output[1][2] == os.path.getsize(bucket_files[7])
+
+def test_split_output_must_match_the_batch(bucket_files, get_dir):
+    with pytest.raises(Exception, match = 'split_output returned 1 elements'):
+        apply_batch_func(sizes, make_batch(bucket_files, get_dir), pass_args = 'all',
+                         split_output = lambda out: [out.sum()], progress = False)
+
+def test_unknown_pass_args(bucket_files, get_dir):
+    with pytest.raises(Exception):
+        apply_batch_func(sizes, make_batch(bucket_files, get_dir), pass_args = 'some', progress = False)
@@ -0,0 +1,116 @@
+import os
+import pickle
+import pytest
+from cloudbatch import LocalBackend, RemoteFile, RetryPolicy, TransferError
+
+BLOCK = 1024
+
+class CountingBackend(LocalBackend):
+    ''' LocalBackend recording range requests and downloads '''
+
+    def __init__(self, fail_reads = 0):
+        self.ranges = []
+        self.gets = 0
+        self.fail_reads = fail_reads
+
+    def read_range(self, path, start, length):
+        self.ranges.append((start, length))
+        if self.fail_reads > 0:
+            self.fail_reads -= 1
+            raise OSError('connection reset')
+        return super().read_range(path, start, length)
+
+    def get(self, remote_paths, local_dir):
+        self.gets += len(remote_paths)
+        return super().get(remote_paths, local_dir)
+
+@pytest.fixture
+def blob(tmp_path):
+    data = os.urandom(64 * BLOCK + 100)
+    ff = tmp_path / 'blob.bin'
+    ff.write_bytes(data)
+    return str(ff), data
+
+def open_remote(blob, backend, **kwargs):
+    ff, data = blob
+    return RemoteFile(ff, len(data), backend, block_size = BLOCK,
+                      retry = RetryPolicy(max_attempts = 3, base_delay = 0), **kwargs)
+
+def test_random_reads_only_fetch_their_blocks(blob):
+    backend = CountingBackend()
+    data = blob[1]
+    fh = open_remote(blob, backend)
+
+    for start, length in [(10 * BLOCK + 5, 100), (40 * BLOCK - 10, 20), (len(data) - 50, 100)]:
+        fh.seek(start)
+        assert fh.read(length) == data[start:start + length]
+
+    assert backend.ranges == [(10 * BLOCK, BLOCK), (39 * BLOCK, 2 * BLOCK), (64 * BLOCK, 100)]
+    assert fh.bytes_fetched == 3 * BLOCK + 100
+    assert not fh.materialized
+
+def test_cached_blocks_are_not_fetched_again(blob):
+    backend = CountingBackend()
+    fh = open_remote(blob, backend)
+
+    fh.seek(5 * BLOCK)
+    fh.read(10)
+    fh.seek(5 * BLOCK + 500)
+    fh.read(10)
+
+    assert len(backend.ranges) == 1
+
+def test_sequential_reads_fetch_ahead(blob):
+    backend = CountingBackend()
+    data = blob[1]
+    fh = open_remote(blob, backend)
+
+    got = b''.join([fh.read(BLOCK) for _ in range(8)])
+
+    assert got == data[:8 * BLOCK]
+    # Requests reach ahead of what has been read
+    assert max([length for start, length in backend.ranges]) > BLOCK
+    assert max([start + length for start, length in backend.ranges]) > 8 * BLOCK
+    assert all([start % BLOCK == 0 for start, length in backend.ranges])
+
+def test_whole_object_is_downloaded_once_worth_it(blob, tmp_path):
+    backend = CountingBackend()
+    data = blob[1]
+    fh = open_remote(blob, backend, local_dir = str(tmp_path / 'local'), full_fraction = 0.25)
+    os.makedirs(tmp_path / 'local')
+
+    assert fh.read() == data
+    assert fh.materialized and backend.gets == 1
+    assert fh.bytes_fetched <= 2 * len(data)
+
+    local_path = fh.local_path
+    fh.close()
+    assert not os.path.exists(local_path)
+
+def test_failed_range_reads_are_retried(blob):
+    backend = CountingBackend(fail_reads = 2)
+    data = blob[1]
+    fh = open_remote(blob, backend)
+
+    assert fh.read(100) == data[:100]
+    assert len(backend.ranges) == 3
+
+def test_range_reads_raise_transfer_error(blob):
+    fh = open_remote(blob, CountingBackend(fail_reads = 10))
+
+    with pytest.raises(TransferError) as info:
+        fh.read(100)
+
+    assert info.value.failures[0]['attempts'] == 3
+    assert 'connection reset' in info.value.failures[0]['error']
+
+def test_remote_file_pickles(blob):
+    data = blob[1]
+    fh = open_remote(blob, LocalBackend())
+    fh.seek(1000)
+    fh.read(10)
+
+    copy = pickle.loads(pickle.dumps(fh))
+
+    assert copy.tell() == 0 and copy.bytes_fetched == 0
+    assert copy.read(BLOCK) == data[:BLOCK]
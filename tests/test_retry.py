@@ -0,0 +1,100 @@
+import os
+import pytest
+from cloudbatch import GSBatch, LocalBackend, RetryPolicy, TransferError, apply_batch_func
+
+class FlakyBackend(LocalBackend):
+    ''' LocalBackend whose transfers fail for objects in fail_times, as many
+    times as given there. Records the number of objects per call. '''
+
+    def __init__(self, fail_times):
+        self.fail_times = dict(fail_times)
+        self.calls = []
+
+    def _fails(self, name):
+        name = os.path.basename(name)
+        if self.fail_times.get(name, 0) > 0:
+            self.fail_times[name] -= 1
+            return True
+        return False
+
+    def get(self, remote_paths, local_dir):
+        self.calls.append(len(remote_paths))
+        super().get([ff for ff in remote_paths if not self._fails(ff)], local_dir)
+        return self._local_targets(remote_paths, local_dir)
+
+    def put(self, local_paths, remote_dir):
+        self.calls.append(len(local_paths))
+        failed = [ff for ff in local_paths if self._fails(ff)]
+        super().put([ff for ff in local_paths if ff not in failed], remote_dir)
+        return failed
+
+def no_wait(max_attempts = 3):
+    return RetryPolicy(max_attempts = max_attempts, base_delay = 0)
+
+def test_backoff_is_capped():
+    policy = RetryPolicy(base_delay = 1, max_delay = 5, jitter = False)
+
+    assert [policy.delay(attempt) for attempt in range(5)] == [1, 2, 4, 5, 5]
+    assert 0 <= RetryPolicy(base_delay = 1).delay(3) <= 8
+    assert RetryPolicy(max_attempts = 0).max_attempts == 1
+
+def test_only_failed_objects_are_retried(bucket_files, get_dir):
+    backend = FlakyBackend({'f01.txt' : 2})
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4,
+                  backend = backend, retry = no_wait())
+
+    gsb.get_batch()
+
+    assert backend.calls == [4, 1, 1]
+    assert sorted(os.listdir(get_dir)) == ['f00.txt', 'f01.txt', 'f02.txt', 'f03.txt']
+
+def test_get_raises_transfer_error(bucket, bucket_files, get_dir):
+    backend = FlakyBackend({'f02.txt' : 10})
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4,
+                  backend = backend, retry = no_wait())
+
+    with pytest.raises(TransferError) as info:
+        gsb.get_batch()
+
+    assert [ff['path'] for ff in info.value.failures] == [str(bucket / 'f02.txt')]
+    assert info.value.failures[0]['op'] == 'get'
+    assert info.value.failures[0]['attempts'] == 3
+    assert gsb.failures == info.value.failures
+    # Nothing from the failed batch is left behind
+    assert os.listdir(get_dir) == []
+
+def test_put_raises_transfer_error(bucket_files, tmp_path):
+    backend = FlakyBackend({'f00.txt' : 10})
+    put_dir = tmp_path / 'put'
+    gsb = GSBatch(bucket_files, put_dir = str(put_dir), source = 'local',
+                  batch_size = 3, backend = backend, retry = no_wait(2))
+
+    with pytest.raises(TransferError) as info:
+        gsb.put_batch()
+
+    assert [ff['op'] for ff in info.value.failures] == ['put']
+    assert backend.calls == [3, 1]
+    assert sorted(os.listdir(put_dir)) == ['f01.txt', 'f02.txt']
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_failed_batches_can_be_skipped(bucket, bucket_files, get_dir, prefetch):
+    backend = FlakyBackend({'f05.txt' : 10})
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4,
+                  backend = backend, retry = no_wait())
+
+    app = apply_batch_func(os.path.basename, gsb, prefetch = prefetch,
+                           on_transfer_error = 'skip', progress = False)
+
+    assert app.output[1] is None
+    assert app.output[2] == ['f08.txt', 'f09.txt', 'f10.txt', 'f11.txt']
+    assert [fb['batch'] for fb in app.failed_batches] == [1]
+    assert app.failed_batches[0]['failures'][0]['path'] == str(bucket / 'f05.txt')
+    assert os.listdir(get_dir) == []
+
+def test_failed_batch_raises_by_default(bucket_files, get_dir):
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 4,
+                  backend = FlakyBackend({'f05.txt' : 10}), retry = no_wait())
+
+    with pytest.raises(TransferError):
+        apply_batch_func(os.path.basename, gsb, progress = False)
+    assert os.listdir(get_dir) == []
@@ -0,0 +1,79 @@
+import os
+import pytest
+from cloudbatch import GSBatch, BatchLeases, apply_batch_func, shard_from_env
+from cloudbatch.sharding import shard_batches
+
+def make_batch(bucket_files, get_dir):
+    return GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 2, backend = 'local')
+
+def test_shard_from_env():
+    assert shard_from_env({}) == (0, 1)
+    assert shard_from_env({'CLOUDBATCH_SHARD_INDEX' : '2', 'CLOUDBATCH_NUM_SHARDS' : '4'}) == (2, 4)
+    assert shard_from_env({'BATCH_TASK_INDEX' : '1', 'BATCH_TASK_COUNT' : '3'}) == (1, 3)
+    assert shard_from_env({'SLURM_ARRAY_TASK_ID' : '5', 'SLURM_ARRAY_TASK_MIN' : '1',
+                           'SLURM_ARRAY_TASK_COUNT' : '8'}) == (4, 8)
+    assert shard_from_env({'JOB_COMPLETION_INDEX' : '0', 'CLOUDBATCH_NUM_SHARDS' : '2'}) == (0, 2)
+    with pytest.raises(Exception, match = 'CLOUDBATCH_NUM_SHARDS'):
+        shard_from_env({'AWS_BATCH_JOB_ARRAY_INDEX' : '3'})
+
+def test_shards_are_dealt_round_robin():
+    shards = [shard_batches(10, ii, 3) for ii in range(3)]
+
+    assert shards == [[0, 3, 6, 9], [1, 4, 7], [2, 5, 8]]
+    with pytest.raises(Exception):
+        shard_batches(10, 3, 3)
+    with pytest.raises(Exception):
+        shard_batches(10, 0, None)
+
+def test_each_shard_runs_its_own_batches(bucket_files, get_dir):
+    seen = []
+    def record(ff):
+        seen.append(os.path.basename(ff))
+        return os.path.basename(ff)
+
+    for shard in [(0, 2), (1, 2)]:
+        app = apply_batch_func(record, make_batch(bucket_files, get_dir), shard = shard, progress = False)
+        assert app.batch_ids == list(range(shard[0], 6, 2))
+
+    assert sorted(seen) == [os.path.basename(ff) for ff in bucket_files]
+
+def test_shard_from_the_environment(bucket_files, get_dir, monkeypatch):
+    monkeypatch.setenv('CLOUDBATCH_SHARD_INDEX', '1')
+    monkeypatch.setenv('CLOUDBATCH_NUM_SHARDS', '3')
+
+    app = apply_batch_func(os.path.basename, make_batch(bucket_files, get_dir), shard = 'env',
+                           progress = False)
+
+    assert app.batch_ids == [1, 4]
+
+def test_a_lease_is_claimed_once(tmp_path):
+    lease_dir = str(tmp_path / 'leases')
+    first = BatchLeases(lease_dir, ttl = 60)
+    second = BatchLeases(lease_dir, ttl = 60, poll_interval = 0.01)
+
+    assert next(first.claims([0, 1, 2])) == 0
+    first.done(0)
+    # The second worker takes what's left and stops, as 0 is done
+    assert list(second.claims([0, 1, 2])) == [1, 2]
+
+def test_abandoned_leases_are_taken_over(tmp_path):
+    lease_dir = str(tmp_path / 'leases')
+    crashed = BatchLeases(lease_dir, ttl = 60)
+    next(crashed.claims([0]))
+    other = BatchLeases(lease_dir, ttl = 0.1, poll_interval = 0.02)
+
+    assert list(other.claims([0, 1])) == [1, 0]
+    assert sorted(os.listdir(lease_dir)) == ['b00000000.0.lease', 'b00000000.1.lease',
+                                             'b00000001.0.lease']
+
+def test_workers_share_batches_through_leases(bucket_files, get_dir, tmp_path):
+    lease_dir = str(tmp_path / 'leases')
+    first = apply_batch_func(os.path.basename, make_batch(bucket_files, get_dir), shard = (0, 2),
+                             lease_dir = lease_dir, progress = False)
+
+    # The first worker also took over the batches of shard 1
+    assert first.batch_ids == list(range(6))
+
+    second = apply_batch_func(os.path.basename, make_batch(bucket_files, get_dir), shard = (1, 2),
+                              lease_dir = lease_dir, progress = False)
+    assert second.batch_ids == []
@@ -0,0 +1,96 @@
+import os
+import pickle
+import tarfile
+from cloudbatch import GSBatch, ShardArchive, ShardMember, apply_batch_func, write_shard
+
+def contents(ff):
+    with open(ff, 'rb') as fh:
+        return fh.read()
+
+def test_write_and_read_shard(bucket_files, tmp_path):
+    files = bucket_files[:5]
+    shard_file = str(tmp_path / 'shard.tar')
+
+    index = write_shard(shard_file, files)
+    archive = ShardArchive(shard_file)
+
+    assert archive.names() == [os.path.basename(ff) for ff in files]
+    assert [mm['raw_size'] for mm in index['members']] == [os.path.getsize(ff) for ff in files]
+    for ff in files:
+        assert archive.read(os.path.basename(ff)) == contents(ff)
+
+def test_shard_is_a_plain_tar(bucket_files, tmp_path):
+    files = bucket_files[:3]
+    shard_file = str(tmp_path / 'shard.tar')
+    write_shard(shard_file, files)
+
+    with tarfile.open(shard_file) as tar:
+        tar.extractall(tmp_path / 'out')
+
+    for ff in files:
+        assert contents(tmp_path / 'out' / os.path.basename(ff)) == contents(ff)
+
+def test_plain_tar_is_scanned(bucket_files, tmp_path):
+    files = bucket_files[:3]
+    tar_file = str(tmp_path / 'plain.tar')
+    with tarfile.open(tar_file, 'w') as tar:
+        for ff in files:
+            tar.add(ff, arcname = os.path.basename(ff))
+
+    archive = ShardArchive(tar_file)
+
+    assert archive.read('f01.txt') == contents(files[1])
+
+def test_bundle_round_trip(bucket_files, tmp_path):
+    files = bucket_files
+    put_dir = tmp_path / 'shards'
+    up = GSBatch(files, put_dir = str(put_dir), source = 'local', batch_size = 5,
+                 backend = 'local', bundle = True)
+    for bb in range(up.n_batches):
+        up.goto_batch(bb)
+        up.put_batch()
+    assert sorted(os.listdir(put_dir)) == ['shard-00000000.tar', 'shard-00000001.tar', 'shard-00000002.tar']
+
+    get_dir = tmp_path / 'get'
+    get_dir.mkdir()
+    down = GSBatch(str(put_dir / '*.tar'), get_dir = str(get_dir), batch_size = 2,
+                   backend = 'local', bundle = True)
+    app = apply_batch_func(contents, down, progress = False)
+
+    assert [data for out in app.output for data in out] == [contents(ff) for ff in files]
+    assert os.listdir(get_dir) == []
+
+def test_lazy_members_are_extracted_when_used(bucket_files, tmp_path):
+    files = bucket_files[:4]
+    shard_file = str(tmp_path / 'shard.tar')
+    write_shard(shard_file, files)
+
+    member = ShardMember(ShardArchive(shard_file), 'f02.txt', str(tmp_path / 'members'))
+    assert not member.extracted and not os.path.exists(member.path)
+
+    assert contents(member) == contents(files[2])
+    assert member.extracted
+    member.remove()
+    assert not os.path.exists(member.path)
+
+def test_shard_member_pickles(bucket, bucket_files, tmp_path):
+    shard_file = str(tmp_path / 'shard.tar')
+    write_shard(shard_file, bucket_files[:2])
+    member = ShardMember(ShardArchive(shard_file), 'f01.txt', str(tmp_path / 'members'))
+
+    copy = pickle.loads(pickle.dumps(member))
+
+    assert (copy.name, copy.path, copy.size) == (member.name, member.path, member.size)
+    assert contents(copy) == contents(bucket / 'f01.txt')
+
+def test_lazy_members_with_a_process_pool(bucket_files, tmp_path):
+    files = bucket_files[:6]
+    write_shard(str(tmp_path / 'shard-0.tar'), files)
+    os.makedirs(tmp_path / 'get')
+    down = GSBatch(str(tmp_path / 'shard-*.tar'), get_dir = str(tmp_path / 'get'),
+                   batch_size = 1, backend = 'local', bundle = True, bundle_extract = 'lazy')
+
+    app = apply_batch_func(contents, down, executor = 'process', max_workers = 2, progress = False)
+
+    assert app.errors == []
+    assert app.output == [[contents(ff) for ff in files]]
@@ -0,0 +1,124 @@
+import os
+import numpy as np
+import pytest
+from cloudbatch import (GSBatch, JSONLinesSink, MemorySink, NpyResults, NpySink, ParquetSink,
+                        ZarrSink, apply_batch_func, read_results)
+
+def make_batch(bucket_files, get_dir):
+    return GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 5, backend = 'local')
+
+def size(ff):
+    return os.path.getsize(ff)
+
+def sizes(files):
+    return np.array([os.path.getsize(ff) for ff in files])
+
+def all_sizes(bucket_files):
+    return [os.path.getsize(ff) for ff in bucket_files]
+
+def test_memory_sink_orders_by_batch():
+    sink = MemorySink()
+    sink.open()
+    sink.write(1, 'b')
+    sink.write(0, 'a')
+    sink.close()
+
+    assert sink.result() == ['a', 'b']
+
+def test_json_lines_sink(bucket_files, get_dir, tmp_path):
+    fn = str(tmp_path / 'out' / 'sizes.jsonl')
+
+    app = apply_batch_func(sizes, make_batch(bucket_files, get_dir), pass_args = 'all',
+                           sink = JSONLinesSink(fn), progress = False)
+
+    assert app.output == fn
+    records = list(read_results(fn))
+    assert [bb for bb, out in records] == [0, 1, 2]
+    assert sum([out for bb, out in records], []) == all_sizes(bucket_files)
+
+def test_npy_sink_memory_maps_the_results(bucket_files, get_dir, tmp_path):
+    out_dir = str(tmp_path / 'npy')
+
+    results = apply_batch_func(size, make_batch(bucket_files, get_dir), sink = NpySink(out_dir),
+                               progress = False).output
+
+    assert isinstance(results, NpyResults)
+    assert len(results) == 12
+    assert results[7] == os.path.getsize(bucket_files[7])
+    assert results[-1] == os.path.getsize(bucket_files[-1])
+    assert list(results[3:6]) == all_sizes(bucket_files)[3:6]
+    assert list(results.batch(2)) == all_sizes(bucket_files)[10:]
+    assert isinstance(results.batch(0), np.memmap)
+    assert list(read_results(out_dir).to_array()) == all_sizes(bucket_files)
+    with pytest.raises(IndexError):
+        results[12]
+
+def test_npy_sink_with_scalar_outputs(bucket_files, get_dir, tmp_path):
+    out_dir = str(tmp_path / 'npy')
+
+    # One number per batch
+    results = apply_batch_func(lambda files: sizes(files).sum(), make_batch(bucket_files, get_dir),
+                               pass_args = 'all', sink = NpySink(out_dir), progress = False).output
+
+    assert len(results) == 3
+    assert list(results) == [sum(all_sizes(bucket_files)[bb:bb + 5]) for bb in [0, 5, 10]]
+    assert results.batch(1).shape == (1,)
+
+def test_npy_results_read_scalar_chunks(tmp_path):
+    # As written by earlier versions of NpySink
+    np.save(tmp_path / 'batch_00000000.npy', np.array(4.5))
+    np.save(tmp_path / 'batch_00000001.npy', np.array([1.5, 2.5]))
+
+    results = NpyResults(str(tmp_path))
+
+    assert len(results) == 3
+    assert list(results) == [4.5, 1.5, 2.5]
+
+def test_npy_sink_skips_failed_batches_and_old_chunks(tmp_path):
+    out_dir = tmp_path / 'npy'
+    out_dir.mkdir()
+    np.save(out_dir / 'batch_00000009.npy', np.zeros(3))
+    sink = NpySink(str(out_dir))
+
+    sink.open()
+    sink.write(0, [1, 2])
+    sink.write(1, None)
+    sink.close()
+
+    assert sorted(os.listdir(out_dir)) == ['batch_00000000.npy']
+    with pytest.raises(Exception, match = 'object array'):
+        sink.write(2, [{'a' : 1}])
+
+def test_sink_keeps_batches_written_before_an_error(bucket_files, get_dir, tmp_path):
+    fn = str(tmp_path / 'sizes.jsonl')
+    def fail_on_f07(ff):
+        if ff.endswith('f07.txt'):
+            raise ValueError('bad file')
+        return size(ff)
+
+    with pytest.raises(ValueError):
+        apply_batch_func(fail_on_f07, make_batch(bucket_files, get_dir), sink = JSONLinesSink(fn),
+                         progress = False)
+
+    assert [bb for bb, out in read_results(fn)] == [0]
+
+def test_parquet_sink(bucket_files, get_dir, tmp_path):
+    pytest.importorskip('pyarrow')
+    fn = str(tmp_path / 'sizes.parquet')
+
+    apply_batch_func(lambda ff: {'name' : os.path.basename(ff), 'size' : size(ff)},
+                     make_batch(bucket_files, get_dir), sink = ParquetSink(fn), progress = False)
+
+    table = read_results(fn)
+    assert table.column('size').to_pylist() == all_sizes(bucket_files)
+    assert table.column('batch').to_pylist()[5] == 1
+
+def test_zarr_sink(bucket_files, get_dir, tmp_path):
+    pytest.importorskip('zarr')
+    store = str(tmp_path / 'sizes.zarr')
+
+    apply_batch_func(size, make_batch(bucket_files, get_dir), sink = ZarrSink(store), progress = False)
+
+    group = read_results(store)
+    assert list(group['output'][:]) == all_sizes(bucket_files)
+    assert list(group['batch'][:]) == [0] * 5 + [1] * 5 + [2] * 2
@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from cloudbatch import GSBatch, StagingArea, apply_batch_func
+
+def test_reservations_wait_for_space():
+    staging = StagingArea(max_bytes = 100)
+    staging.reserve({'a' : 60})
+    admitted = []
+    waiter = threading.Thread(target = lambda: (staging.reserve({'b' : 60}), admitted.append('b')))
+    waiter.start()
+
+    time.sleep(0.1)
+    assert admitted == []
+    staging.release(['a'])
+    waiter.join(timeout = 5)
+
+    assert admitted == ['b']
+    assert staging.stats() == {'max_bytes' : 100, 'staged_bytes' : 60, 'peak_bytes' : 60}
+
+def test_tickets_are_admitted_in_order():
+    staging = StagingArea(max_bytes = 100)
+    first = staging.ticket()
+    second = staging.ticket()
+    admitted = []
+    waiter = threading.Thread(target = lambda: (staging.reserve({'b' : 10}, second), admitted.append('b')))
+    waiter.start()
+
+    # There is room, but the earlier ticket goes first
+    time.sleep(0.1)
+    assert admitted == []
+    staging.reserve({'a' : 10}, first)
+    waiter.join(timeout = 5)
+
+    assert admitted == ['b']
+
+def test_oversized_and_timed_out_reservations_raise():
+    staging = StagingArea(max_bytes = 100, timeout = 0.05)
+    with pytest.raises(Exception, match = 'more than the staging quota'):
+        staging.reserve({'a' : 101})
+
+    staging.reserve({'a' : 80})
+    with pytest.raises(Exception, match = 'Timed out'):
+        staging.reserve({'b' : 30})
+    # A failed reservation doesn't block later ones
+    staging.reserve({'c' : 20})
+    assert staging.staged_bytes == 100
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_staged_bytes_stay_under_the_quota(bucket_files, get_dir, prefetch):
+    sizes = [os.path.getsize(ff) for ff in bucket_files]
+    quota = 2 * sum(sizes[-3:])
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 3, staging = quota, backend = 'local')
+
+    app = apply_batch_func(os.path.basename, gsb, prefetch = prefetch, progress = False)
+
+    assert app.output[3] == ['f09.txt', 'f10.txt', 'f11.txt']
+    assert 0 < gsb.staging.peak_bytes <= quota
+    assert gsb.staging.staged_bytes == 0
+
+def test_oversized_batches_can_be_split(bucket_files, get_dir):
+    quota = sum([os.path.getsize(ff) for ff in bucket_files[-2:]])
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 6, staging = quota,
+                  staging_split = True, backend = 'local')
+
+    app = apply_batch_func(os.path.basename, gsb, progress = False)
+
+    totals = np.add.reduceat(gsb.file_sizes, gsb.batch_bounds[:-1])
+    assert np.all(totals <= quota)
+    assert sum(app.output, []) == [os.path.basename(ff) for ff in bucket_files]
+
+def test_oversized_batches_raise_without_split(bucket_files, get_dir):
+    gsb = GSBatch(bucket_files, get_dir = str(get_dir), batch_size = 6, staging = 50, backend = 'local')
+
+    with pytest.raises(Exception, match = 'staging quota'):
+        gsb.get_batch()